@@ -115,7 +115,10 @@ let appState = {
     memoryEnabled: true,
     memoryInfluence: 0.7, // How much memory affects recognition (0-1)
     maxMemories: 50, // Maximum number of memories to store
-    currentMemoryContext: null
+    currentMemoryContext: null,
+    // Memories to send to / delete from the server on the next save
+    dirtyMemoryIds: new Set(),
+    deletedMemoryIds: new Set()
 };
 
 // Utility functions
@@ -168,12 +171,15 @@ async function storeVisualMemory(imageData, recognizedObjects, processingResults
     console.log('🧠 Created memory with tags:', memory.tags);
     
     appState.visualMemories.push(memory);
+    appState.dirtyMemoryIds.add(memory.id);
     
     // Maintain memory limit
     if (appState.visualMemories.length > appState.maxMemories) {
         // Remove oldest memory with lowest access count
         appState.visualMemories.sort((a, b) => (a.accessCount + a.confidence) - (b.accessCount + b.confidence));
         const removedMemory = appState.visualMemories.shift();
+        appState.dirtyMemoryIds.delete(removedMemory.id);
+        appState.deletedMemoryIds.add(removedMemory.id);
         console.log('🧠 Removed old memory:', removedMemory.recognizedObjects.map(o => o.name));
     }
     
@@ -208,6 +214,7 @@ function findSimilarMemories(currentTags, maxResults = 5) {
         .slice(0, maxResults)
         .map(scored => {
             scored.memory.accessCount++;
+            appState.dirtyMemoryIds.add(scored.memory.id);
             return scored;
         });
 }
@@ -260,6 +267,8 @@ function generateMemoryContext(similarMemories) {
 }
 
 async function clearVisualMemory() {
+    appState.visualMemories.forEach(memory => appState.deletedMemoryIds.add(memory.id));
+    appState.dirtyMemoryIds.clear();
     appState.visualMemories = [];
     appState.currentMemoryContext = null;
     updateMemoryDisplay();
@@ -296,36 +305,57 @@ function updateMemoryDisplay() {
 }
 
 // Persistent Memory Storage Functions
+function memoryUrl(id) {
+    return `/memories/${encodeURIComponent(String(id))}`;
+}
+
 async function saveMemoriesToFile() {
+    // Only memories that were added, used or removed since the last save are sent,
+    // so a save costs the same however large the server-side bank is
     try {
-        const memoryData = {
-            version: "1.0",
-            timestamp: new Date().toISOString(),
-            memories: appState.visualMemories.map(memory => ({
-                ...memory,
-                // Don't save the full base64 image data to keep file size manageable
-                // Keep only a thumbnail or hash for identification
-                imageData: memory.imageData ? memory.imageData.substring(0, 100) + '...' : null
+        const dirty = appState.visualMemories.filter(memory => appState.dirtyMemoryIds.has(memory.id));
+        const deleted = Array.from(appState.deletedMemoryIds);
+        const requests = [
+            ...deleted.map(id => fetch(memoryUrl(id), { method: 'DELETE' })),
+            ...dirty.map(memory => fetch(memoryUrl(memory.id), {
+                method: 'PUT',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({
+                    ...memory,
+                    // Don't save the full base64 image data to keep the bank small
+                    // Keep only a thumbnail or hash for identification
+                    imageData: memory.imageData ? memory.imageData.substring(0, 100) + '...' : null
+                })
             })),
-            settings: {
-                memoryEnabled: appState.memoryEnabled,
-                memoryInfluence: appState.memoryInfluence,
-                maxMemories: appState.maxMemories
-            }
-        };
-        
-        const response = await fetch('/save-memory', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify(memoryData)
-        });
+            // Settings only: without a memories list the server leaves the bank alone
+            fetch('/save-memory', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({
+                    version: "1.0",
+                    timestamp: new Date().toISOString(),
+                    settings: {
+                        memoryEnabled: appState.memoryEnabled,
+                        memoryInfluence: appState.memoryInfluence,
+                        maxMemories: appState.maxMemories
+                    }
+                })
+            })
+        ];
+        const responses = await Promise.all(requests);
         
-        if (response.ok) {
-            console.log('💾 Visual memories saved to file');
+        // A DELETE of a memory the server no longer has is fine
+        const failed = responses.filter(response => !response.ok && response.status !== 404);
+        if (failed.length === 0) {
+            dirty.forEach(memory => appState.dirtyMemoryIds.delete(memory.id));
+            deleted.forEach(id => appState.deletedMemoryIds.delete(id));
+            console.log(`💾 Visual memories saved (${dirty.length} updated, ${deleted.length} removed)`);
         } else {
-            console.error('❌ Failed to save memories:', response.statusText);
+            console.error('❌ Failed to save memories:', failed[0].statusText);
         }
     } catch (error) {
         console.error('❌ Error saving memories:', error);
@@ -886,7 +916,7 @@ function resetAllSteps() {
     updateProgress(0);
 }
 
-async function callClaudeAPI(prompt, model = 'claude-3-5-sonnet-20241022', imageData = null) {
+async function callClaudeAPI(prompt, model = 'claude-3-5-sonnet-20241022', imageData = null, onDelta = null) {
     // Prepare message content
     let content;
     
@@ -922,6 +952,11 @@ async function callClaudeAPI(prompt, model = 'claude-3-5-sonnet-20241022', image
         }],
         api_key: appState.apiKey
     };
+    
+    // Stream tokens through the proxy when the caller wants partial output
+    if (onDelta) {
+        requestBody.stream = true;
+    }
 
     const response = await fetch('/claude-proxy', {
         method: 'POST',
@@ -935,10 +970,49 @@ async function callClaudeAPI(prompt, model = 'claude-3-5-sonnet-20241022', image
         throw new Error(`Claude API error: ${response.status} ${response.statusText}`);
     }
     
+    if (onDelta) {
+        return readClaudeEventStream(response, onDelta);
+    }
+    
     const data = await response.json();
     return data.content[0].text;
 }
 
+async function readClaudeEventStream(response, onDelta) {
+    // Parse server-sent events and report the accumulated text after every delta
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let text = '';
+    
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            const dataLine = rawEvent.split('\n').find(line => line.startsWith('data:'));
+            if (!dataLine) continue;
+            
+            const event = JSON.parse(dataLine.slice(5).trim());
+            if (event.type === 'content_block_delta' && event.delta.type === 'text_delta') {
+                text += event.delta.text;
+                onDelta(text);
+            } else if (event.type === 'error') {
+                throw new Error(`Claude API error: ${event.error.message}`);
+            }
+        }
+    }
+    
+    if (!text) {
+        throw new Error('No content received from Claude API');
+    }
+    return text;
+}
+
 function selectOptimalModel(stepNumber) {
     // Implement optimal model selection based on step complexity
     if (stepNumber <= 3) {
@@ -1026,12 +1100,13 @@ async function startSimulation() {
             // Call Claude API with image if available
             const startTime = Date.now();
             let output;
+            const showPartialOutput = (partial) => updateStepOutput(stepNumber, partial);
             if (stepNumber === 1 && appState.inputMethod === 'camera' && appState.capturedFrame) {
                 // First step with camera input - send image to vision model
-                output = await callClaudeAPI(prompt, selectedModel, appState.capturedFrame);
+                output = await callClaudeAPI(prompt, selectedModel, appState.capturedFrame, showPartialOutput);
             } else {
                 // Regular text processing for subsequent steps
-                output = await callClaudeAPI(prompt, selectedModel);
+                output = await callClaudeAPI(prompt, selectedModel, null, showPartialOutput);
             }
             const processingTime = Date.now() - startTime;
             appState.totalProcessingTime += processingTime;
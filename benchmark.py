@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the Claude Neural Visual Processing Simulator
+Throughput, latency percentiles and memory of pathway runs, batches, the proxy and the
+memory store against the offline mock API, appended to a results file for comparison
+"""
+
+import argparse
+import gc
+import http.client
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource  # Unix only: peak resident set size
+except ImportError:
+    resource = None
+
+import script
+import start_server
+from memory_store import MemoryStore
+from mock_api import MockAPIServer, MockBehavior
+from structured_logging import set_quiet
+
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results.jsonl')
+
+SCALES = {
+    'small': {'runs': 5, 'batch_items': 8, 'proxy_requests': 50, 'proxy_concurrency': 8, 'memory_counts': (100, 1000)},
+    'medium': {'runs': 20, 'batch_items': 32, 'proxy_requests': 300, 'proxy_concurrency': 16, 'memory_counts': (1000, 5000)},
+    'large': {'runs': 50, 'batch_items': 128, 'proxy_requests': 1000, 'proxy_concurrency': 32, 'memory_counts': (1000, 10000, 50000)},
+}
+
+# Direction of improvement for the compared statistics
+HIGHER_IS_BETTER = ('throughput',)
+LOWER_IS_BETTER = ('p50', 'p95', 'p99')
+
+
+def percentile(values, q):
+    """Linearly interpolated ``q`` quantile (0..1) of ``values``"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(samples, elapsed, units=None):
+    """Latency percentiles of ``samples`` (seconds) and throughput of ``units`` (default: one per sample)"""
+    units = len(samples) if units is None else units
+    return {
+        'count': len(samples),
+        'seconds': round(elapsed, 4),
+        'throughput': round(units / elapsed, 3) if elapsed else None,
+        'mean': round(sum(samples) / len(samples), 6) if samples else None,
+        'p50': round(percentile(samples, 0.50), 6) if samples else None,
+        'p95': round(percentile(samples, 0.95), 6) if samples else None,
+        'p99': round(percentile(samples, 0.99), 6) if samples else None,
+    }
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Linux reports KiB
+
+
+def measure(name, scenario, trace_memory):
+    """Run ``scenario()`` (returning a stats dict), adding peak traced allocations when enabled"""
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        stats = scenario()
+        if trace_memory:
+            stats['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    stats['peak_rss_bytes'] = peak_rss_bytes()
+    print(f'  {name:<28} ' + '  '.join(f'{key}={value}' for key, value in stats.items()
+                                         if key in ('count', 'throughput', 'p50', 'p95', 'p99')))
+    return stats
+
+
+def make_simulator(behavior):
+    simulator = script.VisualProcessingSimulator()
+    simulator.set_provider(script.MockProvider(behavior))
+    return simulator
+
+
+def bench_single_runs(behavior, runs):
+    simulator = make_simulator(behavior)
+    samples, steps = [], 0
+    start = time.perf_counter()
+    for run in range(runs):
+        run_start = time.perf_counter()
+        results = simulator.process_visual_input(f'Benchmark stimulus {run}: a moving red square on grey', verbose=False)
+        samples.append(time.perf_counter() - run_start)
+        steps += len(results)
+    stats = summarize(samples, time.perf_counter() - start)
+    stats['steps_per_second'] = round(steps / sum(samples), 3) if samples else None
+    return stats
+
+
+def bench_batch(behavior, items, concurrency=4):
+    simulator = make_simulator(behavior)
+    inputs = [f'Batch stimulus {index}: a rotating blue grating' for index in range(items)]
+    start = time.perf_counter()
+    results = list(simulator.process_batch(inputs, max_concurrency=concurrency))
+    stats = summarize([item.elapsed for item in results], time.perf_counter() - start)
+    stats['errors'] = sum(1 for item in results if item.error)
+    return stats
+
+
+def bench_proxy(behavior, requests, concurrency):
+    """Concurrent clients -> start_server proxy -> pooled upstream -> mock Messages API"""
+    upstream = MockAPIServer(behavior).start()
+    previous_upstream = start_server.UPSTREAM
+    start_server.UPSTREAM = start_server.UpstreamPool(upstream.url, pool_size=concurrency)
+    proxy = start_server.BoundedThreadPoolServer(('127.0.0.1', 0), start_server.Handler, workers=concurrency)
+    threading.Thread(target=proxy.serve_forever, daemon=True).start()
+    port = proxy.server_address[1]
+    local = threading.local()
+
+    def call(index):
+        if not hasattr(local, 'connection'):
+            local.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        body = json.dumps({'api_key': 'mock-key', 'model': 'claude-3-5-haiku-20241022', 'max_tokens': 300,
+                           'messages': [{'role': 'user', 'content': f'Proxy request {index}'}]})
+        request_start = time.perf_counter()
+        # Bypass the proxy response cache so every request measures the upstream path
+        local.connection.request('POST', '/claude-proxy', body, {'Content-Type': 'application/json', 'Cache-Control': 'no-cache'})
+        response = local.connection.getresponse()
+        response.read()
+        if response.getheader('Connection', '').lower() == 'close' or response.version == 10:
+            local.connection.close()
+            del local.connection
+        return time.perf_counter() - request_start, response.status
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            outcomes = list(executor.map(call, range(requests)))
+        stats = summarize([seconds for seconds, _ in outcomes], time.perf_counter() - start)
+        stats['errors'] = sum(1 for _, status in outcomes if status != 200)
+        return stats
+    finally:
+        proxy.shutdown()
+        proxy.server_close()
+        start_server.UPSTREAM.close()
+        start_server.UPSTREAM = previous_upstream
+        upstream.stop()
+
+
+def make_memory(index):
+    return {
+        'id': f'bench-{index:07d}',
+        'timestamp': f'2024-01-01T00:{index // 60 % 60:02d}:{index % 60:02d}Z',
+        'description': f'Benchmark memory {index}: red square moving left over a grey background',
+        'confidence': (index % 100) / 100,
+        'accessCount': index % 7,
+        'tags': ['benchmark', f'group-{index % 10}'],
+        'features': {'color': 'red', 'shape': 'square', 'motion': 'left'},
+    }
+
+
+def bench_memory_store(count):
+    """Bulk save, full load and single-memory update times for a bank of ``count`` memories"""
+    memories = [make_memory(index) for index in range(count)]
+    with tempfile.TemporaryDirectory() as directory:
+        store = MemoryStore(os.path.join(directory, 'bench.sqlite'))
+        try:
+            start = time.perf_counter()
+            store.replace_all(memories)
+            save_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            exported = store.export_all()
+            load_seconds = time.perf_counter() - start
+            samples = []
+            for index in range(0, count, max(1, count // 200)):
+                memory = dict(memories[index], accessCount=memories[index]['accessCount'] + 1)
+                upsert_start = time.perf_counter()
+                store.upsert(memory)
+                samples.append(time.perf_counter() - upsert_start)
+        finally:
+            store.close()
+    stats = summarize(samples, sum(samples))
+    stats.update(memories=len(exported['memories']), save_seconds=round(save_seconds, 4), load_seconds=round(load_seconds, 4),
+                 save_per_second=round(count / save_seconds, 1), load_per_second=round(count / load_seconds, 1))
+    return stats
+
+
+def current_version():
+    """``git describe`` of the working tree (with -dirty), or 'unknown' outside a checkout"""
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or 'unknown'
+    except (OSError, subprocess.SubprocessError):
+        return 'unknown'
+
+
+def run_benchmarks(scale='small', behavior=None, scenarios=None, trace_memory=False):
+    """Run the selected scenarios at ``scale`` and return one result record"""
+    config = SCALES[scale]
+    behavior_options = {'latency': 0.02, 'distribution': 'lognormal', 'output_tokens': 300}
+    behavior_options.update(behavior or {})
+    selected = set(scenarios or ('single', 'batch', 'proxy', 'memory'))
+    # Per-step INFO records would dominate the output; warnings (e.g. injected failures) still show
+    set_quiet(True)
+
+    def mock():
+        return MockBehavior(**behavior_options)
+
+    results = {}
+    if 'single' in selected:
+        results['single_run'] = measure('single_run', lambda: bench_single_runs(mock(), config['runs']), trace_memory)
+    if 'batch' in selected:
+        results['batch'] = measure('batch', lambda: bench_batch(mock(), config['batch_items']), trace_memory)
+    if 'proxy' in selected:
+        results['proxy'] = measure('proxy', lambda: bench_proxy(mock(), config['proxy_requests'], config['proxy_concurrency']), trace_memory)
+    if 'memory' in selected:
+        for count in config['memory_counts']:
+            name = f'memory_store_{count}'
+            results[name] = measure(name, lambda: bench_memory_store(count), trace_memory)
+    return {
+        'version': current_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': scale,
+        'behavior': behavior_options,
+        'scenarios': results,
+    }
+
+
+def load_results(path=RESULTS_FILE):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_result(record, path=RESULTS_FILE):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def compare(record, baseline, threshold=0.10):
+    """Relative change of each scenario statistic against ``baseline``; returns (rows, regressions)"""
+    rows, regressions = [], []
+    for name, stats in record['scenarios'].items():
+        previous = baseline['scenarios'].get(name)
+        if not previous:
+            continue
+        for key in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            old, new = previous.get(key), stats.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if key in HIGHER_IS_BETTER else change
+            row = (name, key, old, new, change)
+            rows.append(row)
+            if worse > threshold:
+                regressions.append(row)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the simulator against the offline mock API')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--scenario', action='append', choices=('single', 'batch', 'proxy', 'memory'),
+                        help='scenario to run (repeatable; default: all)')
+    parser.add_argument('--latency', type=float, default=0.02, help='mean mock API latency in seconds')
+    parser.add_argument('--distribution', choices=MockBehavior.DISTRIBUTIONS, default='lognormal')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--output-tokens', type=int, default=300)
+    parser.add_argument('--tracemalloc', action='store_true', help='also record peak Python allocations (slower)')
+    parser.add_argument('--results', default=RESULTS_FILE, help='JSON-lines file results are appended to')
+    parser.add_argument('--no-save', action='store_true', help='do not append this run to the results file')
+    parser.add_argument('--compare', action='store_true', help='compare with the previous result at the same scale and mock behaviour')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative slowdown reported as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 on regressions')
+    args = parser.parse_args()
+
+    print(f'Benchmarking at scale {args.scale} (mock latency {args.latency}s {args.distribution})')
+    record = run_benchmarks(args.scale, {'latency': args.latency, 'distribution': args.distribution,
+                                         'error_rate': args.error_rate, 'rate_limit_rate': args.rate_limit_rate,
+                                         'output_tokens': args.output_tokens},
+                            args.scenario, args.tracemalloc)
+    # Only runs against the same scale and mock behaviour are comparable
+    history = [previous for previous in load_results(args.results)
+               if previous.get('scale') == record['scale'] and previous.get('behavior') == record['behavior']]
+    if not args.no_save:
+        save_result(record, args.results)
+        print(f'Results appended to {args.results} (version {record["version"]})')
+
+    if args.compare:
+        if not history:
+            print('No previous result at this scale and mock behaviour to compare with')
+            return
+        baseline = history[-1]
+        rows, regressions = compare(record, baseline, args.threshold)
+        print(f'Compared with {baseline["version"]} ({baseline["timestamp"]}):')
+        for name, key, old, new, change in rows:
+            marker = '  REGRESSION' if (name, key, old, new, change) in regressions else ''
+            print(f'  {name:<28} {key:<10} {old:>12} -> {new:<12} {change:+.1%}{marker}')
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
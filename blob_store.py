@@ -0,0 +1,99 @@
+"""
+Content-addressed blob store for visual memory images
+Each image is stored once on disk under its SHA-256 hash
+"""
+
+import base64
+import binascii
+import hashlib
+import os
+import re
+import tempfile
+
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# Leading bytes of the image formats the camera and uploads produce
+MAGIC_NUMBERS = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+
+def sniff_media_type(header):
+    """Guess an image media type from its first bytes"""
+    for magic, media_type in MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return media_type
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+def decode_image_data(image_data):
+    """Decode base64 image data (optionally a data: URL); returns None if it isn't valid base64"""
+    if not isinstance(image_data, str) or not image_data:
+        return None
+    if image_data.startswith('data:'):
+        image_data = image_data.partition(',')[2]
+    try:
+        return base64.b64decode(image_data, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+
+class BlobStore:
+    """Stores byte blobs in a sharded directory tree keyed by SHA-256
+
+    Identical images are written once no matter how many memories refer to them,
+    and files are written atomically so concurrent writers never expose partial data.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, blob_hash):
+        if not HASH_PATTERN.match(blob_hash):
+            raise ValueError(f'Invalid blob hash: {blob_hash}')
+        return os.path.join(self.root, blob_hash[:2], blob_hash[2:4], blob_hash)
+
+    def exists(self, blob_hash):
+        return os.path.exists(self.path(blob_hash))
+
+    def put(self, data):
+        """Store bytes and return their hash (a no-op if the blob is already present)"""
+        blob_hash = hashlib.sha256(data).hexdigest()
+        target = self.path(blob_hash)
+        if os.path.exists(target):
+            return blob_hash
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return blob_hash
+
+    def media_type(self, blob_hash):
+        with open(self.path(blob_hash), 'rb') as f:
+            return sniff_media_type(f.read(16))
+
+    def iter_hashes(self):
+        """Yield the hash of every stored blob"""
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if HASH_PATTERN.match(name):
+                    yield name
+
+    def delete(self, blob_hash):
+        try:
+            os.remove(self.path(blob_hash))
+            return True
+        except FileNotFoundError:
+            return False
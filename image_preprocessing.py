@@ -0,0 +1,235 @@
+"""
+Image ingestion for the Claude Neural Visual Processing Simulator
+Sniffs the real format, normalizes EXIF orientation, downscales and recompresses
+oversized photos and optionally tiles high-detail scenes before they are uploaded
+"""
+
+import base64
+import hashlib
+import io
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from blob_store import sniff_media_type
+
+try:
+    from PIL import Image, ImageOps  # Optional: without Pillow images are validated and sent unchanged
+except ImportError:
+    Image = ImageOps = None
+
+# Formats the Messages API accepts
+SUPPORTED_MEDIA_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp')
+# The API rejects base64 images over 5 MB; larger images are also scaled down server-side anyway
+API_MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+
+def media_type_of_base64(image_data):
+    """Media type of base64 image data, sniffed from its first bytes (image/jpeg when unknown)"""
+    header = base64.b64decode(image_data[:24] + '=' * (-len(image_data[:24]) % 4), validate=False)
+    media_type = sniff_media_type(header)
+    return media_type if media_type in SUPPORTED_MEDIA_TYPES else 'image/jpeg'
+
+
+class PreparedImage:
+    """Base64 payload(s) of one ingested image plus what the preprocessing did to it
+
+    ``images`` holds the overview image first, then any tiles, as (media type, base64) pairs.
+    """
+
+    def __init__(self, image_hash, images, original_bytes, width=None, height=None, resized=False, tiles=0):
+        self.image_hash = image_hash
+        self.images = images
+        self.original_bytes = original_bytes
+        self.width = width
+        self.height = height
+        self.resized = resized
+        self.tiles = tiles
+
+    @property
+    def image_data(self):
+        """What the simulator passes to ClaudeProvider: one base64 string, or a list with tiles"""
+        payloads = [data for _, data in self.images]
+        return payloads[0] if len(payloads) == 1 else payloads
+
+    @property
+    def upload_bytes(self):
+        return sum(len(data) * 3 // 4 - data[-2:].count('=') for _, data in self.images)
+
+    def summary(self):
+        return {'image_hash': self.image_hash, 'media_type': self.images[0][0], 'original_bytes': self.original_bytes,
+                'upload_bytes': self.upload_bytes, 'width': self.width, 'height': self.height,
+                'resized': self.resized, 'tiles': self.tiles}
+
+    def to_dict(self):
+        return dict(self.summary(), images=[list(image) for image in self.images])
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['image_hash'], [tuple(image) for image in data['images']], data['original_bytes'],
+                   data['width'], data['height'], data['resized'], data['tiles'])
+
+
+class ImagePreprocessor:
+    """Turns image files into API-ready payloads, cached by content hash
+
+    With Pillow installed the image is rotated according to its EXIF orientation,
+    scaled so its long edge is at most ``max_dimension`` pixels (the API downsamples
+    anything larger, so the extra pixels only cost upload time) and re-encoded as
+    JPEG, stepping the quality down from ``quality`` to ``min_quality`` until it
+    fits ``target_bytes``. Images with transparency stay PNG. Already-small images
+    that need no rotation are sent untouched. With ``tile`` set, images larger than
+    ``max_dimension`` are also cut into up to ``max_tiles`` full-resolution tiles
+    sent after the overview, for scenes whose detail would be lost by downscaling.
+
+    Without Pillow, images are only sniffed and checked against the API limits.
+    Results are kept in an LRU of ``cache_entries`` and, with ``cache_dir``, on disk.
+    """
+
+    def __init__(self, max_dimension=1568, target_bytes=1024 * 1024, quality=85, min_quality=50,
+                 tile=False, max_tiles=4, cache_entries=32, cache_dir=None):
+        self.max_dimension = max_dimension
+        self.target_bytes = target_bytes
+        self.quality = quality
+        self.min_quality = min_quality
+        self.tile = tile
+        self.max_tiles = max_tiles
+        self.cache_entries = cache_entries
+        self.cache_dir = cache_dir
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'images': 0, 'cache_hits': 0, 'original_bytes': 0, 'upload_bytes': 0}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _settings_key(self):
+        settings = [self.max_dimension, self.target_bytes, self.quality, self.min_quality, self.tile, self.max_tiles]
+        return hashlib.sha256(json.dumps(settings).encode('utf-8')).hexdigest()[:16]
+
+    def prepare_file(self, path):
+        with open(path, 'rb') as f:
+            return self.prepare(f.read())
+
+    def prepare(self, image_bytes):
+        """Return the PreparedImage for raw image bytes, reusing earlier work on identical images"""
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        key = f'{image_hash}-{self._settings_key()}'
+        prepared = self._cached(key)
+        if prepared is None:
+            prepared = self._process(image_hash, image_bytes)
+            self._store(key, prepared)
+        with self.lock:
+            self.stats['images'] += 1
+            self.stats['original_bytes'] += prepared.original_bytes
+            self.stats['upload_bytes'] += prepared.upload_bytes
+        return prepared
+
+    def _cached(self, key):
+        with self.lock:
+            prepared = self.cache.get(key)
+            if prepared is not None:
+                self.cache.move_to_end(key)
+                self.stats['cache_hits'] += 1
+                return prepared
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, f'{key}.json')
+            try:
+                with open(path, encoding='utf-8') as f:
+                    prepared = PreparedImage.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError):
+                return None
+            with self.lock:
+                self.stats['cache_hits'] += 1
+            self._store(key, prepared, persist=False)
+            return prepared
+        return None
+
+    def _store(self, key, prepared, persist=True):
+        with self.lock:
+            self.cache[key] = prepared
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_entries:
+                self.cache.popitem(last=False)
+        if persist and self.cache_dir:
+            path = os.path.join(self.cache_dir, f'{key}.json')
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(prepared.to_dict(), f)
+            os.replace(path + '.tmp', path)
+
+    def _process(self, image_hash, image_bytes):
+        media_type = sniff_media_type(image_bytes[:16])
+        if Image is None:
+            if media_type not in SUPPORTED_MEDIA_TYPES:
+                raise ValueError(f'Unsupported image format ({media_type}); the API accepts {", ".join(SUPPORTED_MEDIA_TYPES)}')
+            if len(image_bytes) * 4 / 3 > API_MAX_IMAGE_BYTES:
+                raise ValueError(f'Image is {len(image_bytes)} bytes, over the API limit; install Pillow to downscale it')
+            return PreparedImage(image_hash, [(media_type, base64.b64encode(image_bytes).decode('ascii'))], len(image_bytes))
+
+        try:
+            image = Image.open(io.BytesIO(image_bytes))
+            image.load()
+        except (OSError, Image.DecompressionBombError) as e:
+            raise ValueError(f'Unreadable image: {e}')
+        rotated = _exif_orientation(image) not in (None, 1)
+        oriented = ImageOps.exif_transpose(image) if rotated else image
+        width, height = oriented.size
+        oversized = max(width, height) > self.max_dimension
+        if (media_type in SUPPORTED_MEDIA_TYPES and not oversized and not rotated
+                and len(image_bytes) <= self.target_bytes):
+            return PreparedImage(image_hash, [(media_type, base64.b64encode(image_bytes).decode('ascii'))],
+                                 len(image_bytes), width, height)
+
+        images = [self._encode(_fit(oriented, self.max_dimension))]
+        tiles = self._tiles(oriented) if self.tile and oversized else []
+        images.extend(self._encode(tile) for tile in tiles)
+        return PreparedImage(image_hash, images, len(image_bytes), width, height, resized=oversized, tiles=len(tiles))
+
+    def _tiles(self, image):
+        """Full-resolution crops of a grid just fine enough for each cell to fit ``max_dimension``"""
+        width, height = image.size
+        columns = math.ceil(width / self.max_dimension)
+        rows = math.ceil(height / self.max_dimension)
+        while columns * rows > self.max_tiles:
+            # Too many cells: coarsen the grid and let _fit downscale each tile a little
+            if columns >= rows:
+                columns -= 1
+            else:
+                rows -= 1
+        tiles = []
+        for row in range(rows):
+            for column in range(columns):
+                box = (width * column // columns, height * row // rows, width * (column + 1) // columns, height * (row + 1) // rows)
+                tiles.append(_fit(image.crop(box), self.max_dimension))
+        return tiles
+
+    def _encode(self, image):
+        """Encode as PNG when the image has transparency, otherwise as JPEG within ``target_bytes``"""
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            buffer = io.BytesIO()
+            image.save(buffer, 'PNG', optimize=True)
+            return 'image/png', base64.b64encode(buffer.getvalue()).decode('ascii')
+        image = image.convert('RGB')
+        quality = self.quality
+        while True:
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=quality, optimize=True)
+            if buffer.tell() <= self.target_bytes or quality <= self.min_quality:
+                return 'image/jpeg', base64.b64encode(buffer.getvalue()).decode('ascii')
+            quality = max(self.min_quality, quality - 10)
+
+
+def _exif_orientation(image):
+    try:
+        return image.getexif().get(0x0112)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _fit(image, max_dimension):
+    """``image`` scaled down (never up) so its long edge is at most ``max_dimension``"""
+    if max(image.size) <= max_dimension:
+        return image
+    scale = max_dimension / max(image.size)
+    return image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
@@ -0,0 +1,333 @@
+"""
+Metrics and tracing for the Claude Neural Visual Processing Simulator
+Latency histograms and counters with Prometheus text output, plus lightweight
+OpenTelemetry-style spans, shared by the simulator and the proxy server
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Seconds; fine enough at the low end for cached calls and connects, wide enough for slow Opus steps
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style, with interpolated quantiles
+
+    Quantiles are clamped to the observed minimum and maximum, which keeps them
+    honest for series with only a handful of observations.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = position
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate the ``q`` quantile by linear interpolation inside its bucket"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for position, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = max(self.buckets[position - 1] if position > 0 else 0.0, self.min)
+                upper = min(self.buckets[position], self.max) if position < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.50),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in pairs) + '}'
+
+
+class MetricsRegistry:
+    """Thread-safe store of labelled histograms, counters and gauges"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}   # name -> {label key: Histogram}
+        self.counters = {}     # name -> {label key: float}
+        self.gauges = {}       # name -> {label key: float}
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            key = _label_key(labels)
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = _label_key(labels)
+            series[key] = series.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def summary(self, name, group_by=None):
+        """p50/p95/p99 of histogram ``name`` keyed by the ``group_by`` label values
+
+        Series that share those values (e.g. one step run on several models) are merged.
+        """
+        with self.lock:
+            merged = {}
+            for key, histogram in self.histograms.get(name, {}).items():
+                labels = dict(key)
+                parts = [labels.get(label, '') for label in group_by] if group_by else [value for _, value in key]
+                group = ':'.join(parts) or 'all'
+                if group not in merged:
+                    merged[group] = Histogram(histogram.buckets)
+                merged[group].merge(histogram)
+            return {group: histogram.summary() for group, histogram in merged.items()}
+
+    def counter_values(self, name):
+        with self.lock:
+            return {key: value for key, value in self.counters.get(name, {}).items()}
+
+    def render_prometheus(self):
+        """All series in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                self._header(lines, name, 'counter')
+                for key, value in sorted(series.items()):
+                    lines.append(f'{name}{_format_labels(key)} {value}')
+            for name, series in sorted(self.gauges.items()):
+                self._header(lines, name, 'gauge')
+                for key, value in sorted(series.items()):
+                    lines.append(f'{name}{_format_labels(key)} {value}')
+            for name, series in sorted(self.histograms.items()):
+                self._header(lines, name, 'histogram')
+                for key, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_format_labels(key, [("le", bound)])} {cumulative}')
+                    lines.append(f'{name}_sum{_format_labels(key)} {histogram.sum}')
+                    lines.append(f'{name}_count{_format_labels(key)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name, kind):
+        if name in self.help:
+            lines.append(f'# HELP {name} {self.help[name]}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+
+METRICS = MetricsRegistry()
+METRICS.describe('claude_api_request_seconds', 'Claude API request time by model and phase (connect, ttfb, body, total)')
+METRICS.describe('claude_api_requests_total', 'Claude API requests by model and HTTP status ("cached" for cache hits, "error" for transport failures)')
+METRICS.describe('claude_api_tokens_total', 'Tokens reported in the API usage field by model and direction')
+METRICS.describe('simulator_step_seconds', 'Processing time of each pathway step by step and model')
+METRICS.describe('simulator_run_seconds', 'Wall time of whole pathway runs')
+
+
+def record_api_call(model, usage, phases):
+    """Publish one Messages API call's phase timings and ``usage`` tokens; returns (input, output) tokens
+
+    Cache writes and reads count as input tokens, as they are part of the prompt.
+    """
+    usage = usage or {}
+    input_tokens = sum(int(usage.get(name) or 0) for name in ('input_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens'))
+    output_tokens = int(usage.get('output_tokens') or 0)
+    for phase, seconds in phases.items():
+        METRICS.observe('claude_api_request_seconds', seconds, model=model, phase=phase)
+    METRICS.inc('claude_api_tokens_total', input_tokens, model=model, direction='input')
+    METRICS.inc('claude_api_tokens_total', output_tokens, model=model, direction='output')
+    return input_tokens, output_tokens
+
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """One timed operation in a trace, shaped after the OpenTelemetry span data model"""
+
+    def __init__(self, tracer, name, parent=None, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.start_time_unix_nano = time.time_ns()
+        self.end_time_unix_nano = None
+        self.status = {'code': 'UNSET'}
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes):
+        self.attributes.update(attributes)
+
+    def set_error(self, message):
+        self.status = {'code': 'ERROR', 'message': str(message)}
+
+    @property
+    def traceparent(self):
+        """W3C trace context header value identifying this span"""
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def end(self):
+        if self.end_time_unix_nano is None:
+            self.end_time_unix_nano = time.time_ns()
+            self.tracer._export(self)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_span_id': self.parent_span_id,
+            'start_time_unix_nano': self.start_time_unix_nano,
+            'end_time_unix_nano': self.end_time_unix_nano,
+            'attributes': self.attributes,
+            'status': self.status,
+        }
+
+
+class JsonlSpanExporter:
+    """Appends finished spans to a JSON-lines file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, span):
+        line = json.dumps(span.to_dict()) + '\n'
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+class Tracer:
+    """Creates spans and hands finished ones to exporters
+
+    The active span is tracked in a context variable, so spans opened inside it
+    (including in asyncio tasks and in threads started with a copied context)
+    become its children. The most recent finished spans are kept in ``finished``.
+    """
+
+    def __init__(self, keep=2048):
+        self.exporters = []
+        self.finished = deque(maxlen=keep)
+        self.enabled = True
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def _export(self, span):
+        self.finished.append(span)
+        for exporter in self.exporters:
+            exporter(span)
+
+    @staticmethod
+    def current_span():
+        return _current_span.get()
+
+    @contextlib.contextmanager
+    def span(self, name, attributes=None, parent=None, activate=True):
+        """Context manager that opens a child of the current (or given) span and ends it on exit
+
+        Pass ``activate=False`` inside generators: making the span current there would
+        leak it into the consumer's context between yields.
+        """
+        if not self.enabled:
+            yield None
+            return
+        span = Span(self, name, parent or _current_span.get(), attributes)
+        token = _current_span.set(span) if activate else None
+        try:
+            yield span
+        except GeneratorExit:
+            raise  # The consumer stopped early; not an error
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            if token is not None:
+                _current_span.reset(token)
+            span.end()
+
+
+TRACER = Tracer()
+
+
+def parse_traceparent(value):
+    """Return (trace id, parent span id) from a W3C traceparent header, or None if malformed"""
+    parts = (value or '').split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2]
+
+
+def remote_parent(traceparent):
+    """A stand-in parent span for continuing a trace started in another process"""
+    parsed = parse_traceparent(traceparent)
+    if parsed is None:
+        return None
+    parent = Span.__new__(Span)
+    parent.trace_id, parent.span_id = parsed
+    return parent
+
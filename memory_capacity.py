@@ -0,0 +1,370 @@
+"""
+Capacity management for the visual memory bank
+Keeps the store within a memory-count and byte budget by evicting with a pluggable
+policy (LRU, LFU with aging or ARC) and reports hit rates
+"""
+
+import datetime
+import heapq
+import itertools
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def memory_time(memory, default=None):
+    """Unix time of a memory's ``timestamp`` (ISO string or ms epoch), or ``default``"""
+    value = memory.get('timestamp')
+    try:
+        if isinstance(value, (int, float)):
+            return value / 1000.0
+        if isinstance(value, str) and value:
+            return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        pass
+    return time.time() if default is None else default
+
+
+class LRUPolicy:
+    """Evicts the least recently used memory; O(1) per operation"""
+
+    name = 'lru'
+
+    def __init__(self):
+        self.order = OrderedDict()
+
+    def __len__(self):
+        return len(self.order)
+
+    def admit(self, memory_id, used_at, access_count):
+        self.order[memory_id] = None
+        self.order.move_to_end(memory_id)
+
+    def touch(self, memory_id, used_at):
+        self.order.move_to_end(memory_id)
+
+    def remove(self, memory_id):
+        self.order.pop(memory_id, None)
+
+    def pop_victim(self, exclude=None):
+        for memory_id in self.order:
+            if memory_id != exclude:
+                del self.order[memory_id]
+                return memory_id
+        raise KeyError('pop_victim from an empty policy')
+
+    def miss(self, memory_id):
+        pass
+
+
+class LFUPolicy:
+    """Evicts the least frequently used memory, with use counts halving every ``half_life`` seconds
+
+    A memory's priority is ``log2(count) + last_use / half_life``. Decaying every
+    count by the same factor leaves that ordering unchanged, so entries never need
+    rescoring: a use only pushes a new heap entry (O(log n)), and superseded entries
+    are skipped when popped and dropped when the heap is rebuilt.
+    """
+
+    name = 'lfu'
+
+    def __init__(self, half_life=7 * 24 * 3600.0):
+        self.half_life = half_life
+        self.entries = {}  # memory id -> (priority, decayed count, last use)
+        self.heap = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _push(self, memory_id, count, used_at):
+        priority = math.log2(max(count, 1e-9)) + used_at / self.half_life
+        self.entries[memory_id] = (priority, count, used_at)
+        heapq.heappush(self.heap, (priority, next(self._sequence), memory_id))
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [(priority, next(self._sequence), key) for key, (priority, _, _) in self.entries.items()]
+            heapq.heapify(self.heap)
+
+    def admit(self, memory_id, used_at, access_count):
+        self._push(memory_id, max(1, access_count), used_at)
+
+    def touch(self, memory_id, used_at):
+        _, count, last = self.entries[memory_id]
+        decayed = count * 2.0 ** (-max(0.0, used_at - last) / self.half_life)
+        self._push(memory_id, decayed + 1, max(used_at, last))
+
+    def remove(self, memory_id):
+        self.entries.pop(memory_id, None)
+
+    def pop_victim(self, exclude=None):
+        skipped = None
+        try:
+            while self.heap:
+                item = heapq.heappop(self.heap)
+                priority, _, memory_id = item
+                entry = self.entries.get(memory_id)
+                if entry is None or entry[0] != priority:
+                    continue
+                if memory_id == exclude:
+                    skipped = item
+                    continue
+                del self.entries[memory_id]
+                return memory_id
+            raise KeyError('pop_victim from an empty policy')
+        finally:
+            if skipped is not None:
+                heapq.heappush(self.heap, skipped)
+
+    def miss(self, memory_id):
+        pass
+
+
+class ARCPolicy:
+    """Adaptive Replacement Cache: balances recency (T1) and frequency (T2) lists
+
+    Evicted ids are remembered in ghost lists B1/B2. An evicted memory is deleted
+    from the bank, so a ghost is hit either when a client asks for it (``miss``) or
+    when it is uploaded again (``admit``, e.g. a bulk save from a client that still
+    holds it). A ghost from T1 grows T1's target share ``p``, one from T2 shrinks it.
+    ``capacity`` (the count limit, or the resident count when only bytes are
+    limited) bounds the ghost lists. O(1) per operation.
+    """
+
+    name = 'arc'
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.t1, self.t2, self.b1, self.b2 = OrderedDict(), OrderedDict(), OrderedDict(), OrderedDict()
+        self.p = 0.0
+
+    def __len__(self):
+        return len(self.t1) + len(self.t2)
+
+    def _limit(self):
+        return self.capacity or max(1, len(self))
+
+    def _adapt(self, memory_id):
+        """Move ``p`` for a ghost hit on ``memory_id``; returns False if it is not a ghost"""
+        if memory_id in self.b1:
+            self.p = min(self._limit(), self.p + max(len(self.b2) / len(self.b1), 1))
+            del self.b1[memory_id]
+        elif memory_id in self.b2:
+            self.p = max(0.0, self.p - max(len(self.b1) / len(self.b2), 1))
+            del self.b2[memory_id]
+        else:
+            return False
+        return True
+
+    def admit(self, memory_id, used_at, access_count):
+        if self._adapt(memory_id):
+            self.t2[memory_id] = None
+        elif access_count > 1:
+            self.t2[memory_id] = None  # Already used more than once (e.g. when rebuilding)
+        else:
+            self.t1[memory_id] = None
+
+    def touch(self, memory_id, used_at):
+        if memory_id in self.t1:
+            del self.t1[memory_id]
+            self.t2[memory_id] = None
+        else:
+            self.t2.move_to_end(memory_id)
+
+    def remove(self, memory_id):
+        self.t1.pop(memory_id, None)
+        self.t2.pop(memory_id, None)
+
+    def miss(self, memory_id):
+        self._adapt(memory_id)
+
+    @staticmethod
+    def _oldest(entries, exclude):
+        for memory_id in entries:
+            if memory_id != exclude:
+                return memory_id
+        return None
+
+    def pop_victim(self, exclude=None):
+        # The excluded id (the memory just written) is skipped in place, not ghosted
+        t1_victim, t2_victim = self._oldest(self.t1, exclude), self._oldest(self.t2, exclude)
+        if t1_victim is not None and (len(self.t1) > self.p or t2_victim is None):
+            memory_id, resident, ghosts = t1_victim, self.t1, self.b1
+        elif t2_victim is not None:
+            memory_id, resident, ghosts = t2_victim, self.t2, self.b2
+        else:
+            raise KeyError('pop_victim from an empty policy')
+        del resident[memory_id]
+        ghosts[memory_id] = None
+        while len(self.b1) + len(self.b2) > self._limit():
+            (self.b1 if len(self.b1) >= len(self.b2) else self.b2).popitem(last=False)
+        return memory_id
+
+
+POLICIES = {'lru': LRUPolicy, 'lfu': LFUPolicy, 'arc': ARCPolicy}
+
+
+def make_policy(name, max_count=None, half_life=None):
+    if name not in POLICIES:
+        raise ValueError(f"Unknown eviction policy '{name}'. Use one of {sorted(POLICIES)}")
+    if name == 'arc':
+        return ARCPolicy(max_count)
+    if name == 'lfu' and half_life:
+        return LFUPolicy(half_life)
+    return POLICIES[name]()
+
+
+class MemoryCapacityManager:
+    """Store listener that evicts memories once the bank exceeds ``max_count`` or ``max_bytes``
+
+    A memory's size is its stored JSON plus its image blob, counted once however many
+    memories share it (the store deletes a blob once no memory refers to it). A use
+    is a recall hit, a ``GET /memories/<id>`` or an upsert with a higher
+    ``accessCount``; a client that reads a memory and then saves its bumped count is
+    counted once. Requests for evicted ids count as misses.
+    """
+
+    def __init__(self, store, max_count=None, max_bytes=None, policy='lru', half_life=None):
+        self.store = store
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.policy = make_policy(policy, max_count, half_life) if isinstance(policy, str) else policy
+        self.lock = threading.Lock()
+        self.entries = {}        # memory id -> (bytes, image ref, access count)
+        self.blob_refs = {}      # image hash -> number of resident memories using it
+        self.blob_sizes = {}
+        self.evicted = OrderedDict()  # recently evicted ids, to recognize misses
+        self.reads = {}          # memory id -> reads counted since its last accessCount upsert
+        self.total_bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'evicted_bytes': 0}
+
+    def _blob_size(self, image_hash):
+        size = self.blob_sizes.get(image_hash)
+        if size is None:
+            try:
+                size = os.path.getsize(self.store.blob_store.path(image_hash)) if self.store.blob_store else 0
+            except (OSError, ValueError):
+                size = 0
+            self.blob_sizes[image_hash] = size
+        return size
+
+    def _add_blob_ref(self, image_hash):
+        if not image_hash:
+            return 0
+        self.blob_refs[image_hash] = self.blob_refs.get(image_hash, 0) + 1
+        return self._blob_size(image_hash) if self.blob_refs[image_hash] == 1 else 0
+
+    def _drop_blob_ref(self, image_hash):
+        if not image_hash or image_hash not in self.blob_refs:
+            return 0
+        self.blob_refs[image_hash] -= 1
+        if self.blob_refs[image_hash] > 0:
+            return 0
+        del self.blob_refs[image_hash]
+        return self.blob_sizes.pop(image_hash, 0)
+
+    def _track(self, memory):
+        """Account for an upserted memory; returns True if it was already resident"""
+        memory_id = str(memory['id'])
+        size = len(json.dumps(memory, ensure_ascii=False).encode('utf-8'))
+        image_ref = memory.get('imageRef')
+        access_count = int(memory.get('accessCount') or 0)
+        previous = self.entries.get(memory_id)
+        if previous is not None:
+            old_size, old_ref, old_count = previous
+            self.total_bytes += size - old_size
+            if image_ref != old_ref:
+                self.total_bytes += self._add_blob_ref(image_ref) - self._drop_blob_ref(old_ref)
+            self.entries[memory_id] = (size, image_ref, access_count)
+            if access_count > old_count:
+                # Uses already counted by record_access are only being saved by the client
+                counted = self.reads.pop(memory_id, 0)
+                if access_count - old_count > counted:
+                    self.stats['hits'] += 1
+                    self.policy.touch(memory_id, time.time())
+            return True
+        self.entries[memory_id] = (size, image_ref, access_count)
+        self.total_bytes += size + self._add_blob_ref(image_ref)
+        self.evicted.pop(memory_id, None)
+        return False
+
+    def _forget(self, memory_id):
+        self.reads.pop(memory_id, None)
+        size, image_ref, _ = self.entries.pop(memory_id)
+        freed = size + self._drop_blob_ref(image_ref)
+        self.total_bytes -= freed
+        return freed
+
+    def _over_limit(self):
+        return ((self.max_count is not None and len(self.entries) > self.max_count)
+                or (self.max_bytes is not None and self.total_bytes > self.max_bytes))
+
+    def _select_victims(self, protect=None):
+        """Pop victims until the bank fits, never the memory just written"""
+        victims = []
+        while self._over_limit():
+            try:
+                memory_id = self.policy.pop_victim(exclude=protect)
+            except KeyError:
+                break
+            freed = self._forget(memory_id)
+            victims.append(memory_id)
+            self.evicted[memory_id] = None
+            self.stats['evictions'] += 1
+            self.stats['evicted_bytes'] += freed
+        while len(self.evicted) > max(1000, self.max_count or 0):
+            self.evicted.popitem(last=False)
+        return victims
+
+    def _delete(self, victims):
+        for memory_id in victims:
+            self.store.delete(memory_id)
+
+    def rebuild(self, memories):
+        """Load the current bank (oldest first, so recency is right), then evict down to the limits"""
+        ordered = sorted(memories, key=lambda memory: memory_time(memory, 0.0))
+        with self.lock:
+            for memory in ordered:
+                if not self._track(memory):
+                    self.policy.admit(str(memory['id']), memory_time(memory), int(memory.get('accessCount') or 0))
+            victims = self._select_victims()
+        self._delete(victims)
+
+    # Store listener hooks
+
+    def memory_upserted(self, memory):
+        memory_id = str(memory['id'])
+        with self.lock:
+            if not self._track(memory):
+                self.policy.admit(memory_id, time.time(), int(memory.get('accessCount') or 0))
+            victims = self._select_victims(protect=memory_id)
+        self._delete(victims)
+
+    def memory_deleted(self, memory_id):
+        with self.lock:
+            if memory_id in self.entries:  # Not already forgotten as an eviction victim
+                self.policy.remove(memory_id)
+                self._forget(memory_id)
+
+    # Hit accounting
+
+    def record_access(self, memory_id, found=True):
+        """Count a read of ``memory_id``: a hit if it is resident, a miss if it was evicted"""
+        memory_id = str(memory_id)
+        with self.lock:
+            if found and memory_id in self.entries:
+                self.stats['hits'] += 1
+                self.reads[memory_id] = self.reads.get(memory_id, 0) + 1
+                self.policy.touch(memory_id, time.time())
+            elif memory_id in self.evicted:
+                self.stats['misses'] += 1
+                self.policy.miss(memory_id)
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return dict(self.stats, policy=self.policy.name, count=len(self.entries), bytes=self.total_bytes,
+                        max_count=self.max_count, max_bytes=self.max_bytes, blobs=len(self.blob_refs),
+                        hit_rate=self.stats['hits'] / lookups if lookups else None)
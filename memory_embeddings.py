@@ -0,0 +1,394 @@
+"""
+Offline embedding index for visual memory recall
+Hashed TF-IDF vectors in a memory-mapped float32 matrix with an IVF
+(inverted file) approximate nearest-neighbour structure on top
+"""
+
+import json
+import math
+import os
+import re
+import threading
+import uuid
+import zipfile
+import zlib
+from collections import Counter
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def memory_text(memory):
+    """Text used to embed a memory: recognized objects, tags and every step output"""
+    parts = []
+    for recognized in memory.get('recognizedObjects') or []:
+        if isinstance(recognized, dict):
+            parts.append(str(recognized.get('name', '')))
+            parts.extend(str(value) for value in recognized.get('properties') or [])
+        else:
+            parts.append(str(recognized))
+    parts.extend(str(tag) for tag in memory.get('tags') or [])
+    results = memory.get('processingResults') or {}
+    steps = results.values() if isinstance(results, dict) else results
+    for step in steps:
+        if isinstance(step, dict):
+            parts.append(str(step.get('output', '')))
+        else:
+            parts.append(str(step))
+    return ' '.join(parts)
+
+
+def memory_summary(memory, max_chars=240):
+    """Short description of a memory for injecting into prompts"""
+    names = [r.get('name') if isinstance(r, dict) else str(r) for r in memory.get('recognizedObjects') or []]
+    summary = ', '.join(str(name) for name in names if name) or ', '.join(str(tag) for tag in (memory.get('tags') or [])[:8])
+    timestamp = memory.get('timestamp')
+    summary = f'{summary} (seen {timestamp})' if timestamp else summary
+    return summary[:max_chars]
+
+
+class HashingEmbedder:
+    """Stateless signed feature-hashing embedder with sublinear term frequency
+
+    Document vectors are L2-normalized TF vectors; inverse document frequency is
+    applied on the query side from bucket document counts kept by the index, so
+    stored vectors never need re-encoding as the corpus grows.
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def buckets(self, text):
+        """Map text to {bucket: signed weight}"""
+        weights = {}
+        for token, count in Counter(TOKEN_PATTERN.findall(text.lower())).items():
+            if len(token) < 2:
+                continue
+            digest = zlib.crc32(token.encode('utf-8'))
+            bucket = digest % self.dim
+            sign = 1.0 if (digest >> 31) & 1 else -1.0
+            weights[bucket] = weights.get(bucket, 0.0) + sign * (1.0 + math.log(count))
+        return weights
+
+    def embed(self, text, idf=None):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for bucket, weight in self.buckets(text).items():
+            vector[bucket] = weight
+        if idf is not None:
+            vector *= idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+
+class EmbeddingIndex:
+    """Approximate nearest-neighbour index over memory embeddings
+
+    Vectors live in a float32 ``np.memmap`` at ``path`` that grows by doubling;
+    ids, tombstones and the IVF state are saved alongside it by ``save()``. Below
+    ``min_train`` live vectors search is exact; above it a spherical k-means
+    coarse quantizer (about sqrt(n) lists) is trained and queries only score the
+    ``nprobe`` closest lists. Inserts are assigned to their nearest list and
+    deletes are tombstoned, and the quantizer is retrained when the index doubles.
+
+    ``store_version`` is the store version the saved index reflects (see
+    ``MemoryStore.version``); ``autosave()`` saves it a few seconds after updates.
+    """
+
+    def __init__(self, path, dim=256, nprobe=16, min_train=2048):
+        self.path = path
+        self.meta_path = path + '.meta.json'
+        self.state_path = path + '.state.npz'
+        self.embedder = HashingEmbedder(dim)
+        self.dim = dim
+        self.nprobe = nprobe
+        self.min_train = min_train
+        self.lock = threading.RLock()
+        self.autosave_delay = None
+        self.version_source = None
+        self.save_timer = None
+        self._reset()
+
+        loaded = False
+        if os.path.exists(self.meta_path) and os.path.exists(path):
+            try:
+                self._load()
+                loaded = True
+            except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+                # A damaged or half-written index is stale: start empty so the caller rebuilds it
+                self._reset()
+        if not loaded:
+            open(path, 'wb').close()
+
+    def _reset(self):
+        """Empty in-memory state; ``store_version`` None marks the index as stale"""
+        self.vectors = None
+        self.capacity = 0
+        self.row_ids = []
+        self.summaries = []
+        self.id_to_row = {}
+        self.alive = np.zeros(0, dtype=bool)
+        self.doc_freq = np.zeros(self.dim, dtype=np.int64)
+        self.centroids = None
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.lists = []
+        self.list_arrays = {}
+        self.trained_size = 0
+        self.store_version = None
+
+    # Storage
+    def _ensure_capacity(self, rows):
+        if rows <= self.capacity:
+            return
+        capacity = max(rows, 2 * self.capacity, 1024)
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(capacity * self.dim * 4)
+        self.vectors = np.memmap(self.path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        self.alive = np.concatenate([self.alive, np.zeros(capacity - len(self.alive), dtype=bool)])
+        self.assignments = np.concatenate([self.assignments, np.full(capacity - len(self.assignments), -1, dtype=np.int32)])
+        self.capacity = capacity
+
+    def save(self, store_version=None):
+        """Flush vectors and persist ids, tombstones and IVF state next to the matrix
+
+        Pass the store version read *before* saving: later writes then show up as a
+        version mismatch rather than being mistaken for part of the saved index.
+        The state is replaced first and the metadata last, as the commit marker; both
+        carry the same save token, so a save interrupted in between loads as stale.
+        """
+        with self.lock:
+            if self.vectors is not None:
+                self.vectors.flush()
+            token = uuid.uuid4().hex
+            state = {'alive': self.alive, 'doc_freq': self.doc_freq, 'assignments': self.assignments,
+                     'token': np.array(token)}
+            if self.centroids is not None:
+                state['centroids'] = self.centroids
+            tmp_state = self.state_path + '.tmp'
+            with open(tmp_state, 'wb') as f:
+                np.savez(f, **state)
+            os.replace(tmp_state, self.state_path)
+            tmp_meta = self.meta_path + '.tmp'
+            with open(tmp_meta, 'w', encoding='utf-8') as f:
+                json.dump({'dim': self.dim, 'capacity': self.capacity, 'row_ids': self.row_ids,
+                           'summaries': self.summaries, 'trained_size': self.trained_size,
+                           'store_version': store_version, 'token': token}, f)
+            os.replace(tmp_meta, self.meta_path)
+            self.store_version = store_version
+
+    def autosave(self, delay, version_source):
+        """Save ``delay`` seconds after the first update since the last save
+
+        ``version_source`` returns the current store version (e.g. ``store.version``).
+        """
+        self.autosave_delay = delay
+        self.version_source = version_source
+
+    def _schedule_save(self):
+        if self.autosave_delay is None or self.save_timer is not None:
+            return
+        self.save_timer = threading.Timer(self.autosave_delay, self._autosave)
+        self.save_timer.daemon = True
+        self.save_timer.start()
+
+    def _autosave(self):
+        with self.lock:
+            self.save_timer = None
+        self.save(self.version_source())
+
+    def close(self):
+        """Cancel a pending autosave and save now"""
+        with self.lock:
+            if self.save_timer is not None:
+                self.save_timer.cancel()
+                self.save_timer = None
+        self.save(self.version_source() if self.version_source else None)
+
+    def _load(self):
+        """Load a saved index, raising ValueError if its files do not belong together"""
+        with open(self.meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['dim'] != self.dim:
+            raise ValueError(f"Index at {self.path} has dimension {meta['dim']}, expected {self.dim}")
+        with np.load(self.state_path) as state:
+            if 'token' not in state or str(state['token']) != meta.get('token'):
+                raise ValueError(f"Index state at {self.state_path} does not match its metadata")
+            alive = state['alive']
+            doc_freq = state['doc_freq']
+            assignments = state['assignments']
+            centroids = state['centroids'] if 'centroids' in state else None
+        capacity = meta['capacity']
+        if (len(alive) != capacity or len(assignments) != capacity or len(meta['row_ids']) > capacity
+                or len(meta['summaries']) != len(meta['row_ids'])
+                or os.path.getsize(self.path) < capacity * self.dim * 4):
+            raise ValueError(f"Index at {self.path} is inconsistent")
+        self.capacity = capacity
+        self.row_ids = meta['row_ids']
+        self.summaries = meta['summaries']
+        self.trained_size = meta['trained_size']
+        self.store_version = meta.get('store_version')
+        self.alive = alive
+        self.doc_freq = doc_freq
+        self.assignments = assignments
+        self.centroids = centroids
+        if capacity:
+            self.vectors = np.memmap(self.path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        self.id_to_row = {memory_id: row for row, memory_id in enumerate(self.row_ids) if self.alive[row]}
+        self._rebuild_lists()
+
+    # Updates
+    def add(self, memory):
+        """Embed and insert (or replace) one memory"""
+        memory_id = str(memory['id'])
+        vector = self.embedder.embed(memory_text(memory))
+        with self.lock:
+            self.remove(memory_id)
+            if len(self.row_ids) - len(self.id_to_row) > max(self.min_train, len(self.id_to_row)):
+                self._compact()
+            row = len(self.row_ids)
+            self._ensure_capacity(row + 1)
+            self.vectors[row] = vector
+            self.row_ids.append(memory_id)
+            self.summaries.append(memory_summary(memory))
+            self.id_to_row[memory_id] = row
+            self.alive[row] = True
+            self.doc_freq[np.flatnonzero(vector)] += 1
+            if self.centroids is not None:
+                self._assign(np.array([row]))
+            live = len(self.id_to_row)
+            if live >= self.min_train and live >= 2 * self.trained_size:
+                self.train()
+            self._schedule_save()
+
+    def remove(self, memory_id):
+        with self.lock:
+            row = self.id_to_row.pop(str(memory_id), None)
+            if row is not None:
+                self.alive[row] = False
+                self.doc_freq[np.flatnonzero(self.vectors[row])] -= 1
+                self._schedule_save()
+
+    def _compact(self):
+        """Move live vectors to the front of the matrix, dropping removed and superseded rows"""
+        live_rows = np.flatnonzero(self.alive[:len(self.row_ids)])
+        count = len(live_rows)
+        self.vectors[:count] = self.vectors[live_rows]
+        self.assignments[:count] = self.assignments[live_rows]
+        self.assignments[count:] = -1
+        self.alive[:count] = True
+        self.alive[count:] = False
+        self.row_ids = [self.row_ids[row] for row in live_rows]
+        self.summaries = [self.summaries[row] for row in live_rows]
+        self.id_to_row = {memory_id: row for row, memory_id in enumerate(self.row_ids)}
+        self._rebuild_lists()
+
+    def rebuild(self, memories):
+        """Reset the index and insert ``memories``, training the quantizer once at the end"""
+        with self.lock:
+            self.row_ids, self.summaries, self.id_to_row = [], [], {}
+            self.alive[:] = False
+            self.assignments[:] = -1
+            self.doc_freq[:] = 0
+            self.centroids, self.lists, self.list_arrays = None, [], {}
+            self.trained_size = 0
+            min_train, self.min_train = self.min_train, float('inf')
+            try:
+                for memory in memories:
+                    self.add(memory)
+            finally:
+                self.min_train = min_train
+            if len(self.id_to_row) >= self.min_train:
+                self.train()
+
+    # IVF quantizer
+    def train(self, iterations=10, sample_size=50000, seed=0):
+        """Train the coarse quantizer with spherical k-means and reassign every live vector"""
+        with self.lock:
+            live_rows = np.flatnonzero(self.alive[:len(self.row_ids)])
+            if len(live_rows) == 0:
+                return
+            n_lists = max(1, min(4096, int(math.sqrt(len(live_rows)))))
+            rng = np.random.default_rng(seed)
+            sample = live_rows if len(live_rows) <= sample_size else rng.choice(live_rows, sample_size, replace=False)
+            data = np.asarray(self.vectors[np.sort(sample)])
+            centroids = data[rng.choice(len(data), n_lists, replace=False)]
+            for _ in range(iterations):
+                labels = np.argmax(data @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, labels, data)
+                norms = np.linalg.norm(sums, axis=1, keepdims=True)
+                # Keep the previous centroid for lists that received no vectors
+                centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+            self.centroids = centroids.astype(np.float32)
+            self.assignments[:] = -1
+            self.lists = []
+            self._assign(live_rows)
+            self._rebuild_lists()
+            self.trained_size = len(live_rows)
+
+    def _assign(self, rows, batch_size=8192):
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            labels = np.argmax(np.asarray(self.vectors[batch]) @ self.centroids.T, axis=1)
+            self.assignments[batch] = labels
+            if self.lists:
+                for row, label in zip(batch, labels):
+                    self.lists[label].append(int(row))
+                    self.list_arrays.pop(int(label), None)
+
+    def _rebuild_lists(self):
+        self.list_arrays = {}
+        if self.centroids is None:
+            self.lists = []
+            return
+        self.lists = [[] for _ in range(len(self.centroids))]
+        for row in np.flatnonzero(self.alive[:len(self.row_ids)]):
+            self.lists[self.assignments[row]].append(int(row))
+
+    def _list_array(self, list_id):
+        array = self.list_arrays.get(list_id)
+        if array is None:
+            array = np.asarray(self.lists[list_id], dtype=np.int64)
+            self.list_arrays[list_id] = array
+        return array
+
+    # Queries
+    def idf(self):
+        documents = max(1, len(self.id_to_row))
+        return (np.log((documents + 1) / (self.doc_freq + 1)) + 1.0).astype(np.float32)
+
+    def search(self, text, k=5):
+        """Return up to ``k`` dicts with ``id``, ``score`` and ``summary``, most similar first"""
+        with self.lock:
+            if not self.id_to_row or k <= 0:
+                return []
+            query = self.embedder.embed(text, self.idf())
+            count = len(self.row_ids)
+            if self.centroids is None:
+                candidates = np.flatnonzero(self.alive[:count])
+            else:
+                probe = np.argsort(-(self.centroids @ query))[:self.nprobe]
+                candidates = np.concatenate([self._list_array(int(list_id)) for list_id in probe])
+                candidates = candidates[self.alive[candidates]]
+            if len(candidates) == 0:
+                return []
+            scores = np.asarray(self.vectors[candidates]) @ query
+            if len(scores) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                candidates, scores = candidates[top], scores[top]
+            order = np.argsort(-scores)
+            return [{'id': self.row_ids[row], 'score': float(score), 'summary': self.summaries[row]}
+                    for row, score in zip(candidates[order], scores[order])]
+
+    def __len__(self):
+        return len(self.id_to_row)
+
+    # MemoryStore listener interface
+    def memory_upserted(self, memory):
+        self.add(memory)
+
+    def memory_deleted(self, memory_id):
+        self.remove(memory_id)
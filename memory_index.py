@@ -0,0 +1,147 @@
+"""
+Inverted tag index for visual memory recall
+Scores candidate memories with vectorized NumPy operations instead of a linear scan
+"""
+
+import threading
+
+import numpy as np
+
+
+def memory_tags(memory):
+    """Normalized set of tags for a memory: its tags plus recognized object names"""
+    tags = set()
+    for tag in memory.get('tags') or []:
+        if isinstance(tag, str) and tag.strip():
+            tags.add(tag.strip().lower())
+    for recognized in memory.get('recognizedObjects') or []:
+        name = recognized.get('name') if isinstance(recognized, dict) else recognized
+        if isinstance(name, str) and name.strip():
+            tags.add(name.strip().lower())
+    return tags
+
+
+class TagIndex:
+    """Inverted tag -> memory index with Jaccard and overlap scoring
+
+    Only memories sharing at least one tag with the query are touched. Their
+    intersection sizes come from one ``np.unique`` over the concatenated posting
+    lists, and the scores, threshold and top-k selection are all array operations.
+    """
+
+    METRICS = ('jaccard', 'overlap')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.row_ids = []          # row -> memory id
+        self.row_tags = []         # row -> tags, kept so removed rows can be compacted away
+        self.id_to_row = {}        # memory id -> row
+        self.tag_counts = np.zeros(0, dtype=np.int32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.postings = {}         # tag -> list of rows
+        self.posting_arrays = {}   # tag -> cached np.ndarray of rows
+
+    def __len__(self):
+        return len(self.id_to_row)
+
+    def _grow(self, size):
+        if size <= len(self.alive):
+            return
+        capacity = max(size, 2 * len(self.alive), 1024)
+        self.tag_counts = np.concatenate([self.tag_counts, np.zeros(capacity - len(self.tag_counts), dtype=np.int32)])
+        self.alive = np.concatenate([self.alive, np.zeros(capacity - len(self.alive), dtype=bool)])
+
+    def add(self, memory):
+        """Index (or re-index) one memory"""
+        memory_id = str(memory['id'])
+        tags = memory_tags(memory)
+        with self.lock:
+            self.remove(memory_id)
+            if len(self.row_ids) - len(self.id_to_row) > max(1024, len(self.id_to_row)):
+                self._compact()
+            row = len(self.row_ids)
+            self.row_ids.append(memory_id)
+            self.row_tags.append(tags)
+            self.id_to_row[memory_id] = row
+            self._grow(row + 1)
+            self.tag_counts[row] = len(tags)
+            self.alive[row] = True
+            for tag in tags:
+                self.postings.setdefault(tag, []).append(row)
+                self.posting_arrays.pop(tag, None)
+
+    def remove(self, memory_id):
+        """Drop a memory; its stale posting entries are masked out at query time"""
+        with self.lock:
+            row = self.id_to_row.pop(str(memory_id), None)
+            if row is not None:
+                self.alive[row] = False
+
+    def rebuild(self, memories):
+        """Replace the index contents with ``memories``"""
+        with self.lock:
+            self.id_to_row = {}
+            self._compact()
+            for memory in memories:
+                self.add(memory)
+
+    def _compact(self):
+        """Renumber live rows so removed and superseded rows stop costing memory and query time"""
+        live = [(self.row_ids[row], self.row_tags[row]) for row in sorted(self.id_to_row.values())]
+        self.row_ids, self.row_tags, self.id_to_row = [], [], {}
+        self.tag_counts = np.zeros(0, dtype=np.int32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.postings, self.posting_arrays = {}, {}
+        self._grow(len(live))
+        for row, (memory_id, tags) in enumerate(live):
+            self.row_ids.append(memory_id)
+            self.row_tags.append(tags)
+            self.id_to_row[memory_id] = row
+            self.tag_counts[row] = len(tags)
+            self.alive[row] = True
+            for tag in tags:
+                self.postings.setdefault(tag, []).append(row)
+
+    def _posting_array(self, tag):
+        array = self.posting_arrays.get(tag)
+        if array is None:
+            array = np.asarray(self.postings[tag], dtype=np.int64)
+            self.posting_arrays[tag] = array
+        return array
+
+    def query(self, tags, k=5, threshold=0.0, metric='jaccard'):
+        """Return up to ``k`` (memory id, score) pairs scoring at least ``threshold``, best first"""
+        if metric not in self.METRICS:
+            raise ValueError(f"Unsupported metric '{metric}'. Use one of {self.METRICS}")
+        query_tags = memory_tags({'tags': list(tags)})
+        with self.lock:
+            arrays = [self._posting_array(tag) for tag in query_tags if tag in self.postings]
+            if not arrays or k <= 0:
+                return []
+            candidates, intersections = np.unique(np.concatenate(arrays), return_counts=True)
+            live = self.alive[candidates]
+            candidates, intersections = candidates[live], intersections[live]
+            sizes = self.tag_counts[candidates]
+            row_ids = self.row_ids
+
+        query_size = len(query_tags)
+        if metric == 'jaccard':
+            scores = intersections / (query_size + sizes - intersections)
+        else:
+            # Same normalization as the web client: common tags / larger tag set
+            scores = intersections / np.maximum(query_size, sizes)
+
+        keep = scores >= threshold
+        candidates, scores = candidates[keep], scores[keep]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return [(row_ids[row], float(score)) for row, score in zip(candidates[order], scores[order])]
+
+    # MemoryStore listener interface
+    def memory_upserted(self, memory):
+        self.add(memory)
+
+    def memory_deleted(self, memory_id):
+        self.remove(memory_id)
@@ -0,0 +1,365 @@
+"""
+Indexed visual memory store for the Claude Neural Visual Processing Simulator
+Memories live in SQLite so saves touch only the rows that changed
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from blob_store import decode_image_data
+
+
+class MemoryStore:
+    """SQLite-backed store of visual memories with per-memory writes and paginated reads
+
+    Each memory is kept as its original JSON document plus a few indexed columns
+    (timestamp, access count, confidence), so inserting or updating one memory costs
+    the same whether the bank holds ten entries or tens of thousands.
+    """
+
+    def __init__(self, db_path, blob_store=None):
+        self.db_path = db_path
+        self.blob_store = blob_store
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.unsettled = 0  # Committed writes whose listeners have not been notified yet
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS memories (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                timestamp TEXT,
+                access_count INTEGER NOT NULL DEFAULT 0,
+                confidence REAL NOT NULL DEFAULT 0,
+                size INTEGER NOT NULL DEFAULT 0,
+                hash TEXT,
+                image_ref TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS memories_timestamp ON memories (timestamp);
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        ''')
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(memories)')}
+        if 'hash' not in columns:
+            # Stores created before content hashes; rows without one are rewritten on their next bulk save
+            self.conn.execute('ALTER TABLE memories ADD COLUMN hash TEXT')
+        if 'image_ref' not in columns:
+            self.conn.execute('ALTER TABLE memories ADD COLUMN image_ref TEXT')
+            self.conn.execute("""UPDATE memories SET image_ref = json_extract(data, '$.imageRef')
+                                 WHERE data LIKE '%"imageRef"%'""")
+        self.conn.execute('CREATE INDEX IF NOT EXISTS memories_image_ref ON memories (image_ref)')
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('store_id', ?)", (uuid.uuid4().hex,))
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', '0')")
+        self.conn.commit()
+
+    def add_listener(self, listener):
+        """Register an object with ``memory_upserted(memory)`` and ``memory_deleted(memory_id)`` hooks
+
+        Used to keep derived structures such as recall indexes in step with the store.
+        """
+        self.listeners.append(listener)
+
+    def _bump_generation(self):
+        """Record a change to the memories (call with the lock held, before committing)
+
+        The write counts as unsettled until ``_settle`` runs after its listeners were notified.
+        """
+        self.conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'generation'")
+        self.unsettled += 1
+
+    def _settle(self):
+        with self.lock:
+            self.unsettled -= 1
+
+    def version(self):
+        """An id for the current contents (store id plus write generation) for derived indexes to save
+
+        Returns None while a committed write has not reached the listeners yet, since an
+        index saved at that moment may not reflect it.
+        """
+        with self.lock:
+            if self.unsettled:
+                return None
+            meta = dict(self.conn.execute("SELECT key, value FROM meta WHERE key IN ('store_id', 'generation')"))
+        return f"{meta['store_id']}:{meta['generation']}"
+
+    def _notify_upserted(self, memory):
+        for listener in self.listeners:
+            listener.memory_upserted(memory)
+
+    def _notify_deleted(self, memory_id):
+        for listener in self.listeners:
+            listener.memory_deleted(memory_id)
+
+    @staticmethod
+    def new_memory_id():
+        """Generate an id in the same style as the web client (ms timestamp + fraction)"""
+        return f'{time.time() * 1000:.4f}'
+
+    def _prepare(self, memory):
+        """Copy a memory, assign an id if missing and move inline image data into the blob store
+
+        The memory keeps only ``imageRef`` (the image hash) and ``imageUrl``; payloads that
+        aren't valid base64 (e.g. the web client's truncated previews) are left as they are.
+        A memory that already has an ``imageRef`` is not decoded and hashed again.
+        Called with the lock held, so blob writes never race ``_release_images``.
+        """
+        memory = dict(memory)
+        memory.setdefault('id', self.new_memory_id())
+        if memory.get('imageRef'):
+            memory.pop('imageData', None)
+        elif self.blob_store is not None and memory.get('imageData'):
+            image_bytes = decode_image_data(memory['imageData'])
+            if image_bytes is not None:
+                image_hash = self.blob_store.put(image_bytes)
+                del memory['imageData']
+                memory['imageRef'] = image_hash
+                memory['imageUrl'] = f'/memory-image/{image_hash}'
+        return memory
+
+    @staticmethod
+    def _content_hash(data):
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def _row_values(self, memory, data=None):
+        data = data if data is not None else json.dumps(memory, ensure_ascii=False)
+        return (
+            str(memory['id']),
+            memory.get('timestamp'),
+            int(memory.get('accessCount') or 0),
+            float(memory.get('confidence') or 0),
+            len(data.encode('utf-8')),
+            self._content_hash(data),
+            memory.get('imageRef'),
+            data
+        )
+
+    def _upsert(self, memory, data=None):
+        self.conn.execute('''
+            INSERT INTO memories (id, timestamp, access_count, confidence, size, hash, image_ref, data)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                timestamp = excluded.timestamp,
+                access_count = excluded.access_count,
+                confidence = excluded.confidence,
+                size = excluded.size,
+                hash = excluded.hash,
+                image_ref = excluded.image_ref,
+                data = excluded.data
+        ''', self._row_values(memory, data))
+
+    def _image_ref(self, memory_id):
+        row = self.conn.execute('SELECT image_ref FROM memories WHERE id = ?', (memory_id,)).fetchone()
+        return row[0] if row else None
+
+    def _release_images(self, image_refs):
+        """Delete the blobs of ``image_refs`` that no memory refers to any more (call with the lock held)
+
+        Blobs are only written under the same lock (see ``_prepare``), so an upload of
+        the same image cannot slip in between the check and the delete.
+        """
+        if self.blob_store is None:
+            return
+        for image_ref in set(image_refs) - {None}:
+            if self.conn.execute('SELECT 1 FROM memories WHERE image_ref = ? LIMIT 1', (image_ref,)).fetchone() is None:
+                self.blob_store.delete(image_ref)
+
+    def upsert(self, memory):
+        """Insert or update one memory, assigning an id if it has none; returns the id"""
+        with self.lock:
+            memory = self._prepare(memory)
+            previous_ref = self._image_ref(str(memory['id']))
+            self._upsert(memory)
+            if previous_ref != memory.get('imageRef'):
+                self._release_images([previous_ref])
+            self._bump_generation()
+            self.conn.commit()
+        try:
+            self._notify_upserted(memory)
+        finally:
+            self._settle()
+        return str(memory['id'])
+
+    def get(self, memory_id):
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM memories WHERE id = ?', (str(memory_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete(self, memory_id):
+        """Delete one memory; returns False if it did not exist"""
+        with self.lock:
+            image_ref = self._image_ref(str(memory_id))
+            cursor = self.conn.execute('DELETE FROM memories WHERE id = ?', (str(memory_id),))
+            if cursor.rowcount == 0:
+                return False
+            self._release_images([image_ref])
+            self._bump_generation()
+            self.conn.commit()
+        try:
+            self._notify_deleted(str(memory_id))
+        finally:
+            self._settle()
+        return True
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM memories').fetchone()[0]
+
+    def list(self, offset=0, limit=50):
+        """Return (memories, total) for one page, in insertion order"""
+        with self.lock:
+            rows = self.conn.execute('SELECT data FROM memories ORDER BY seq LIMIT ? OFFSET ?', (limit, offset)).fetchall()
+            total = self.conn.execute('SELECT COUNT(*) FROM memories').fetchone()[0]
+        return [json.loads(row[0]) for row in rows], total
+
+    def iter_memories(self, batch_size=1000):
+        """Yield every memory in insertion order without loading the whole bank at once"""
+        last_seq = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute('SELECT seq, data FROM memories WHERE seq > ? ORDER BY seq LIMIT ?',
+                                         (last_seq, batch_size)).fetchall()
+            if not rows:
+                return
+            for seq, data in rows:
+                yield json.loads(data)
+            last_seq = rows[-1][0]
+
+    def replace_all(self, memories):
+        """Make the store hold exactly ``memories`` (used by the legacy bulk save endpoint)
+
+        Incoming memories are compared with each row's stored content hash, so only
+        ids and hashes are read from the bank and unchanged rows are left alone.
+        """
+        changed = []
+        released = []
+        with self.lock:
+            existing = {memory_id: (content_hash, image_ref) for memory_id, content_hash, image_ref
+                        in self.conn.execute('SELECT id, hash, image_ref FROM memories')}
+            keep = set()
+            for memory in memories:
+                memory = self._prepare(memory)
+                memory_id = str(memory['id'])
+                keep.add(memory_id)
+                data = json.dumps(memory, ensure_ascii=False)
+                content_hash, image_ref = existing.get(memory_id, (None, None))
+                if content_hash != self._content_hash(data):
+                    self._upsert(memory, data)
+                    changed.append(memory)
+                    released.append(image_ref)
+            stale = [memory_id for memory_id in existing if memory_id not in keep]
+            self.conn.executemany('DELETE FROM memories WHERE id = ?', [(memory_id,) for memory_id in stale])
+            self._release_images(released + [existing[memory_id][1] for memory_id in stale])
+            if not changed and not stale:
+                return
+            self._bump_generation()
+            self.conn.commit()
+        try:
+            # Deletions first, so a capacity manager sees the room they free before the
+            # new memories arrive instead of evicting new ones to make space
+            for memory_id in stale:
+                self._notify_deleted(memory_id)
+            for memory in changed:
+                self._notify_upserted(memory)
+        finally:
+            self._settle()
+
+    def get_settings(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT key, value FROM settings').fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def set_settings(self, settings):
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+                                  [(key, json.dumps(value)) for key, value in settings.items()])
+            self.conn.commit()
+
+    def export_all(self):
+        """Return every memory in the legacy visual_memories.json layout"""
+        with self.lock:
+            rows = self.conn.execute('SELECT data FROM memories ORDER BY seq').fetchall()
+        return {
+            'version': '1.0',
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'memories': [json.loads(row[0]) for row in rows],
+            'settings': self.get_settings()
+        }
+
+    def migrate_from_json(self, json_path):
+        """Import a legacy visual_memories.json file once; returns the number of memories imported"""
+        source = os.path.basename(json_path)
+        with self.lock:
+            already = self.conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from' AND value = ?", (source,)).fetchone()
+        if already or not os.path.exists(json_path):
+            return 0
+        with open(json_path, 'r', encoding='utf-8') as f:
+            memory_data = json.load(f)
+        with self.lock:
+            memories = [self._prepare(memory) for memory in memory_data.get('memories', [])]
+            for memory in memories:
+                self._upsert(memory)
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from', ?)", (source,))
+            self._bump_generation()
+            self.conn.commit()
+        try:
+            for memory in memories:
+                self._notify_upserted(memory)
+        finally:
+            self._settle()
+        if memory_data.get('settings'):
+            self.set_settings(memory_data['settings'])
+        return len(memories)
+
+    def externalize_images(self):
+        """Move inline image data of already-stored memories into the blob store; returns the count"""
+        if self.blob_store is None:
+            return 0
+        with self.lock:
+            rows = self.conn.execute("SELECT data FROM memories WHERE data LIKE '%\"imageData\"%'").fetchall()
+        moved = 0
+        for (data,) in rows:
+            memory = json.loads(data)
+            with self.lock:
+                prepared = self._prepare(memory)
+                if 'imageRef' not in prepared or 'imageData' not in memory:
+                    continue
+                self._upsert(prepared)
+                self._bump_generation()
+                self.conn.commit()
+            try:
+                self._notify_upserted(prepared)
+            finally:
+                self._settle()
+            moved += 1
+        return moved
+
+    def collect_orphan_images(self):
+        """Delete blobs no memory refers to (e.g. left behind before deletes released them); returns the count"""
+        if self.blob_store is None:
+            return 0
+        removed = 0
+        with self.lock:
+            referenced = {row[0] for row in self.conn.execute('SELECT DISTINCT image_ref FROM memories WHERE image_ref IS NOT NULL')}
+            for image_hash in self.blob_store.iter_hashes():
+                if image_hash not in referenced and self.blob_store.delete(image_hash):
+                    removed += 1
+        return removed
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
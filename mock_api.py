@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Deterministic offline stand-in for the Claude Messages API
+A configurable latency, failure and output-size model shared by script.MockProvider
+and a local HTTP server speaking the Messages and Message Batches endpoints
+"""
+
+import argparse
+import hashlib
+import http.server
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+FILLER_WORDS = ('signal', 'neurons', 'receptive', 'field', 'contrast', 'edge', 'orientation', 'luminance',
+                'colour', 'opponent', 'motion', 'depth', 'feature', 'binding', 'cortex', 'layer', 'spike',
+                'rate', 'inhibition', 'excitation', 'pathway', 'response', 'pattern', 'activation')
+
+ERROR_TYPES = {429: 'rate_limit_error', 500: 'api_error', 529: 'overloaded_error'}
+
+
+def request_text(request_body):
+    """The text of the last user message in a Messages API request body"""
+    messages = request_body.get('messages') or [{}]
+    content = messages[-1].get('content', '')
+    if isinstance(content, list):
+        content = ' '.join(block.get('text', '') for block in content if isinstance(block, dict) and block.get('type') == 'text')
+    return str(content)
+
+
+class MockBehavior:
+    """Latency, failure and output-size model of the mock API
+
+    Every decision comes from a random generator seeded with the request (model,
+    system prompt and messages), ``seed`` and the number of times that request has
+    been seen, so runs are reproducible whatever the concurrency and a retried
+    request can succeed where its first attempt failed.
+
+    ``latency`` is the mean in seconds, drawn from ``distribution`` ('fixed',
+    'uniform' within +/- ``spread``, 'exponential' or 'lognormal' with sigma
+    ``spread``). ``rate_limit_rate`` and ``error_rate`` are the fractions of
+    requests answered with 429 and with ``error_status``. Responses are
+    ``output_tokens`` long (at ~4 characters per token), capped at the request's
+    ``max_tokens``.
+    """
+
+    DISTRIBUTIONS = ('fixed', 'uniform', 'exponential', 'lognormal')
+
+    def __init__(self, latency=0.0, distribution='fixed', spread=0.5, error_rate=0.0, error_status=500,
+                 rate_limit_rate=0.0, retry_after=0.0, output_tokens=200, seed=0):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError(f"Unsupported latency distribution '{distribution}'. Use one of {self.DISTRIBUTIONS}")
+        if not 0.0 <= error_rate + rate_limit_rate <= 1.0:
+            raise ValueError('error_rate and rate_limit_rate must add up to a fraction between 0 and 1')
+        self.latency = latency
+        self.distribution = distribution
+        self.spread = spread
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.output_tokens = output_tokens
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.attempts = {}
+
+    def _rng(self, key):
+        with self.lock:
+            attempt = self.attempts.get(key, 0)
+            self.attempts[key] = attempt + 1
+        digest = hashlib.sha256(f'{self.seed}:{attempt}:{key}'.encode('utf-8')).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    def sample_latency(self, rng):
+        if self.latency <= 0:
+            return 0.0
+        if self.distribution == 'uniform':
+            return rng.uniform(self.latency * (1 - self.spread), self.latency * (1 + self.spread))
+        if self.distribution == 'exponential':
+            return rng.expovariate(1.0 / self.latency)
+        if self.distribution == 'lognormal':
+            # mu chosen so the distribution's mean is ``latency``
+            return rng.lognormvariate(math.log(self.latency) - self.spread ** 2 / 2, self.spread)
+        return self.latency
+
+    def response_text(self, request_body, rng):
+        model = request_body.get('model', '')
+        tokens = min(self.output_tokens, int(request_body.get('max_tokens') or self.output_tokens))
+        text = f'[Mock {model}] Simulated neural response based on prompt: {request_text(request_body)[:50]}...'
+        words = [text]
+        length = len(text)
+        while length < tokens * 4:
+            word = rng.choice(FILLER_WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return ' '.join(words)
+
+    def plan(self, request_body):
+        """Decide the outcome of one request: {'status', 'latency', 'text', 'usage'} (text None on errors)"""
+        key = json.dumps([request_body.get('model'), request_body.get('system'), request_body.get('messages')], sort_keys=True)
+        rng = self._rng(key)
+        latency = self.sample_latency(rng)
+        roll = rng.random()
+        if roll < self.rate_limit_rate:
+            status = 429
+        elif roll < self.rate_limit_rate + self.error_rate:
+            status = self.error_status
+        else:
+            status = 200
+        text = self.response_text(request_body, rng) if status == 200 else None
+        usage = {
+            'input_tokens': len(json.dumps(request_body.get('messages', []))) // 4 + len(str(request_body.get('system', ''))) // 4,
+            'output_tokens': len(text) // 4 if text else 0,
+        }
+        return {'status': status, 'latency': latency, 'text': text, 'usage': usage}
+
+
+_message_ids = itertools.count(1)
+
+
+def message_body(request_body, outcome):
+    """A Messages API response body for a successful outcome"""
+    return {
+        'id': f'msg_mock_{next(_message_ids):08d}',
+        'type': 'message',
+        'role': 'assistant',
+        'model': request_body.get('model'),
+        'content': [{'type': 'text', 'text': outcome['text']}],
+        'stop_reason': 'end_turn',
+        'usage': outcome['usage'],
+    }
+
+
+def error_body(status):
+    error_type = ERROR_TYPES.get(status, 'api_error')
+    return {'type': 'error', 'error': {'type': error_type, 'message': f'Injected {error_type} ({status})'}}
+
+
+class MockBatches:
+    """In-memory Message Batches: results are decided at creation and released ``batch_seconds`` later"""
+
+    def __init__(self, behavior, batch_seconds=0.0, results_url=None):
+        self.behavior = behavior
+        self.batch_seconds = batch_seconds
+        self.results_url = results_url or (lambda batch_id: f'mock://batches/{batch_id}/results')
+        self.lock = threading.Lock()
+        self.batches = {}
+
+    def create(self, requests):
+        results = []
+        for entry in requests:
+            params = entry.get('params') or {}
+            outcome = self.behavior.plan(params)
+            if outcome['status'] == 200:
+                result = {'type': 'succeeded', 'message': message_body(params, outcome)}
+            else:
+                result = {'type': 'errored', 'error': error_body(outcome['status'])}
+            results.append({'custom_id': entry.get('custom_id'), 'result': result})
+        now = time.time()
+        batch = {'id': f'msgbatch_mock_{next(_message_ids):08d}', 'created_at': now,
+                 'ends_at': now + self.batch_seconds, 'results': results}
+        with self.lock:
+            self.batches[batch['id']] = batch
+        return batch
+
+    def get(self, batch_id):
+        with self.lock:
+            return self.batches.get(batch_id)
+
+    @staticmethod
+    def ended(batch):
+        return time.time() >= batch['ends_at']
+
+    def status(self, batch):
+        """The batch as the Messages API reports it (``processing_status``, ``request_counts``, ``results_url``)"""
+        ended = self.ended(batch)
+        succeeded = sum(1 for entry in batch['results'] if entry['result']['type'] == 'succeeded')
+        counts = {'processing': 0 if ended else len(batch['results']),
+                  'succeeded': succeeded if ended else 0,
+                  'errored': len(batch['results']) - succeeded if ended else 0,
+                  'canceled': 0, 'expired': 0}
+        return {'id': batch['id'], 'type': 'message_batch', 'processing_status': 'ended' if ended else 'in_progress',
+                'request_counts': counts, 'results_url': self.results_url(batch['id']) if ended else None}
+
+
+class MockAPIHandler(http.server.BaseHTTPRequestHandler):
+    """POST .../messages (JSON or SSE), POST .../messages/batches, GET .../batches/<id>[/results]"""
+
+    protocol_version = 'HTTP/1.1'
+    BATCH_PATH = re.compile(r'/messages/batches/([\w-]+)(/results)?$')
+
+    def log_message(self, format, *args):
+        pass  # Benchmarks shouldn't pay for an access log
+
+    def read_json_body(self):
+        return json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path.endswith('/messages/batches'):
+            self.handle_create_batch(self.read_json_body())
+        elif path.endswith('/messages') or path.endswith('/claude-proxy'):
+            self.handle_messages(self.read_json_body())
+        else:
+            self.send_json(404, {'type': 'error', 'error': {'type': 'not_found_error', 'message': path}})
+
+    def do_GET(self):
+        match = self.BATCH_PATH.search(urllib.parse.urlsplit(self.path).path)
+        batch = self.server.batches.get(match.group(1)) if match else None
+        if batch is None:
+            self.send_json(404, {'type': 'error', 'error': {'type': 'not_found_error', 'message': self.path}})
+        elif match.group(2):
+            self.handle_batch_results(batch)
+        else:
+            self.send_json(200, self.server.batches.status(batch))
+
+    def handle_messages(self, request_body):
+        behavior = self.server.behavior
+        outcome = behavior.plan(request_body)
+        if outcome['status'] != 200:
+            time.sleep(outcome['latency'])
+            self.send_json(outcome['status'], error_body(outcome['status']), {'Retry-After': str(behavior.retry_after)})
+            return
+        if not request_body.get('stream'):
+            time.sleep(outcome['latency'])
+            self.send_json(200, message_body(request_body, outcome))
+            return
+
+        # Stream: a third of the latency before the first event, the rest spread over the deltas
+        time.sleep(outcome['latency'] / 3)
+        message = message_body(request_body, outcome)
+        text = message.pop('content')[0]['text']
+        chunks = [text[i:i + 32] for i in range(0, len(text), 32)] or ['']
+        pause = outcome['latency'] * 2 / 3 / len(chunks)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        message_start = dict(message, content=[], usage={'input_tokens': outcome['usage']['input_tokens'], 'output_tokens': 1})
+        self.send_event('message_start', {'type': 'message_start', 'message': message_start})
+        self.send_event('content_block_start', {'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+        for chunk in chunks:
+            if pause:
+                time.sleep(pause)
+            self.send_event('content_block_delta', {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': chunk}})
+        self.send_event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+        self.send_event('message_delta', {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'},
+                                          'usage': {'output_tokens': outcome['usage']['output_tokens']}})
+        self.send_event('message_stop', {'type': 'message_stop'})
+
+    def send_event(self, event_type, data):
+        self.wfile.write(f'event: {event_type}\ndata: {json.dumps(data)}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    def handle_create_batch(self, body):
+        requests = body.get('requests') or []
+        if not requests:
+            self.send_json(400, {'type': 'error', 'error': {'type': 'invalid_request_error', 'message': 'requests must not be empty'}})
+            return
+        batches = self.server.batches
+        self.send_json(200, batches.status(batches.create(requests)))
+
+    def handle_batch_results(self, batch):
+        if not MockBatches.ended(batch):
+            self.send_json(409, {'type': 'error', 'error': {'type': 'invalid_request_error', 'message': 'Batch has not ended'}})
+            return
+        body = ''.join(json.dumps(entry) + '\n' for entry in batch['results']).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-jsonl')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockAPIServer(http.server.ThreadingHTTPServer):
+    """Local Messages API stand-in; ``url`` is the value to use as a provider's ``base_url``
+
+    Batches end ``batch_seconds`` after they are created; their results are decided
+    up front by the same MockBehavior as interactive requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, behavior=None, host='127.0.0.1', port=0, batch_seconds=0.0):
+        super().__init__((host, port), MockAPIHandler)
+        self.behavior = behavior or MockBehavior()
+        self.batches = MockBatches(self.behavior, batch_seconds, lambda batch_id: f'{self.url}/batches/{batch_id}/results')
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1/messages'
+
+    def start(self):
+        """Serve from a background thread; returns self"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the Claude Messages API')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean response latency in seconds')
+    parser.add_argument('--distribution', choices=MockBehavior.DISTRIBUTIONS, default='lognormal')
+    parser.add_argument('--spread', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with --error-status')
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of requests answered with 429')
+    parser.add_argument('--output-tokens', type=int, default=200)
+    parser.add_argument('--batch-seconds', type=float, default=2.0, help='time until a message batch ends')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    behavior = MockBehavior(args.latency, args.distribution, args.spread, args.error_rate, args.error_status,
+                            args.rate_limit_rate, output_tokens=args.output_tokens, seed=args.seed)
+    server = MockAPIServer(behavior, port=args.port, batch_seconds=args.batch_seconds)
+    print(f'Mock Messages API at {server.url} (point CLAUDE_API_URL or ClaudeProvider.base_url here)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
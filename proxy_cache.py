@@ -0,0 +1,127 @@
+"""
+Response cache for the /claude-proxy endpoint
+Serves repeated identical Messages API requests from memory and coalesces identical
+requests that are in flight at the same time into a single upstream call
+"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+_ERROR_EVENT = re.compile(rb'^event:\s*error\s*$', re.MULTILINE)
+_STOP_EVENT = re.compile(rb'^event:\s*message_stop\s*$', re.MULTILINE)
+
+
+class CachedResponse:
+    """A complete upstream response: status, content type and body bytes (JSON or a recorded event stream)"""
+
+    __slots__ = ('status', 'content_type', 'body')
+
+    def __init__(self, status, content_type, body):
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+
+    def shareable(self):
+        """True for a success that any client may be given: a 200, and for streams one that
+        ran to ``message_stop`` without an ``error`` event (e.g. overloaded mid-stream)"""
+        if self.status != 200:
+            return False
+        if self.content_type == 'text/event-stream':
+            return _ERROR_EVENT.search(self.body) is None and _STOP_EVENT.search(self.body) is not None
+        return True
+
+
+class Flight:
+    """An upstream call in progress that identical requests can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+
+    def wait(self, timeout=None):
+        """The leader's response, or None if it failed or did not finish within ``timeout``"""
+        self.done.wait(timeout)
+        return self.response
+
+
+class ProxyResponseCache:
+    """LRU cache of upstream responses with a TTL, plus single-flight coalescing
+
+    Keys are a SHA-256 of the canonical request body without the API key, so every
+    client sending the same model, prompt, image and settings shares one entry. Only
+    successful responses (see ``CachedResponse.shareable``) are cached, up to
+    ``max_body_bytes``, or handed to the requests waiting on an in-flight call. On
+    any other outcome (a 401, 403 or 429 for the leader's key, say) the waiters get
+    None and send the request with their own key.
+
+    ``begin(key)`` returns ``('hit', CachedResponse)``, ``('coalesced', Flight)`` to
+    wait on, or ``('miss', Flight)`` for the request that makes the upstream call; it
+    must then call ``finish(key, flight, response)`` (None on failure) to release the
+    requests waiting on it.
+    """
+
+    def __init__(self, max_entries=256, ttl=300.0, max_body_bytes=1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_body_bytes = max_body_bytes
+        self.entries = OrderedDict()  # key -> (CachedResponse, stored at)
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'coalesced': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expirations': 0}
+
+    @staticmethod
+    def make_key(request_body):
+        canonical = json.dumps(request_body, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def begin(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                response, stored_at = entry
+                if self.ttl is None or time.monotonic() - stored_at <= self.ttl:
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return 'hit', response
+                del self.entries[key]
+                self.stats['expirations'] += 1
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.stats['coalesced'] += 1
+                return 'coalesced', flight
+            flight = self.flights[key] = Flight()
+            self.stats['misses'] += 1
+            return 'miss', flight
+
+    def finish(self, key, flight, response):
+        """Release the followers of ``flight`` and cache ``response`` if it is a cacheable success"""
+        if response is not None and not response.shareable():
+            response = None
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            if response is not None and len(response.body) <= self.max_body_bytes:
+                self.entries[key] = (response, time.monotonic())
+                self.entries.move_to_end(key)
+                self.stats['stores'] += 1
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.stats['evictions'] += 1
+        flight.response = response
+        flight.done.set()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def metrics(self):
+        with self.lock:
+            metrics = dict(self.stats, entries=len(self.entries), in_flight=len(self.flights))
+        requests = metrics['hits'] + metrics['coalesced'] + metrics['misses']
+        metrics['upstream_saved_ratio'] = (metrics['hits'] + metrics['coalesced']) / requests if requests else 0.0
+        return metrics
@@ -0,0 +1,231 @@
+"""
+Shared rate limiter for Claude API calls
+Per-model token buckets for requests/min and tokens/min, a priority wait queue and
+Retry-After-aware pausing, used by both the Python simulator and the HTTP proxy
+"""
+
+import contextlib
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+PRIORITIES = {'interactive': PRIORITY_INTERACTIVE, 'batch': PRIORITY_BATCH}
+
+# Priority used by calls that don't pass one explicitly; see request_priority()
+current_priority = contextvars.ContextVar('current_priority', default=PRIORITY_INTERACTIVE)
+
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """Run the enclosed calls (and tasks or threads started with a copy of this context) at ``priority``"""
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class RateLimitTimeout(TimeoutError):
+    """Raised when a call could not be admitted within its timeout"""
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at ``per_minute / 60`` tokens per second"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount, now):
+        """Seconds until ``amount`` tokens are available (0 if they are now)"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class ModelLimits:
+    """Buckets, pause deadline, wait queue and counters for one model"""
+
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0.0
+        self.waiters = []
+        self.stats = {'granted': 0, 'timeouts': 0, 'rate_limited': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+
+    def delay(self, tokens, now):
+        delay = max(0.0, self.paused_until - now)
+        if self.requests is not None:
+            delay = max(delay, self.requests.delay(1, now))
+        if self.tokens is not None and tokens:
+            delay = max(delay, self.tokens.delay(tokens, now))
+        return delay
+
+    def take(self, tokens):
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None and tokens:
+            self.tokens.take(tokens)
+
+
+class Reservation:
+    """An admitted call; lets the caller wait out a rate limit or return unused tokens"""
+
+    def __init__(self, limiter, model, tokens, priority, waited):
+        self.limiter = limiter
+        self.model = model
+        self.tokens = tokens
+        self.priority = priority
+        self.waited = waited
+
+    def retry_after(self, seconds):
+        """Pause the model for everyone for ``seconds``, then queue again for another attempt"""
+        self.limiter.pause(self.model, seconds)
+        self.waited += self.limiter.acquire(self.model, self.tokens, self.priority).waited
+
+    def settle(self, used_tokens):
+        """Refund the difference between the reserved and the actually used tokens"""
+        if used_tokens < self.tokens:
+            self.limiter.refund(self.model, self.tokens - used_tokens)
+        self.tokens = used_tokens
+
+
+class RateLimiter:
+    """Process-wide scheduler for Claude API calls
+
+    Each model has optional requests-per-minute and tokens-per-minute buckets. Calls
+    wait in a per-model priority queue, so interactive requests are admitted before
+    queued batch work, and a 429/529 pauses the model for every caller until the
+    Retry-After window has passed instead of letting each caller retry on its own.
+    ``limits`` maps model names to ``{'rpm': ..., 'tpm': ...}``; models without an
+    entry use ``default_rpm``/``default_tpm`` (None means unlimited).
+    """
+
+    def __init__(self, limits=None, default_rpm=None, default_tpm=None):
+        self.limits = dict(limits or {})
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.condition = threading.Condition()
+        self.models = {}
+        self._sequence = itertools.count()
+
+    def _model(self, model):
+        limits = self.models.get(model)
+        if limits is None:
+            config = self.limits.get(model, {})
+            limits = ModelLimits(config.get('rpm', self.default_rpm), config.get('tpm', self.default_tpm))
+            self.models[model] = limits
+        return limits
+
+    def acquire(self, model, tokens=0, priority=None, timeout=None):
+        """Block until a call of ``tokens`` tokens may be sent to ``model``; returns a Reservation"""
+        priority = current_priority.get() if priority is None else priority
+        start = time.monotonic()
+        with self.condition:
+            limits = self._model(model)
+            entry = (priority, next(self._sequence))
+            heapq.heappush(limits.waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    # Only the highest-priority, longest-waiting caller may take tokens
+                    delay = limits.delay(tokens, now) if limits.waiters[0] == entry else None
+                    if delay == 0.0:
+                        limits.take(tokens)
+                        break
+                    if timeout is not None:
+                        remaining = start + timeout - now
+                        if remaining <= 0:
+                            limits.stats['timeouts'] += 1
+                            raise RateLimitTimeout(f'Rate limit for {model} not available within {timeout}s')
+                        delay = remaining if delay is None else min(delay, remaining)
+                    self.condition.wait(delay)
+            finally:
+                limits.waiters.remove(entry)
+                heapq.heapify(limits.waiters)
+                self.condition.notify_all()
+            waited = time.monotonic() - start
+            limits.stats['granted'] += 1
+            limits.stats['wait_seconds'] += waited
+            limits.stats['max_wait_seconds'] = max(limits.stats['max_wait_seconds'], waited)
+        return Reservation(self, model, tokens, priority, waited)
+
+    def pause(self, model, seconds):
+        """Hold back every call to ``model`` for ``seconds`` (after a 429/529)"""
+        with self.condition:
+            limits = self._model(model)
+            limits.paused_until = max(limits.paused_until, time.monotonic() + seconds)
+            limits.stats['rate_limited'] += 1
+            self.condition.notify_all()
+
+    def refund(self, model, tokens):
+        with self.condition:
+            limits = self._model(model)
+            if limits.tokens is not None:
+                limits.tokens.give_back(tokens)
+                self.condition.notify_all()
+
+    def metrics(self):
+        """Queue depth, wait times and rate-limit counts per model"""
+        with self.condition:
+            now = time.monotonic()
+            metrics = {}
+            for model, limits in self.models.items():
+                stats = dict(limits.stats)
+                stats['queue_depth'] = len(limits.waiters)
+                stats['mean_wait_seconds'] = stats['wait_seconds'] / stats['granted'] if stats['granted'] else 0.0
+                stats['paused_for_seconds'] = max(0.0, limits.paused_until - now)
+                if limits.requests is not None:
+                    limits.requests._refill(now)
+                    stats['requests_available'] = limits.requests.tokens
+                if limits.tokens is not None:
+                    limits.tokens._refill(now)
+                    stats['tokens_available'] = limits.tokens.tokens
+                metrics[model] = stats
+            return metrics
+
+
+def estimate_request_tokens(request_body):
+    """Tokens to reserve for a Messages API request: ~4 characters per input token plus max_tokens"""
+    input_chars = len(json.dumps(request_body.get('messages', []))) + len(str(request_body.get('system', '')))
+    return input_chars // 4 + int(request_body.get('max_tokens') or 0)
+
+
+def limiter_from_env():
+    """Build a limiter from CLAUDE_RPM / CLAUDE_TPM and per-model CLAUDE_RATE_LIMITS (JSON)"""
+    def optional_int(name):
+        value = os.environ.get(name)
+        return int(value) if value else None
+    return RateLimiter(json.loads(os.environ.get('CLAUDE_RATE_LIMITS') or '{}'),
+                       optional_int('CLAUDE_RPM'), optional_int('CLAUDE_TPM'))
+
+
+_shared_limiter = None
+_shared_limiter_lock = threading.Lock()
+
+
+def get_shared_limiter():
+    """The process-wide limiter used by ClaudeProvider and the proxy unless another is assigned"""
+    global _shared_limiter
+    with _shared_limiter_lock:
+        if _shared_limiter is None:
+            _shared_limiter = limiter_from_env()
+        return _shared_limiter
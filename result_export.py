@@ -0,0 +1,296 @@
+"""
+Streaming export of simulation results
+Writes ProcessingResults one at a time to JSON-lines, CSV, Parquet or Arrow files
+(optionally gzip or zstd compressed, optionally appending) without building the
+whole export in memory first
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+from abc import ABC, abstractmethod
+
+try:
+    import zstandard  # Optional: zstd compression of JSON-lines and CSV exports
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow  # Optional: Parquet and Arrow exports
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ('jsonl', 'csv', 'parquet', 'arrow')
+COMPRESSIONS = ('gzip', 'zstd')
+_SUFFIX_FORMATS = {'.jsonl': 'jsonl', '.ndjson': 'jsonl', '.csv': 'csv', '.parquet': 'parquet',
+                   '.arrow': 'arrow', '.feather': 'arrow'}
+_SUFFIX_COMPRESSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+
+def result_record(result, extra=None):
+    """The export row of one ProcessingResult, followed by any ``extra`` columns
+
+    Keys match the ``processing_steps`` entries of ``export_results()``, apart from
+    the per-step ``metadata``, which is left to the JSON export.
+    """
+    record = {
+        'step': result.step,
+        'brain_region': result.brain_region,
+        'input': result.input_data,
+        'output': result.output,
+        'processing_time': result.processing_time,
+        'model': result.model_used,
+        'fingerprint': result.fingerprint,
+        'input_tokens': result.input_tokens,
+        'output_tokens': result.output_tokens,
+    }
+    if extra:
+        record.update(extra)
+    return record
+
+
+def infer_format(path):
+    """(format, compression) from a file name such as ``run.jsonl.zst`` or ``run.parquet``"""
+    root, suffix = os.path.splitext(str(path).lower())
+    compression = _SUFFIX_COMPRESSIONS.get(suffix)
+    if compression:
+        suffix = os.path.splitext(root)[1]
+    return _SUFFIX_FORMATS.get(suffix), compression
+
+
+def _open_binary(target, append):
+    """Binary stream for a path (opened for write or append) or an already-open stream"""
+    if hasattr(target, 'write'):
+        return target, False
+    return open(target, 'ab' if append else 'wb'), True
+
+
+def _check_compression(compression):
+    """Raise if ``compression`` is unknown or its module is missing, before any file is opened"""
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression '{compression}'. Use one of {COMPRESSIONS}")
+    if compression == 'zstd' and zstandard is None:
+        raise ImportError("zstd compression requires zstandard. Install it with 'pip install zstandard'.")
+
+
+def _compressed(raw, compression):
+    """Wrap a binary stream in a compressor; appended gzip members and zstd frames concatenate"""
+    _check_compression(compression)
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='wb')
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    return raw
+
+
+class ResultWriter(ABC):
+    """Base class of the streaming writers; use as a context manager or call close()
+
+    ``write(result, **extra)`` adds one ProcessingResult (``extra`` becomes additional
+    columns, e.g. a batch item index); ``count`` is the number of rows written.
+    Subclasses implement ``write_record``.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.closed = False
+
+    def write(self, result, **extra):
+        self.write_record(result_record(result, extra))
+
+    def write_many(self, results, **extra):
+        for result in results:
+            self.write(result, **extra)
+        return self.count
+
+    @abstractmethod
+    def write_record(self, record):
+        """Write one export row (a ``result_record`` dict) and count it"""
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class _TextResultWriter(ResultWriter):
+    """Shared plumbing of the line-oriented writers: compression, append and stream ownership"""
+
+    def __init__(self, target, compression=None, append=False):
+        super().__init__()
+        _check_compression(compression)  # Before opening, so a failure never truncates the target
+        self.appending = append and not hasattr(target, 'write') and os.path.exists(target) and os.path.getsize(target) > 0
+        self.raw, self.owns_raw = _open_binary(target, append)
+        try:
+            self.compressor = _compressed(self.raw, compression)
+        except BaseException:
+            if self.owns_raw:
+                self.raw.close()
+            raise
+        self.text = io.TextIOWrapper(self.compressor, encoding='utf-8', newline='', write_through=False)
+
+    def flush(self):
+        self.text.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.text.flush()
+        self.text.detach()
+        if self.compressor is not self.raw:
+            self.compressor.close()  # Writes the gzip trailer / zstd frame end; leaves raw open
+        if self.owns_raw:
+            self.raw.close()
+        else:
+            self.raw.flush()
+        super().close()
+
+
+class JsonlResultWriter(_TextResultWriter):
+    """One JSON object per line"""
+
+    def write_record(self, record):
+        self.text.write(json.dumps(record, ensure_ascii=False))
+        self.text.write('\n')
+        self.count += 1
+
+
+class CsvResultWriter(_TextResultWriter):
+    """CSV with a header row (skipped when appending to a non-empty file)
+
+    The columns are fixed by the first row written, so every row of one file should
+    carry the same ``extra`` columns.
+    """
+
+    def __init__(self, target, compression=None, append=False):
+        super().__init__(target, compression, append)
+        self.writer = None
+
+    def write_record(self, record):
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.text, fieldnames=list(record), extrasaction='ignore')
+            if not self.appending:
+                self.writer.writeheader()
+        self.writer.writerow(record)
+        self.count += 1
+
+
+class _ArrowResultWriter(ResultWriter):
+    """Buffers ``row_group_size`` rows at a time into Arrow record batches"""
+
+    def __init__(self, target, compression=None, append=False, row_group_size=10000):
+        if pyarrow is None:
+            raise ImportError("Parquet and Arrow exports require pyarrow. Install it with 'pip install pyarrow'.")
+        if append:
+            raise ValueError('Parquet and Arrow files cannot be appended to; write each batch job to its own file')
+        super().__init__()
+        self.target = target
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.schema = None
+        self.writer = None
+
+    def write_record(self, record):
+        self.rows.append(record)
+        self.count += 1
+        if len(self.rows) >= self.row_group_size:
+            self._flush_rows()
+
+    def _flush_rows(self):
+        if not self.rows:
+            return
+        # The first row group fixes the schema; later ones are converted to it
+        table = pyarrow.Table.from_pylist(self.rows, schema=self.schema)
+        if self.writer is None:
+            self.schema = table.schema
+            self.writer = self._open_writer(self.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        if self.closed:
+            return
+        self._flush_rows()
+        if self.writer is not None:
+            self.writer.close()
+        super().close()
+
+
+class ParquetResultWriter(_ArrowResultWriter):
+    """Columnar Parquet; ``compression`` is applied per column (zstd, gzip, snappy or none)"""
+
+    def _open_writer(self, schema):
+        return pyarrow.parquet.ParquetWriter(self.target, schema, compression=self.compression or 'zstd')
+
+
+class ArrowResultWriter(_ArrowResultWriter):
+    """Arrow IPC file (Feather v2); ``compression`` may be zstd or lz4"""
+
+    def _open_writer(self, schema):
+        options = pyarrow.ipc.IpcWriteOptions(compression=self.compression) if self.compression else None
+        return pyarrow.ipc.new_file(self.target, schema, options=options)
+
+
+_WRITERS = {'jsonl': JsonlResultWriter, 'csv': CsvResultWriter, 'parquet': ParquetResultWriter, 'arrow': ArrowResultWriter}
+
+
+def open_result_writer(target, format=None, compression=None, append=False, **options):
+    """Open a streaming writer for a path or binary stream
+
+    ``format`` and ``compression`` default to what the file name says
+    (``results.jsonl.gz``, ``results.csv.zst``, ``results.parquet``). ``append``
+    adds to an existing JSON-lines or CSV file, e.g. one file shared by a batch job.
+    """
+    inferred_format, inferred_compression = infer_format(target) if not hasattr(target, 'write') else (None, None)
+    format = (format or inferred_format or 'jsonl').lower()
+    if format not in _WRITERS:
+        raise ValueError(f"Unsupported export format '{format}'. Use one of {FORMATS}")
+    compression = compression or inferred_compression
+    return _WRITERS[format](target, compression, append, **options)
+
+
+def _iter_arrow_records(path, format):
+    if pyarrow is None:
+        raise ImportError("Reading Parquet and Arrow exports requires pyarrow. Install it with 'pip install pyarrow'.")
+    if format == 'parquet':
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches():
+            yield from batch.to_pylist()
+    else:
+        with pyarrow.memory_map(str(path)) as source:
+            reader = pyarrow.ipc.open_file(source)
+            for index in range(reader.num_record_batches):
+                yield from reader.get_batch(index).to_pylist()
+
+
+def iter_records(path, compression=None):
+    """Yield the rows of an export (JSON lines or CSV, compressed or not, Parquet or Arrow) one at a time"""
+    format, inferred_compression = infer_format(path)
+    if format in ('parquet', 'arrow'):
+        yield from _iter_arrow_records(path, format)
+        return
+    compression = compression or inferred_compression
+    if compression == 'gzip':
+        raw = gzip.open(path, 'rb')
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstd compression requires zstandard. Install it with 'pip install zstandard'.")
+        raw = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+    else:
+        raw = open(path, 'rb')
+    with io.TextIOWrapper(raw, encoding='utf-8', newline='') as text:
+        if format == 'csv':
+            yield from csv.DictReader(text)
+        else:
+            for line in text:
+                if line.strip():
+                    yield json.loads(line)
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Columnar archive of simulation runs
+Stores every step result as Parquet partitioned by date, model and step, with a run
+table for processing metadata, and answers latency and text queries while reading
+only the partitions, row groups and columns they need
+"""
+
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import os
+import time
+import uuid
+
+try:
+    import pyarrow  # Required by RunArchive; imported lazily so the simulator works without it
+    import pyarrow.compute
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+STEP_SCHEMA = None
+RUN_SCHEMA = None
+if pyarrow is not None:
+    STEP_SCHEMA = pyarrow.schema([
+        ('run_id', pyarrow.string()),
+        ('run_timestamp', pyarrow.timestamp('us', tz='UTC')),
+        ('brain_region', pyarrow.string()),
+        ('input', pyarrow.string()),
+        ('output', pyarrow.string()),
+        ('processing_time', pyarrow.float64()),  # seconds
+        ('input_tokens', pyarrow.int64()),
+        ('output_tokens', pyarrow.int64()),
+        ('fingerprint', pyarrow.string()),
+        ('source', pyarrow.string()),
+        # Partition keys (directory names, not stored in the files)
+        ('date', pyarrow.string()),
+        ('model', pyarrow.string()),
+        ('step', pyarrow.int32()),
+    ])
+    RUN_SCHEMA = pyarrow.schema([
+        ('run_id', pyarrow.string()),
+        ('run_timestamp', pyarrow.timestamp('us', tz='UTC')),
+        ('total_steps', pyarrow.int32()),
+        ('total_processing_time', pyarrow.float64()),
+        ('input_tokens_used', pyarrow.int64()),
+        ('output_tokens_used', pyarrow.int64()),
+        ('input', pyarrow.string()),
+        ('source', pyarrow.string()),
+        ('metadata', pyarrow.string()),  # remaining processing_metadata as JSON
+        ('date', pyarrow.string()),
+    ])
+
+STEP_PARTITIONS = ('date', 'model', 'step')
+
+
+def _as_utc(value):
+    """A timezone-aware UTC datetime from a datetime, date, ISO string or Unix time"""
+    if value is None:
+        return datetime.datetime.now(datetime.timezone.utc)
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    elif not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        value = value.astimezone()  # Naive times are local, as written by export_results()
+    return value.astimezone(datetime.timezone.utc)
+
+
+def _model_name(value):
+    """The bare model id: ProcessingResult.model_used carries a ``claude/`` provider prefix, JSON exports may not"""
+    if not value:
+        return 'unknown'
+    return value[len('claude/'):] if value.startswith('claude/') else value
+
+
+class RunArchive:
+    """Parquet archive of ProcessingResults under ``root``
+
+    ``steps/date=YYYY-MM-DD/model=<model>/step=<n>/`` holds one row per step result and
+    ``runs/date=YYYY-MM-DD/`` one row per run. Filters on date, model and step skip
+    whole directories, other filters are checked against row-group statistics before
+    any data is read, and only the requested columns are decoded. Each ingest adds a
+    small file per partition; ``compact()`` merges them once an archive has grown.
+    """
+
+    def __init__(self, root):
+        if pyarrow is None:
+            raise ImportError("RunArchive requires pyarrow. Install it with 'pip install pyarrow'.")
+        self.root = str(root)
+        self.steps_dir = os.path.join(self.root, 'steps')
+        self.runs_dir = os.path.join(self.root, 'runs')
+        os.makedirs(self.steps_dir, exist_ok=True)
+        os.makedirs(self.runs_dir, exist_ok=True)
+
+    # Writing
+
+    def ingest(self, results, metadata=None, run_id=None, timestamp=None, run_input=None, source='simulator'):
+        """Archive one run's ProcessingResults and its ``processing_metadata``; returns the run id"""
+        return self._write_run(
+            [{'step': r.step, 'brain_region': r.brain_region, 'input': r.input_data, 'output': r.output,
+              'processing_time': r.processing_time, 'model': r.model_used, 'fingerprint': r.fingerprint,
+              'input_tokens': r.input_tokens, 'output_tokens': r.output_tokens} for r in results],
+            metadata or {}, run_id or uuid.uuid4().hex, _as_utc(timestamp),
+            run_input if run_input is not None else (results[0].input_data if results else ''), source)
+
+    def _write_run(self, steps, metadata, run_id, timestamp, run_input, source):
+        date = timestamp.strftime('%Y-%m-%d')
+        rows = [{
+            'run_id': run_id, 'run_timestamp': timestamp, 'brain_region': step.get('brain_region') or '',
+            'input': step.get('input') or '', 'output': step.get('output') or '',
+            'processing_time': float(step.get('processing_time') or 0.0),
+            'input_tokens': int(step.get('input_tokens') or 0), 'output_tokens': int(step.get('output_tokens') or 0),
+            'fingerprint': step.get('fingerprint') or '', 'source': source,
+            'date': date, 'model': _model_name(step.get('model')), 'step': int(step['step']),
+        } for step in steps]
+        self._write(pyarrow.Table.from_pylist(rows, schema=STEP_SCHEMA), self.steps_dir, STEP_PARTITIONS, run_id)
+
+        known = ('total_processing_time', 'input_tokens_used', 'output_tokens_used')
+        run = {
+            'run_id': run_id, 'run_timestamp': timestamp, 'total_steps': len(rows),
+            'total_processing_time': float(metadata.get('total_processing_time') or sum(row['processing_time'] for row in rows)),
+            'input_tokens_used': int(metadata.get('input_tokens_used') or sum(row['input_tokens'] for row in rows)),
+            'output_tokens_used': int(metadata.get('output_tokens_used') or sum(row['output_tokens'] for row in rows)),
+            'input': run_input or '', 'source': source,
+            'metadata': json.dumps({key: value for key, value in metadata.items() if key not in known}, default=str),
+            'date': date,
+        }
+        self._write(pyarrow.Table.from_pylist([run], schema=RUN_SCHEMA), self.runs_dir, ('date',), run_id)
+        return run_id
+
+    @staticmethod
+    def _write(table, base_dir, partition_keys, run_id):
+        partitioning = pyarrow.dataset.partitioning(pyarrow.schema([table.schema.field(key) for key in partition_keys]), flavor='hive')
+        pyarrow.dataset.write_dataset(table, base_dir, format='parquet', partitioning=partitioning,
+                                      basename_template=f'part-{run_id}-{{i}}.parquet',
+                                      existing_data_behavior='overwrite_or_ignore')
+
+    def has_run(self, run_id):
+        return self._dataset(self.runs_dir, ('date',)).count_rows(filter=pyarrow.dataset.field('run_id') == run_id) > 0
+
+    # Importing the older JSON exports
+
+    def import_json(self, path):
+        """Archive a run saved as JSON by ``export_results()``, the web app or the demo script
+
+        The run id is derived from the file's contents, so importing a file twice is a
+        no-op. Returns the run id.
+        """
+        with open(path, 'rb') as f:
+            raw = f.read()
+        run_id = 'import-' + hashlib.sha256(raw).hexdigest()[:16]
+        if self.has_run(run_id):
+            return run_id
+        data = json.loads(raw)
+        metadata = data.get('metadata', {}) if isinstance(data, dict) else {}
+        timestamp = metadata.get('timestamp') or os.path.getmtime(path)
+        run_input = data.get('input') if isinstance(data, dict) else None
+        steps_data = data.get('processing_steps', []) if isinstance(data, dict) else data
+
+        if isinstance(steps_data, dict):
+            # Web app export: {"step_1": {...}, ...} with processing times in milliseconds
+            steps = []
+            for key, step in steps_data.items():
+                steps.append({'step': int(key.rsplit('_', 1)[-1]), 'brain_region': step.get('brain_region'),
+                              'input': run_input if key.endswith('_1') else '', 'output': step.get('output'),
+                              'processing_time': float(step.get('processing_time') or 0) / 1000.0,
+                              'model': step.get('model_used') or step.get('model')})
+            metadata = dict(metadata, total_processing_time=float(metadata.get('total_processing_time') or 0) / 1000.0)
+        else:
+            steps = [dict(step, model=step.get('model') or step.get('model_used')) for step in steps_data]
+        if run_input is None and steps:
+            run_input = steps[0].get('input') or ''
+        return self._write_run(steps, metadata, run_id, _as_utc(timestamp), run_input, os.path.basename(path))
+
+    def import_files(self, pattern):
+        """Import every JSON export matching a glob pattern; returns the run ids"""
+        return [self.import_json(path) for path in sorted(glob.glob(pattern))]
+
+    # Reading
+
+    @staticmethod
+    def _dataset(base_dir, partition_keys):
+        schema = STEP_SCHEMA if 'step' in partition_keys else RUN_SCHEMA
+        partitioning = pyarrow.dataset.partitioning(pyarrow.schema([schema.field(key) for key in partition_keys]), flavor='hive')
+        return pyarrow.dataset.dataset(base_dir, format='parquet', partitioning=partitioning, schema=schema)
+
+    @staticmethod
+    def _filter(since=None, until=None, models=None, steps=None, contains=None, where=None):
+        """Dataset filter expression; date bounds also prune the ``date`` partition directories"""
+        field = pyarrow.dataset.field
+        conditions = []
+        if since is not None:
+            since = _as_utc(since)
+            conditions += [field('date') >= since.strftime('%Y-%m-%d'), field('run_timestamp') >= pyarrow.scalar(since, pyarrow.timestamp('us', tz='UTC'))]
+        if until is not None:
+            until = _as_utc(until)
+            conditions += [field('date') <= until.strftime('%Y-%m-%d'), field('run_timestamp') < pyarrow.scalar(until, pyarrow.timestamp('us', tz='UTC'))]
+        if models is not None:
+            conditions.append(field('model').isin([_model_name(model) for model in ([models] if isinstance(models, str) else models)]))
+        if steps is not None:
+            conditions.append(field('step').isin([steps] if isinstance(steps, int) else list(steps)))
+        if contains is not None:
+            conditions.append(pyarrow.compute.match_substring(field('output'), contains, ignore_case=True))
+        if where is not None:
+            conditions.append(where)
+        expression = None
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def query(self, columns=None, since=None, until=None, models=None, steps=None, contains=None, where=None):
+        """Step results as a pyarrow Table, reading only matching partitions and ``columns``
+
+        ``since``/``until`` take datetimes, dates, ISO strings or Unix times; ``contains``
+        is a case-insensitive substring of the output; ``where`` is any extra
+        ``pyarrow.dataset`` expression, e.g. ``pyarrow.dataset.field("processing_time") > 5``.
+        """
+        dataset = self._dataset(self.steps_dir, STEP_PARTITIONS)
+        return dataset.to_table(columns=list(columns) if columns else None,
+                                filter=self._filter(since, until, models, steps, contains, where))
+
+    def runs(self, columns=None, since=None, until=None, where=None):
+        """Run-level rows (totals, token usage and the remaining processing_metadata as JSON)"""
+        dataset = self._dataset(self.runs_dir, ('date',))
+        return dataset.to_table(columns=list(columns) if columns else None, filter=self._filter(since, until, where=where))
+
+    def latency_percentiles(self, step=None, group_by='model', since=None, until=None, models=None, quantiles=(0.5, 0.95, 0.99)):
+        """Exact processing-time quantiles per ``group_by`` value (model, step, date or brain_region)
+
+        e.g. ``latency_percentiles(step=7, since=datetime.now() - timedelta(days=7))``
+        gives p50/p95/p99 of step 7 per model over the last week.
+        """
+        table = self.query([group_by, 'processing_time'], since, until, models, step)
+        grouped = table.group_by(group_by).aggregate([('processing_time', 'list')])
+        summary = {}
+        for key, times in zip(grouped.column(group_by).to_pylist(), grouped.column('processing_time_list').to_pylist()):
+            values = pyarrow.compute.quantile(pyarrow.array(times, pyarrow.float64()), q=list(quantiles)).to_pylist()
+            summary[str(key)] = dict({'count': len(times)}, **{f'p{round(q * 100):g}': value for q, value in zip(quantiles, values)})
+        return summary
+
+    def search_outputs(self, text, step=None, since=None, until=None, columns=('run_id', 'run_timestamp', 'step', 'model', 'output')):
+        """Step outputs containing ``text`` (case-insensitive)"""
+        return self.query(columns, since, until, steps=step, contains=text)
+
+    # Maintenance
+
+    def compact(self):
+        """Merge the small per-run files of every partition into one file; returns partitions merged"""
+        merged = 0
+        for base_dir, partition_keys in ((self.steps_dir, STEP_PARTITIONS), (self.runs_dir, ('date',))):
+            for directory, _, files in os.walk(base_dir):
+                parts = sorted(name for name in files if name.endswith('.parquet'))
+                if len(parts) < 2:
+                    continue
+                table = pyarrow.concat_tables(pyarrow.parquet.read_table(os.path.join(directory, name)) for name in parts)
+                target = os.path.join(directory, f'compacted-{int(time.time() * 1000)}.parquet')
+                pyarrow.parquet.write_table(table, target + '.tmp', compression='zstd')
+                os.replace(target + '.tmp', target)
+                for name in parts:
+                    os.remove(os.path.join(directory, name))
+                merged += 1
+        return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive and query simulation runs')
+    parser.add_argument('--archive', default='run_archive', help='archive directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', help='import JSON exports')
+    import_parser.add_argument('patterns', nargs='+', help='files or glob patterns')
+    latency_parser = commands.add_parser('latency', help='processing-time percentiles')
+    latency_parser.add_argument('--step', type=int)
+    latency_parser.add_argument('--by', default='model', choices=('model', 'step', 'date', 'brain_region'))
+    latency_parser.add_argument('--days', type=float, help='only the last N days')
+    search_parser = commands.add_parser('search', help='outputs containing a phrase')
+    search_parser.add_argument('text')
+    search_parser.add_argument('--step', type=int)
+    search_parser.add_argument('--days', type=float)
+    commands.add_parser('compact', help='merge small files')
+    args = parser.parse_args()
+
+    archive = RunArchive(args.archive)
+    since = None
+    if getattr(args, 'days', None):
+        since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=args.days)
+    if args.command == 'import':
+        for pattern in args.patterns:
+            for run_id in archive.import_files(pattern):
+                print(f'{pattern}: {run_id}')
+    elif args.command == 'latency':
+        for group, stats in sorted(archive.latency_percentiles(args.step, args.by, since).items()):
+            print(f'{group:<32} ' + '  '.join(f'{key}={value:.3f}' if isinstance(value, float) else f'{key}={value}'
+                                              for key, value in stats.items()))
+    elif args.command == 'search':
+        for row in archive.search_outputs(args.text, args.step, since).to_pylist():
+            print(f"{row['run_timestamp']:%Y-%m-%d %H:%M} step {row['step']} {row['model']}: {row['output'][:100]!r}")
+    elif args.command == 'compact':
+        print(f'Compacted {archive.compact()} partitions')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,49 @@
 # This application uses Anthropic's Claude models to simulate neural visual processing
 
 import json
+import logging
+import math
+import os
+import random
+import re
 import requests
 import time
 import base64
-from typing import Dict, List, Optional, Union
-from dataclasses import dataclass
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from dataclasses import asdict, dataclass, field, replace
 from abc import ABC, abstractmethod
 from pathlib import Path
 
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+
+from image_preprocessing import ImagePreprocessor, media_type_of_base64
+from instrumentation import METRICS, TRACER, record_api_call
+from mock_api import MockBatches, MockBehavior
+from rate_limiter import PRIORITY_BATCH, RateLimiter, Reservation, estimate_request_tokens, get_shared_limiter, request_priority
+from result_export import iter_records, open_result_writer
+from structured_logging import ensure_configured as ensure_logging_configured
+
+try:
+    import aiohttp  # Optional: only needed for AsyncClaudeProvider
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger("simulator")
+
+# Base64 image payload of a stimulus: one image, or an overview followed by tiles
+ImageData = Union[str, List[str]]
+
 @dataclass
 class ProcessingStep:
     """Represents a single step in the visual processing pathway"""
@@ -19,6 +54,8 @@ class ProcessingStep:
     process: str
     routing: str
     ai_prompt: str
+    depends_on: Tuple[int, ...] = ()  # Upstream step sequences; empty for the pathway entry point
+    recall_memories: bool = False  # Inject similar stored memories into this step's prompt
 
 @dataclass
 class ProcessingResult:
@@ -29,11 +66,382 @@ class ProcessingResult:
     output: str
     processing_time: float
     model_used: str
+    fingerprint: str = ""  # Hash of the step's prompt, model and upstream input; empty for failed steps
+    input_tokens: int = 0  # Prompt tokens sent for this step (from the API usage field, else estimated)
+    output_tokens: int = 0  # Completion tokens reported by the API usage field
+    metadata: Dict[str, str] = field(default_factory=dict)  # Prompt context beyond the input, e.g. "compacted_input" or "recalled_memories"
+
+@dataclass
+class StepCall:
+    """A fully prepared request for one pathway step
+
+    ``input_data`` is the raw upstream input; ``context`` holds what the prompt
+    adds to or uses instead of it (the compacted input, recalled memories).
+    """
+    step: ProcessingStep
+    model: str
+    input_data: str
+    prompt: str
+    image_data: Optional[ImageData]
+    fingerprint: str
+    context: Dict[str, str] = field(default_factory=dict)
+
+@dataclass
+class StepStreamEvent:
+    """Incremental output from a streamed pathway run
+    
+    ``kind`` is ``"delta"`` for a chunk of generated text and ``"complete"`` once the
+    step has finished, in which case ``result`` holds its ProcessingResult.
+    """
+    step: int
+    brain_region: str
+    kind: str
+    text: str = ""
+    result: Optional[ProcessingResult] = None
+
+@dataclass
+class BatchItemResult:
+    """Outcome of running one stimulus through the pathway as part of a batch"""
+    index: int
+    visual_input: Union[str, Path]
+    input_type: str
+    results: List[ProcessingResult] = field(default_factory=list)
+    error: Optional[str] = None
+    elapsed: float = 0.0
 
 class ClaudeAPIError(Exception):
-    """Custom exception for Claude API errors"""
+    """Custom exception for Claude API errors
+    
+    ``status_code`` is the HTTP status when the API answered with an error, and
+    ``retry_after`` the server's Retry-After hint in seconds, if it sent one.
+    """
+    
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+    
+    @classmethod
+    def from_http_error(cls, message: str, status_code: Optional[int], headers=None) -> "ClaudeAPIError":
+        """Build an error from an HTTP failure, reading Retry-After from the response headers"""
+        retry_after = None
+        try:
+            retry_after = float((headers or {}).get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+        return cls(message, status_code, retry_after)
+
+class SQLiteCacheTier:
+    """On-disk response cache tier backed by a single SQLite file"""
+    
+    def __init__(self, path: Union[str, Path], ttl: Optional[float] = None):
+        self.path = str(path)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL)")
+        self._conn.commit()
+    
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        """Return ``(response, created)`` for an unexpired entry, or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and time.time() - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            return row[0], row[1]
+    
+    def put(self, key: str, response: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, response, created) VALUES (?, ?, ?)", (key, response, time.time()))
+            self._conn.commit()
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """Content-addressed cache of Claude responses for pathway steps
+    
+    Keys are a SHA-256 of the full request payload (model, system prompt, prompt,
+    temperature, image data), so identical steps are never paid for twice. Entries
+    live in an in-memory LRU tier bounded by ``max_entries`` and ``ttl`` seconds,
+    optionally backed by a slower on-disk tier such as ``SQLiteCacheTier``. A disk
+    tier created without its own ``ttl`` expires entries after the same ``ttl``.
+    """
+    
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = 3600.0, disk_tier: Optional[SQLiteCacheTier] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_tier = disk_tier
+        if disk_tier is not None and disk_tier.ttl is None:
+            disk_tier.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+    
+    @staticmethod
+    def make_key(payload: Dict) -> str:
+        """Hash a request payload into a stable cache key"""
+        canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Return a cached response or None, promoting disk hits into memory"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                response, stored_at = entry
+                if self.ttl is None or time.time() - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return response
+                del self._entries[key]
+                self._stats["expirations"] += 1
+        
+        if self.disk_tier is not None:
+            entry = self.disk_tier.get(key)
+            if entry is not None:
+                response, created = entry
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+                # Keep the original write time so a promoted entry expires when its disk copy does
+                self._store_in_memory(key, response, created)
+                return response
+        
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+    
+    def put(self, key: str, response: str):
+        """Store a response in every tier"""
+        self._store_in_memory(key, response)
+        if self.disk_tier is not None:
+            self.disk_tier.put(key, response)
+    
+    def _store_in_memory(self, key: str, response: str, stored_at: Optional[float] = None):
+        with self._lock:
+            self._entries[key] = (response, time.time() if stored_at is None else stored_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+    
+    def clear(self):
+        """Drop every in-memory entry (the disk tier is left untouched)"""
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Hit/miss/eviction counters for reporting in processing metadata"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+class ContextCompactor:
+    """Shrinks the upstream output forwarded to a chained step so it fits a token budget
+    
+    Strategies:
+    - ``"truncate"`` keeps the opening of the text, cut at a sentence boundary.
+    - ``"key_facts"`` keeps the most informative sentences and bullet points (numbers,
+      labelled values, terms the receiving step's prompt uses) in their original order.
+    - ``"sections"`` keeps the headed sections whose headings match the receiving step,
+      via ``step_sections`` keywords or the step prompt's own vocabulary, and falls back
+      to ``key_facts`` when no heading matches.
+    - ``"none"`` forwards the text unchanged.
+    
+    Text that already fits the budget is never touched. Merged multi-branch inputs
+    (``[Region]`` blocks) are compacted block by block so every branch keeps its share.
+    """
+    
+    STRATEGIES = ("none", "truncate", "key_facts", "sections")
+    CHARS_PER_TOKEN = 4
+    TRUNCATION_MARKER = "\n[...truncated]"
+    STOPWORDS = frozenset("""this that with from your into their these those which while about there where
+        include includes including provide process processing describe input output signals information""".split())
+    
+    _word_pattern = re.compile(r"[a-z][a-z0-9]+")
+    _sentence_pattern = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9(\"'])")
+    _bullet_pattern = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+")
+    _heading_pattern = re.compile(r"^\s*(?:#{1,6}\s+(.+?)|\*\*(.+?)\*\*:?|\[(.+?)\]|([A-Z][\w ,/&()'-]{2,60}):)\s*$")
+    _block_pattern = re.compile(r"^\[([^\]\n]+)\]\n", re.MULTILINE)
+    
+    def __init__(self, strategy: str = "truncate", max_tokens: int = 512,
+                 step_strategies: Optional[Dict[int, str]] = None,
+                 step_sections: Optional[Dict[int, Iterable[str]]] = None):
+        for name in [strategy, *(step_strategies or {}).values()]:
+            if name not in self.STRATEGIES:
+                raise ValueError(f"Unsupported compaction strategy '{name}'. Use one of {self.STRATEGIES}")
+        if max_tokens < 1:
+            raise ValueError("max_tokens must be at least 1")
+        self.strategy = strategy
+        self.max_tokens = max_tokens
+        self.step_strategies = dict(step_strategies or {})
+        self.step_sections = {sequence: [keyword.lower() for keyword in keywords]
+                              for sequence, keywords in (step_sections or {}).items()}
+    
+    @classmethod
+    def estimate_tokens(cls, text: str) -> int:
+        """Approximate token count (about four characters per token for English prose)"""
+        return math.ceil(len(text) / cls.CHARS_PER_TOKEN)
+    
+    def compact(self, text: str, step: ProcessingStep) -> str:
+        """Return ``text`` reduced to the budget using the strategy configured for ``step``"""
+        strategy = self.step_strategies.get(step.sequence, self.strategy)
+        if strategy == "none" or self.estimate_tokens(text) <= self.max_tokens:
+            return text
+        blocks = self._split_blocks(text)
+        if len(blocks) > 1:
+            budget = max(1, self.max_tokens // len(blocks))
+            return "\n\n".join(f"[{region}]\n{self._compact_text(body, step, strategy, budget)}" for region, body in blocks)
+        return self._compact_text(text, step, strategy, self.max_tokens)
+    
+    def _split_blocks(self, text: str) -> List[Tuple[str, str]]:
+        """Split input merged by ``_merge_upstream_outputs`` into (region, output) pairs"""
+        matches = list(self._block_pattern.finditer(text))
+        if len(matches) < 2 or matches[0].start() != 0:
+            return [("", text)]
+        bounds = [match.start() for match in matches[1:]] + [len(text)]
+        return [(match.group(1), text[match.end():end].strip()) for match, end in zip(matches, bounds)]
+    
+    def _compact_text(self, text: str, step: ProcessingStep, strategy: str, budget: int) -> str:
+        if self.estimate_tokens(text) <= budget:
+            return text
+        if strategy == "sections":
+            text = self._select_sections(text, step) or self._key_facts(text, step, budget)
+        elif strategy == "key_facts":
+            text = self._key_facts(text, step, budget)
+        return self._truncate(text, budget)
+    
+    def _vocabulary(self, step: ProcessingStep) -> set:
+        """Terms that mark text as relevant to the receiving step"""
+        if step.sequence in self.step_sections:
+            return {word for keyword in self.step_sections[step.sequence] for word in self._word_pattern.findall(keyword)}
+        words = self._word_pattern.findall(f"{step.ai_prompt} {step.process}".lower())
+        return {word for word in words if len(word) > 3 and word not in self.STOPWORDS}
+    
+    def _truncate(self, text: str, budget: int) -> str:
+        max_chars = budget * self.CHARS_PER_TOKEN
+        if len(text) <= max_chars:
+            return text
+        cut = max_chars - len(self.TRUNCATION_MARKER)
+        head = text[:max(cut, 0)]
+        # Prefer ending on a sentence or line boundary in the second half of the budget
+        boundary = max(head.rfind(". "), head.rfind("\n"))
+        if boundary >= cut // 2:
+            head = head[:boundary + 1]
+        return head.rstrip() + self.TRUNCATION_MARKER
+    
+    def _units(self, text: str) -> List[Tuple[str, bool]]:
+        """Split text into (sentence or list item, is_list_item) units, skipping headings"""
+        units = []
+        for line in text.splitlines():
+            if not line.strip() or self._heading_pattern.match(line):
+                continue
+            if self._bullet_pattern.match(line):
+                units.append((self._bullet_pattern.sub("", line).strip(), True))
+            else:
+                units.extend((sentence.strip(), False) for sentence in self._sentence_pattern.split(line.strip()))
+        return [(unit, is_item) for unit, is_item in units if unit]
+    
+    def _key_facts(self, text: str, step: ProcessingStep, budget: int) -> str:
+        vocabulary = self._vocabulary(step)
+        units = self._units(text)
+        scored, seen = [], set()
+        for position, (unit, is_item) in enumerate(units):
+            if unit in seen:
+                continue
+            seen.add(unit)
+            words = set(self._word_pattern.findall(unit.lower()))
+            score = min(len(words & vocabulary), 4) + 2 * is_item
+            score += any(character.isdigit() for character in unit) + (":" in unit.rstrip(":"))
+            if len(words) < 3:
+                score -= 2
+            scored.append((score, position))
+        
+        selected, used = [], 0
+        for score, position in sorted(scored, key=lambda entry: (-entry[0], entry[1])):
+            cost = self.estimate_tokens(units[position][0]) + 1
+            if used + cost <= budget:
+                selected.append(position)
+                used += cost
+        return "\n".join(f"- {units[position][0]}" for position in sorted(selected))
+    
+    def _select_sections(self, text: str, step: ProcessingStep) -> str:
+        vocabulary = self._vocabulary(step)
+        sections, heading, lines = [], None, []
+        for line in text.splitlines():
+            match = self._heading_pattern.match(line)
+            if match:
+                sections.append((heading, lines))
+                heading, lines = next(group for group in match.groups() if group), [line]
+            else:
+                lines.append(line)
+        sections.append((heading, lines))
+        kept = [
+            "\n".join(lines).strip() for heading, lines in sections
+            if heading and vocabulary & set(self._word_pattern.findall(heading.lower()))
+        ]
+        return "\n\n".join(kept)
+
+
+_connect_timing = threading.local()
+
+
+class _TimedConnectionMixin:
+    """Adds the time spent opening a TCP/TLS connection to the calling thread's counter"""
+    
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _connect_timing.seconds = getattr(_connect_timing, "seconds", 0.0) + time.perf_counter() - start
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
     pass
 
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """requests adapter whose pooled connections report how long connecting took
+    
+    Reused keep-alive connections don't connect at all, so their connect time is 0.
+    """
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool}
+    
+    @staticmethod
+    def reset_connect_time():
+        _connect_timing.seconds = 0.0
+    
+    @staticmethod
+    def connect_time() -> float:
+        """Seconds this thread spent connecting since the last ``reset_connect_time()``"""
+        return getattr(_connect_timing, "seconds", 0.0)
+
+
 class AIProvider(ABC):
     """Abstract base class for AI providers"""
     
@@ -50,30 +458,45 @@ class AIProvider(ABC):
         """Test if the API connection is working"""
         pass
 
-class ClaudeProvider(AIProvider):
-    """Anthropic Claude API integration optimized for neural processing simulation"""
+# True while a RetryPolicy owns retries of the calls in this context (see _run_step);
+# providers then hand 429/529s straight back instead of retrying them as well
+_policy_owns_retries = contextvars.ContextVar("policy_owns_retries", default=False)
+
+
+class _ClaudeRequestMixin:
+    """Model catalogue, request building, caching, rate limiting and metrics shared by the sync and async providers"""
     
-    def __init__(self, api_key: str):
-        super().__init__(api_key)
-        self.base_url = "https://api.anthropic.com/v1/messages"
+    def __init__(self, api_key: str, base_url: str = "https://api.anthropic.com/v1/messages"):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.response_cache: Optional[ResponseCache] = None
+        # Shared with every other provider (and the proxy, in the same process); None disables limiting
+        self.rate_limiter: Optional[RateLimiter] = get_shared_limiter()
+        self.max_rate_limit_retries = 2
         self.models = {
             "claude-3-5-sonnet-20241022": {
                 "name": "Claude 3.5 Sonnet",
                 "optimal_for": ["complex_reasoning", "object_recognition", "memory_integration"],
                 "max_tokens": 8192,
-                "cost_tier": "high"
+                "cost_tier": "high",
+                "input_cost_per_mtok": 3.0,
+                "output_cost_per_mtok": 15.0
             },
             "claude-3-5-haiku-20241022": {
                 "name": "Claude 3.5 Haiku", 
                 "optimal_for": ["basic_processing", "feature_extraction", "motion_analysis"],
                 "max_tokens": 8192,
-                "cost_tier": "low"
+                "cost_tier": "low",
+                "input_cost_per_mtok": 0.8,
+                "output_cost_per_mtok": 4.0
             },
             "claude-3-opus-20240229": {
                 "name": "Claude 3 Opus",
                 "optimal_for": ["highest_accuracy", "research_analysis"],
                 "max_tokens": 4096,
-                "cost_tier": "premium"
+                "cost_tier": "premium",
+                "input_cost_per_mtok": 15.0,
+                "output_cost_per_mtok": 75.0
             }
         }
     
@@ -89,34 +512,43 @@ class ClaudeProvider(AIProvider):
         else:
             return "claude-3-5-sonnet-20241022"
     
-    def generate_response(self, prompt: str, model: str = "claude-3-5-sonnet-20241022", image_data: Optional[str] = None) -> str:
-        """Generate response using Anthropic Claude API"""
-        headers = {
+    def _build_headers(self) -> Dict[str, str]:
+        """Headers sent with every Messages API request"""
+        return {
             "x-api-key": self.api_key,
             "Content-Type": "application/json",
             "anthropic-version": "2023-06-01"
         }
-        
+    
+    @staticmethod
+    def _trace_headers(span) -> Dict[str, str]:
+        """W3C ``traceparent`` for the call's span, so a proxy in between logs under the same trace id"""
+        return {"traceparent": span.traceparent} if span is not None else {}
+    
+    def _build_request(self, prompt: str, model: str, image_data: Optional[ImageData] = None) -> Dict:
+        """Build the Messages API request body for a processing step"""
         # Get model configuration
         model_config = self.models.get(model, self.models["claude-3-5-sonnet-20241022"])
         
         # Prepare message content based on whether image data is provided
         if image_data:
+            # The media type is sniffed from the data itself; a mislabelled image is rejected by the API
             content = [
                 {
                     "type": "image",
                     "source": {
                         "type": "base64",
-                        "media_type": "image/jpeg", 
-                        "data": image_data
+                        "media_type": media_type_of_base64(image),
+                        "data": image
                     }
-                },
-                {"type": "text", "text": prompt}
+                }
+                for image in ([image_data] if isinstance(image_data, str) else image_data)
             ]
+            content.append({"type": "text", "text": prompt})
         else:
             content = prompt
         
-        data = {
+        return {
             "model": model,
             "max_tokens": min(model_config["max_tokens"], 1000),  # Limit for processing steps
             "temperature": 0.3,  # Lower temperature for more consistent neural simulation
@@ -128,22 +560,258 @@ class ClaudeProvider(AIProvider):
             ],
             "system": "You are simulating a specific brain region in the visual processing pathway. Provide detailed, scientifically accurate responses that describe neural processing in that region. Focus on the biological mechanisms and signal transformations occurring."
         }
+    
+    def _parse_response(self, result: Dict) -> str:
+        """Extract the generated text from a Messages API response body"""
+        if 'content' in result and len(result['content']) > 0:
+            return result['content'][0]['text']
+        raise ClaudeAPIError("No content in Claude response")
+    
+    def _reserve(self, data: Dict) -> Optional[Reservation]:
+        """Wait for the rate limiter to admit a request (None when no limiter is configured)"""
+        if self.rate_limiter is None:
+            return None
+        return self.rate_limiter.acquire(data["model"], estimate_request_tokens(data))
+    
+    def _retry_rate_limited(self, reservation: Optional[Reservation], status_code: int, retry_after: Optional[str], attempt: int) -> bool:
+        """After a 429/529, wait out Retry-After through the limiter and report whether to retry
         
+        Up to ``max_rate_limit_retries`` retries happen here, none while a retry policy
+        owns retries; a 429/529 that is handed back still pauses the model in the limiter.
+        """
+        if reservation is None or status_code not in (429, 529):
+            return False
         try:
-            response = requests.post(self.base_url, headers=headers, json=data, timeout=30)
-            response.raise_for_status()
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = min(2.0 ** attempt, 30.0)
+        if _policy_owns_retries.get() or attempt >= self.max_rate_limit_retries:
+            reservation.limiter.pause(reservation.model, delay)
+            return False
+        reservation.retry_after(delay)
+        return True
+    
+    @staticmethod
+    def _settle(reservation: Optional[Reservation], data: Dict, text: str):
+        """Return reserved-but-unused output tokens to the limiter"""
+        if reservation is not None:
+            reservation.settle(reservation.tokens - data["max_tokens"] + ContextCompactor.estimate_tokens(text))
+    
+    @staticmethod
+    def _span_attributes(data: Dict) -> Dict:
+        return {"gen_ai.system": "anthropic", "gen_ai.request.model": data["model"], "gen_ai.request.max_tokens": data["max_tokens"]}
+    
+    @staticmethod
+    def _phases(connect: float, headers: float, total: float) -> Dict[str, float]:
+        """Split a request into connect, time to first byte (after connecting) and body read seconds
+        
+        ``headers`` is the time until the response headers arrived, including connecting.
+        """
+        return {"connect": connect, "ttfb": max(0.0, headers - connect), "body": max(0.0, total - headers), "total": total}
+    
+    @staticmethod
+    def _record_call(model: str, usage: Optional[Dict], phases: Dict[str, float], stats: Optional[Dict], span) -> None:
+        """Publish a completed call's token usage and phase timings to metrics, its span and ``stats``"""
+        input_tokens, output_tokens = record_api_call(model, usage, phases)
+        if span is not None:
+            span.set_attributes({"gen_ai.usage.input_tokens": input_tokens, "gen_ai.usage.output_tokens": output_tokens,
+                                 **{f"http.{phase}_seconds": round(seconds, 6) for phase, seconds in phases.items()}})
+        if stats is not None:
+            stats.update(input_tokens=input_tokens, output_tokens=output_tokens, phases=phases, cached=False)
+    
+    @staticmethod
+    def _record_cache_hit(model: str, stats: Optional[Dict]) -> None:
+        METRICS.inc("claude_api_requests_total", model=model, status="cached")
+        if stats is not None:
+            stats["cached"] = True
+    
+    @staticmethod
+    def _api_error(prefix: str, error: requests.exceptions.RequestException, model: Optional[str] = None) -> ClaudeAPIError:
+        """Convert a requests exception, counting transport failures that never got a status"""
+        error_response = getattr(error, "response", None)
+        if error_response is None and model is not None:
+            METRICS.inc("claude_api_requests_total", model=model, status="error")
+        return ClaudeAPIError.from_http_error(f"{prefix}: {str(error)}",
+                                              getattr(error_response, "status_code", None),
+                                              getattr(error_response, "headers", None))
+    
+    def _cache_lookup(self, data: Dict) -> Tuple[Optional[str], Optional[str]]:
+        """Return (cache key, cached response) for a request body when caching is enabled"""
+        if self.response_cache is None:
+            return None, None
+        key = self.response_cache.make_key(data)
+        return key, self.response_cache.get(key)
+
+class ClaudeProvider(_ClaudeRequestMixin, AIProvider):
+    """Anthropic Claude API integration optimized for neural processing simulation"""
+    
+    def __init__(self, api_key: str, base_url: str = "https://api.anthropic.com/v1/messages"):
+        super().__init__(api_key, base_url)
+        # Keep-alive pool whose connections report connect time (see TimedHTTPAdapter)
+        self.session = requests.Session()
+        adapter = TimedHTTPAdapter(pool_maxsize=32)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+    
+    def generate_response(self, prompt: str, model: str = "claude-3-5-sonnet-20241022", image_data: Optional[ImageData] = None, stats: Optional[Dict] = None) -> str:
+        """Generate response using Anthropic Claude API
+        
+        Pass a dict as ``stats`` to receive the call's token usage (``input_tokens``,
+        ``output_tokens``), phase timings (``phases``) and whether it was ``cached``.
+        """
+        data = self._build_request(prompt, model, image_data)
+        cache_key, cached = self._cache_lookup(data)
+        if cached is not None:
+            self._record_cache_hit(model, stats)
+            return cached
+        
+        with TRACER.span("claude.messages", self._span_attributes(data)) as span:
+            try:
+                reservation = self._reserve(data)
+                attempt = 0
+                while True:
+                    TimedHTTPAdapter.reset_connect_time()
+                    start = time.perf_counter()
+                    response = self.session.post(self.base_url, headers=dict(self._build_headers(), **self._trace_headers(span)), json=data, timeout=30)
+                    total = time.perf_counter() - start
+                    METRICS.inc("claude_api_requests_total", model=model, status=response.status_code)
+                    if not self._retry_rate_limited(reservation, response.status_code, response.headers.get("retry-after"), attempt):
+                        break
+                    attempt += 1
+                response.raise_for_status()
+                result = response.json()
+                text = self._parse_response(result)
+                self._record_call(model, result.get("usage"), self._phases(TimedHTTPAdapter.connect_time(), response.elapsed.total_seconds(), total), stats, span)
+                self._settle(reservation, data, text)
+                if cache_key is not None:
+                    self.response_cache.put(cache_key, text)
+                return text
+                
+            except requests.exceptions.RequestException as e:
+                raise self._api_error("API request failed", e, model)
+            except KeyError as e:
+                raise ClaudeAPIError(f"Unexpected response format: {str(e)}")
+    
+    @staticmethod
+    def _iter_sse_events(lines: Iterable[str]) -> Iterator[Tuple[str, Dict]]:
+        """Parse server-sent event lines into (event type, JSON data) pairs"""
+        event_type, data_lines = None, []
+        for line in lines:
+            if line:
+                if line.startswith("event:"):
+                    event_type = line[6:].strip()
+                elif line.startswith("data:"):
+                    data_lines.append(line[5:].strip())
+                continue
+            if data_lines:
+                data = json.loads("\n".join(data_lines))
+                yield event_type or data.get("type", "message"), data
+            event_type, data_lines = None, []
+        if data_lines:
+            data = json.loads("\n".join(data_lines))
+            yield event_type or data.get("type", "message"), data
+    
+    @staticmethod
+    def _iter_stream_lines(response: requests.Response) -> Iterator[str]:
+        """Yield decoded lines from a streamed response as soon as each one arrives
+        
+        ``iter_lines`` waits for fixed-size chunks, which holds back SSE events on
+        connections without chunked encoding, so read whatever is available instead.
+        """
+        read1 = getattr(response.raw, "read1", None)
+        chunks = iter(lambda: read1(8192), b"") if read1 else response.iter_content(chunk_size=None)
+        pending = b""
+        for chunk in chunks:
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                yield line.rstrip(b"\r").decode("utf-8")
+        if pending:
+            yield pending.rstrip(b"\r").decode("utf-8")
+    
+    def stream_response(self, prompt: str, model: str = "claude-3-5-sonnet-20241022", image_data: Optional[ImageData] = None, stats: Optional[Dict] = None) -> Iterator[str]:
+        """Stream a response from the Messages API, yielding text chunks as they arrive
+        
+        ``stats`` is filled as for ``generate_response`` once the stream has ended.
+        """
+        data = self._build_request(prompt, model, image_data)
+        cache_key, cached = self._cache_lookup(data)
+        if cached is not None:
+            self._record_cache_hit(model, stats)
+            yield cached
+            return
+        
+        chunks = []
+        usage = {}
+        with TRACER.span("claude.messages", dict(self._span_attributes(data), **{"gen_ai.request.stream": True}), activate=False) as span:
+            try:
+                reservation = self._reserve(data)
+                attempt = 0
+                while True:
+                    TimedHTTPAdapter.reset_connect_time()
+                    start = time.perf_counter()
+                    response = self.session.post(self.base_url, headers=dict(self._build_headers(), **self._trace_headers(span)), json=dict(data, stream=True), timeout=30, stream=True)
+                    connect = TimedHTTPAdapter.connect_time()
+                    METRICS.inc("claude_api_requests_total", model=model, status=response.status_code)
+                    # Rate limits arrive before any event, so the request can simply be sent again
+                    if not self._retry_rate_limited(reservation, response.status_code, response.headers.get("retry-after"), attempt):
+                        break
+                    response.close()
+                    attempt += 1
+                with response:
+                    response.raise_for_status()
+                    for event_type, event in self._iter_sse_events(self._iter_stream_lines(response)):
+                        if event_type == "content_block_delta" and event["delta"].get("type") == "text_delta":
+                            chunks.append(event["delta"]["text"])
+                            yield event["delta"]["text"]
+                        elif event_type == "message_start":
+                            usage.update(event.get("message", {}).get("usage") or {})
+                        elif event_type == "message_delta":
+                            usage.update(event.get("usage") or {})
+                        elif event_type == "error":
+                            raise ClaudeAPIError(f"Stream error: {event.get('error', {}).get('message', event)}")
             
-            result = response.json()
+            except requests.exceptions.RequestException as e:
+                raise self._api_error("API request failed", e, model)
+            except (KeyError, ValueError) as e:
+                raise ClaudeAPIError(f"Unexpected stream format: {str(e)}")
             
-            if 'content' in result and len(result['content']) > 0:
-                return result['content'][0]['text']
-            else:
+            if not chunks:
                 raise ClaudeAPIError("No content in Claude response")
-                
+            self._record_call(model, usage, self._phases(connect, response.elapsed.total_seconds(), time.perf_counter() - start), stats, span)
+        self._settle(reservation, data, "".join(chunks))
+        if cache_key is not None:
+            self.response_cache.put(cache_key, "".join(chunks))
+    
+    @property
+    def batches_url(self) -> str:
+        """Message Batches endpoint next to the configured Messages endpoint"""
+        return self.base_url.rstrip("/") + "/batches"
+    
+    def _batch_request(self, method: str, url: str, **kwargs) -> requests.Response:
+        try:
+            response = self.session.request(method, url, headers=self._build_headers(), timeout=60, **kwargs)
+            response.raise_for_status()
+            return response
         except requests.exceptions.RequestException as e:
-            raise ClaudeAPIError(f"API request failed: {str(e)}")
-        except KeyError as e:
-            raise ClaudeAPIError(f"Unexpected response format: {str(e)}")
+            raise self._api_error("Batch API request failed", e)
+    
+    def create_message_batch(self, batch_requests: List[Dict]) -> Dict:
+        """Submit ``[{"custom_id": ..., "params": <Messages request>}, ...]`` as one batch job"""
+        return self._batch_request("POST", self.batches_url, json={"requests": batch_requests}).json()
+    
+    def get_message_batch(self, batch_id: str) -> Dict:
+        """Fetch a batch's status (``processing_status`` is ``"ended"`` once results are ready)"""
+        return self._batch_request("GET", f"{self.batches_url}/{batch_id}").json()
+    
+    def iter_message_batch_results(self, batch: Dict) -> Iterator[Dict]:
+        """Yield the JSONL result entries (``custom_id`` and ``result``) of an ended batch"""
+        results_url = batch.get("results_url") or f"{self.batches_url}/{batch['id']}/results"
+        response = self._batch_request("GET", results_url, stream=True)
+        with response:
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
     
     def test_connection(self) -> bool:
         """Test Anthropic Claude API connection"""
@@ -155,24 +823,640 @@ class ClaudeProvider(AIProvider):
             return False
 
 
+class AsyncClaudeProvider(_ClaudeRequestMixin):
+    """asyncio-native Claude provider sharing one keep-alive connection pool
+    
+    Requires ``aiohttp``. The pool is created lazily inside the running event loop
+    (and recreated if the provider is later used from another loop, e.g. a second
+    ``asyncio.run``); call ``close()`` (or use ``async with``) when finished with it.
+    A sibling of ``ClaudeProvider`` rather than a subclass, since its methods are
+    coroutines.
+    """
+    
+    def __init__(self, api_key: str, base_url: str = "https://api.anthropic.com/v1/messages",
+                 max_connections: int = 100, max_connections_per_host: int = 50,
+                 timeout: float = 30.0, keepalive_timeout: float = 30.0):
+        if aiohttp is None:
+            raise ImportError("AsyncClaudeProvider requires aiohttp. Install it with 'pip install aiohttp'.")
+        super().__init__(api_key, base_url)
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+        self._session_loop = None
+    
+    def _get_session(self):
+        """Return the shared client session, creating the connection pool on first use in this event loop"""
+        loop = asyncio.get_running_loop()
+        if self._session is not None and self._session_loop is not loop:
+            # A session cannot outlive its loop; the old loop is gone, so just drop it
+            self._session.detach()
+            self._session = None
+        if self._session is None or self._session.closed:
+            self._session_loop = loop
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_start.append(self._on_connection_create_start)
+            trace_config.on_connection_create_end.append(self._on_connection_create_end)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self._build_headers(),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[trace_config]
+            )
+        return self._session
+    
+    @staticmethod
+    async def _on_connection_create_start(session, context, params):
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx["connect_start"] = time.perf_counter()
+    
+    @staticmethod
+    async def _on_connection_create_end(session, context, params):
+        timings = context.trace_request_ctx
+        if timings is not None and "connect_start" in timings:
+            timings["connect"] = timings.get("connect", 0.0) + time.perf_counter() - timings.pop("connect_start")
+    
+    async def generate_response(self, prompt: str, model: str = "claude-3-5-sonnet-20241022", image_data: Optional[ImageData] = None, stats: Optional[Dict] = None) -> str:
+        """Generate response using Anthropic Claude API without blocking the event loop
+        
+        ``stats`` is filled as for ``ClaudeProvider.generate_response``.
+        """
+        data = self._build_request(prompt, model, image_data)
+        cache_key, cached = self._cache_lookup(data)
+        if cached is not None:
+            self._record_cache_hit(model, stats)
+            return cached
+        
+        with TRACER.span("claude.messages", self._span_attributes(data)) as span:
+            try:
+                # The limiter blocks, so wait for it on a worker thread rather than the event loop
+                reservation = await asyncio.to_thread(self._reserve, data)
+                attempt = 0
+                while True:
+                    timings = {}
+                    start = time.perf_counter()
+                    async with self._get_session().post(self.base_url, json=data, headers=self._trace_headers(span), trace_request_ctx=timings) as response:
+                        headers = time.perf_counter() - start
+                        METRICS.inc("claude_api_requests_total", model=model, status=response.status)
+                        if await asyncio.to_thread(self._retry_rate_limited, reservation, response.status, response.headers.get("retry-after"), attempt):
+                            attempt += 1
+                            continue
+                        response.raise_for_status()
+                        result = await response.json()
+                        total = time.perf_counter() - start
+                        text = self._parse_response(result)
+                    break
+                self._record_call(model, result.get("usage"), self._phases(timings.get("connect", 0.0), headers, total), stats, span)
+                self._settle(reservation, data, text)
+                if cache_key is not None:
+                    self.response_cache.put(cache_key, text)
+                return text
+            
+            except aiohttp.ClientResponseError as e:
+                raise ClaudeAPIError.from_http_error(f"API request failed: {str(e)}", e.status, e.headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                METRICS.inc("claude_api_requests_total", model=model, status="error")
+                raise ClaudeAPIError(f"API request failed: {str(e)}")
+            except KeyError as e:
+                raise ClaudeAPIError(f"Unexpected response format: {str(e)}")
+    
+    async def test_connection(self) -> bool:
+        """Test Anthropic Claude API connection"""
+        try:
+            test_prompt = "Respond with 'Connection successful' if you can process this message."
+            response = await self.generate_response(test_prompt, "claude-3-5-haiku-20241022")
+            return "successful" in response.lower() or len(response) > 0
+        except Exception:
+            return False
+    
+    async def close(self):
+        """Close the pooled connections"""
+        if self._session is not None and not self._session.closed:
+            if self._session_loop is asyncio.get_running_loop():
+                await self._session.close()
+            else:
+                self._session.detach()
+        self._session = None
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+class _MockBehaviorMixin:
+    """Simulated outcomes and in-memory message batches shared by ``MockProvider`` and ``AsyncMockProvider``"""
+    
+    def __init__(self, behavior: Optional[MockBehavior] = None, batch_seconds: float = 0.0, **behavior_options):
+        super().__init__("mock-key", "mock://messages")
+        self.behavior = behavior or MockBehavior(**behavior_options)
+        self.batches = MockBatches(self.behavior, batch_seconds)
+    
+    def _check(self, outcome: Dict):
+        if outcome["status"] != 200:
+            raise ClaudeAPIError.from_http_error(f"API request failed: {outcome['status']} (mock)", outcome["status"],
+                                                 {"retry-after": str(self.behavior.retry_after)})
+
+
+class MockProvider(_MockBehaviorMixin, ClaudeProvider):
+    """Offline provider answering from a ``mock_api.MockBehavior`` instead of the network
+    
+    Goes through the same cache, rate limiter, retry, metrics and tracing paths as
+    ``ClaudeProvider``, with simulated latency, injected 429/5xx errors and
+    configurable output sizes, so pathway runs can be benchmarked and tested
+    deterministically. Pass a ``behavior`` or its options, e.g.
+    ``MockProvider(latency=0.2, distribution="lognormal", error_rate=0.05)``.
+    Message batches are kept in memory and end ``batch_seconds`` after creation.
+    """
+    
+    def _plan(self, data: Dict, reservation: Optional[Reservation], share: float = 1.0) -> Dict:
+        """Decide the outcome of a request, retrying simulated rate limits like a real 429
+        
+        Sleeps for ``share`` of the sampled latency (the time to the first byte, for streams).
+        """
+        attempt = 0
+        while True:
+            outcome = self.behavior.plan(data)
+            time.sleep(outcome["latency"] * share)
+            METRICS.inc("claude_api_requests_total", model=data["model"], status=outcome["status"])
+            if not self._retry_rate_limited(reservation, outcome["status"], str(self.behavior.retry_after), attempt):
+                return outcome
+            attempt += 1
+    
+    def generate_response(self, prompt: str, model: str = "claude-3-5-sonnet-20241022", image_data: Optional[ImageData] = None, stats: Optional[Dict] = None) -> str:
+        data = self._build_request(prompt, model, image_data)
+        cache_key, cached = self._cache_lookup(data)
+        if cached is not None:
+            self._record_cache_hit(model, stats)
+            return cached
+        
+        with TRACER.span("claude.messages", self._span_attributes(data)) as span:
+            reservation = self._reserve(data)
+            outcome = self._plan(data, reservation)
+            self._check(outcome)
+            self._record_call(model, outcome["usage"], self._phases(0.0, outcome["latency"], outcome["latency"]), stats, span)
+        self._settle(reservation, data, outcome["text"])
+        if cache_key is not None:
+            self.response_cache.put(cache_key, outcome["text"])
+        return outcome["text"]
+    
+    def stream_response(self, prompt: str, model: str = "claude-3-5-sonnet-20241022", image_data: Optional[ImageData] = None, stats: Optional[Dict] = None) -> Iterator[str]:
+        data = self._build_request(prompt, model, image_data)
+        cache_key, cached = self._cache_lookup(data)
+        if cached is not None:
+            self._record_cache_hit(model, stats)
+            yield cached
+            return
+        
+        with TRACER.span("claude.messages", dict(self._span_attributes(data), **{"gen_ai.request.stream": True}), activate=False) as span:
+            reservation = self._reserve(data)
+            start = time.perf_counter()
+            # Like the mock server: a third of the latency to the first chunk, the rest spread over the chunks
+            outcome = self._plan(data, reservation, share=1 / 3)
+            self._check(outcome)
+            text = outcome["text"]
+            chunks = [text[i:i + 32] for i in range(0, len(text), 32)]
+            for chunk in chunks:
+                time.sleep(outcome["latency"] * 2 / 3 / len(chunks))
+                yield chunk
+            total = time.perf_counter() - start
+            self._record_call(model, outcome["usage"], self._phases(0.0, outcome["latency"] / 3, total), stats, span)
+        self._settle(reservation, data, text)
+        if cache_key is not None:
+            self.response_cache.put(cache_key, text)
+    
+    def create_message_batch(self, batch_requests: List[Dict]) -> Dict:
+        return self.batches.status(self.batches.create(batch_requests))
+    
+    def get_message_batch(self, batch_id: str) -> Dict:
+        batch = self.batches.get(batch_id)
+        if batch is None:
+            raise ClaudeAPIError(f"Batch API request failed: unknown batch {batch_id}", 404)
+        return self.batches.status(batch)
+    
+    def iter_message_batch_results(self, batch: Dict) -> Iterator[Dict]:
+        stored = self.batches.get(batch["id"])
+        if stored is None or not MockBatches.ended(stored):
+            raise ClaudeAPIError(f"Batch API request failed: batch {batch['id']} has not ended", 409)
+        yield from stored["results"]
+
+
+class AsyncMockProvider(_MockBehaviorMixin, _ClaudeRequestMixin):
+    """asyncio counterpart of ``MockProvider``; simulated latency awaits instead of blocking"""
+    
+    async def generate_response(self, prompt: str, model: str = "claude-3-5-sonnet-20241022", image_data: Optional[ImageData] = None, stats: Optional[Dict] = None) -> str:
+        data = self._build_request(prompt, model, image_data)
+        cache_key, cached = self._cache_lookup(data)
+        if cached is not None:
+            self._record_cache_hit(model, stats)
+            return cached
+        
+        with TRACER.span("claude.messages", self._span_attributes(data)) as span:
+            reservation = await asyncio.to_thread(self._reserve, data)
+            attempt = 0
+            while True:
+                outcome = self.behavior.plan(data)
+                await asyncio.sleep(outcome["latency"])
+                METRICS.inc("claude_api_requests_total", model=model, status=outcome["status"])
+                if not await asyncio.to_thread(self._retry_rate_limited, reservation, outcome["status"], str(self.behavior.retry_after), attempt):
+                    break
+                attempt += 1
+            self._check(outcome)
+            self._record_call(model, outcome["usage"], self._phases(0.0, outcome["latency"], outcome["latency"]), stats, span)
+        self._settle(reservation, data, outcome["text"])
+        if cache_key is not None:
+            self.response_cache.put(cache_key, outcome["text"])
+        return outcome["text"]
+    
+    async def test_connection(self) -> bool:
+        return True
+    
+    async def close(self):
+        pass
+
+
+class ModelRouter:
+    """Adaptive per-step model selection driven by measured latency, errors and output length
+    
+    Keeps a rolling window of latency, success and output-length samples for every
+    (step, model) pair. Each step starts from the provider's default model
+    (``get_optimal_model_for_step``); when the pathway's estimated p95 latency
+    (the sum of per-step p95s) exceeds ``latency_slo`` seconds, or its estimated cost
+    exceeds ``cost_budget`` dollars per run, steps are moved to faster or cheaper
+    models, picking the move that saves the most per tier of model quality given up.
+    
+    Models are skipped while cooling down after a rate limit (429/529) and when
+    their measured error rate exceeds ``max_error_rate``, or their outputs on a step
+    are much shorter than the default model's (a cheap proxy for quality loss).
+    Statistics persist across runs via ``save()``/``state_path``.
+    """
+    
+    QUALITY_RANK = {"low": 1, "high": 2, "premium": 3}
+    RATE_LIMIT_STATUSES = (429, 529)
+    
+    def __init__(self, latency_slo: Optional[float] = None, cost_budget: Optional[float] = None,
+                 window: int = 200, min_samples: int = 5, max_error_rate: float = 0.2,
+                 min_output_ratio: float = 0.5, rate_limit_cooldown: float = 30.0,
+                 explore_rate: float = 0.05, state_path: Optional[Union[str, Path]] = None, seed: Optional[int] = None):
+        self.latency_slo = latency_slo
+        self.cost_budget = cost_budget
+        self.window = window
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.min_output_ratio = min_output_ratio
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self.explore_rate = explore_rate
+        self.state_path = Path(state_path) if state_path else None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        # (step, model) -> {"latency": deque, "ok": deque, "output_chars": deque, "input_tokens": deque, "rate_limited": int}
+        self._samples: Dict[Tuple[int, str], Dict] = {}
+        self._cooldown_until: Dict[str, float] = {}
+        if self.state_path is not None and self.state_path.exists():
+            self.load(self.state_path)
+    
+    def _entry(self, step: int, model: str) -> Dict:
+        key = (step, model)
+        if key not in self._samples:
+            self._samples[key] = {name: deque(maxlen=self.window) for name in ("latency", "ok", "output_chars", "input_tokens")}
+            self._samples[key]["rate_limited"] = 0
+        return self._samples[key]
+    
+    def record(self, step: int, model: str, latency: float, output_chars: int = 0, input_tokens: int = 0, error: Optional[Exception] = None):
+        """Add one observed call; rate-limit errors start a cooldown instead of counting as failures"""
+        status_code = getattr(error, "status_code", None)
+        with self._lock:
+            entry = self._entry(step, model)
+            if status_code in self.RATE_LIMIT_STATUSES:
+                entry["rate_limited"] += 1
+                retry_after = getattr(error, "retry_after", None)
+                self._cooldown_until[model] = time.monotonic() + (retry_after if retry_after is not None else self.rate_limit_cooldown)
+                return
+            entry["ok"].append(error is None)
+            entry["input_tokens"].append(input_tokens)
+            if error is None:
+                entry["latency"].append(latency)
+                entry["output_chars"].append(output_chars)
+    
+    def is_cooling_down(self, model: str) -> bool:
+        return self._cooldown_until.get(model, 0.0) > time.monotonic()
+    
+    @staticmethod
+    def _percentile(values: Iterable[float], percentile: float) -> float:
+        """Nearest-rank percentile of ``values``"""
+        ordered = sorted(values)
+        return ordered[max(0, math.ceil(percentile / 100 * len(ordered)) - 1)]
+    
+    def _pooled(self, step: int, model: str, name: str) -> List[float]:
+        """Samples for (step, model), or for the model across all steps if the step has too few"""
+        entry = self._samples.get((step, model))
+        if entry is not None and len(entry[name]) >= self.min_samples:
+            return list(entry[name])
+        pooled = [value for (_, other), samples in self._samples.items() if other == model for value in samples[name]]
+        return pooled if len(pooled) >= self.min_samples else []
+    
+    def _p95(self, step: int, model: str) -> Optional[float]:
+        latencies = self._pooled(step, model, "latency")
+        return self._percentile(latencies, 95) if latencies else None
+    
+    def _cost(self, step: int, model: str, models: Dict[str, Dict]) -> Optional[float]:
+        input_tokens = self._pooled(step, model, "input_tokens")
+        output_chars = self._pooled(step, model, "output_chars")
+        config = models.get(model, {})
+        if not input_tokens or not output_chars or "input_cost_per_mtok" not in config:
+            return None
+        output_tokens = sum(output_chars) / len(output_chars) / ContextCompactor.CHARS_PER_TOKEN
+        mean_input = sum(input_tokens) / len(input_tokens)
+        return (mean_input * config["input_cost_per_mtok"] + output_tokens * config["output_cost_per_mtok"]) / 1_000_000
+    
+    def _eligible(self, step: int, model: str, default: str) -> bool:
+        if self.is_cooling_down(model):
+            return False
+        entry = self._samples.get((step, model))
+        if entry is not None and len(entry["ok"]) >= self.min_samples:
+            if entry["ok"].count(False) / len(entry["ok"]) > self.max_error_rate:
+                return False
+        default_entry = self._samples.get((step, default))
+        if model != default and entry is not None and default_entry is not None \
+                and len(entry["output_chars"]) >= self.min_samples and len(default_entry["output_chars"]) >= self.min_samples:
+            mean_chars = sum(entry["output_chars"]) / len(entry["output_chars"])
+            default_chars = sum(default_entry["output_chars"]) / len(default_entry["output_chars"])
+            if mean_chars < self.min_output_ratio * default_chars:
+                return False
+        return True
+    
+    def _rank(self, model: str, models: Dict[str, Dict]) -> int:
+        return self.QUALITY_RANK.get(models.get(model, {}).get("cost_tier"), 0)
+    
+    def _fallback(self, step: int, default: str, models: Dict[str, Dict]) -> str:
+        """Closest-quality eligible model to ``default``, preferring cheaper ones on ties"""
+        candidates = [model for model in models if self._eligible(step, model, default)]
+        if not candidates:
+            return default
+        default_rank = self._rank(default, models)
+        return min(candidates, key=lambda model: (abs(self._rank(model, models) - default_rank), self._rank(model, models)))
+    
+    def plan(self, pathway: Iterable[int], provider: "_ClaudeRequestMixin") -> Dict[int, str]:
+        """Choose a model for every step in ``pathway`` under the latency SLO and cost budget"""
+        models = provider.models
+        with self._lock:
+            defaults = {step: provider.get_optimal_model_for_step(step) for step in pathway}
+            plan = {step: default if self._eligible(step, default, default) else self._fallback(step, default, models)
+                    for step, default in defaults.items()}
+            for metric, limit in ((self._p95, self.latency_slo), (lambda s, m: self._cost(s, m, models), self.cost_budget)):
+                if limit is not None:
+                    self._reduce(plan, defaults, models, metric, limit)
+            return plan
+    
+    def _reduce(self, plan: Dict[int, str], defaults: Dict[int, str], models: Dict[str, Dict], metric, limit: float):
+        """Greedily swap step models until the summed ``metric`` estimate fits ``limit``"""
+        while True:
+            estimates = {step: metric(step, model) for step, model in plan.items()}
+            if sum(value or 0.0 for value in estimates.values()) <= limit:
+                return
+            best, best_value = None, 0.0
+            for step, model in plan.items():
+                if estimates[step] is None:
+                    continue
+                for candidate in models:
+                    if candidate == model or not self._eligible(step, candidate, defaults[step]):
+                        continue
+                    candidate_estimate = metric(step, candidate)
+                    if candidate_estimate is None or candidate_estimate >= estimates[step]:
+                        continue
+                    quality_loss = max(0, self._rank(model, models) - self._rank(candidate, models))
+                    value = (estimates[step] - candidate_estimate) / (1 + quality_loss)
+                    if value > best_value:
+                        best, best_value = (step, candidate), value
+            if best is None:
+                return
+            plan[best[0]] = best[1]
+    
+    def choose_model(self, step: int, pathway: Iterable[int], provider: "_ClaudeRequestMixin") -> str:
+        """Model for one step; occasionally explores another eligible model to keep statistics fresh"""
+        model = self.plan(pathway, provider)[step]
+        if self.explore_rate and self._random.random() < self.explore_rate:
+            default = provider.get_optimal_model_for_step(step)
+            with self._lock:
+                others = [candidate for candidate in provider.models if candidate != model and self._eligible(step, candidate, default)]
+            if others:
+                return self._random.choice(others)
+        return model
+    
+    def fallback_model(self, step: int, failed_model: str, provider: "_ClaudeRequestMixin") -> Optional[str]:
+        """Alternative to a rate-limited model, or None if every other model is unavailable"""
+        with self._lock:
+            models = {model: config for model, config in provider.models.items() if model != failed_model}
+            candidates = [model for model in models if not self.is_cooling_down(model)]
+            if not candidates:
+                return None
+            rank = self._rank(failed_model, provider.models)
+            return min(candidates, key=lambda model: (abs(self._rank(model, models) - rank), self._rank(model, models)))
+    
+    def stats(self) -> Dict[str, Dict[str, Union[int, float, None]]]:
+        """Per "step:model" latency percentiles, error rate and output-length summary"""
+        with self._lock:
+            report = {}
+            for (step, model), entry in sorted(self._samples.items()):
+                latencies, ok, output_chars = list(entry["latency"]), entry["ok"], entry["output_chars"]
+                report[f"{step}:{model}"] = {
+                    "samples": len(ok),
+                    "p50": self._percentile(latencies, 50) if latencies else None,
+                    "p95": self._percentile(latencies, 95) if latencies else None,
+                    "p99": self._percentile(latencies, 99) if latencies else None,
+                    "error_rate": ok.count(False) / len(ok) if ok else 0.0,
+                    "mean_output_chars": sum(output_chars) / len(output_chars) if output_chars else None,
+                    "rate_limited": entry["rate_limited"]
+                }
+            return report
+    
+    def save(self, path: Optional[Union[str, Path]] = None):
+        """Write the rolling statistics as JSON (to ``state_path`` by default)
+        
+        Each save writes its own temporary file and swaps it in under a lock, so
+        concurrent saves never clobber one another's half-written state.
+        """
+        path = Path(path or self.state_path)
+        with self._lock:
+            state = {
+                "window": self.window,
+                "samples": [
+                    {"step": step, "model": model, "rate_limited": entry["rate_limited"],
+                     **{name: list(entry[name]) for name in ("latency", "ok", "output_chars", "input_tokens")}}
+                    for (step, model), entry in self._samples.items()
+                ]
+            }
+        with self._save_lock:
+            tmp_file = tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=path.parent, prefix=path.name + ".", suffix=".tmp", delete=False)
+            try:
+                with tmp_file:
+                    json.dump(state, tmp_file)
+                Path(tmp_file.name).replace(path)
+            except BaseException:
+                Path(tmp_file.name).unlink(missing_ok=True)
+                raise
+    
+    def load(self, path: Union[str, Path]):
+        """Replace the statistics with those saved at ``path``"""
+        state = json.loads(Path(path).read_text(encoding="utf-8"))
+        with self._lock:
+            self._samples = {}
+            for saved in state["samples"]:
+                entry = self._entry(saved["step"], saved["model"])
+                for name in ("latency", "ok", "output_chars", "input_tokens"):
+                    entry[name].extend(saved[name])
+                entry["rate_limited"] = saved["rate_limited"]
+
+
+@dataclass
+class RetryPolicy:
+    """How failed step calls are retried
+    
+    Transient failures (connection errors and the HTTP statuses in ``retry_statuses``)
+    are retried up to ``max_attempts`` calls in total with full-jitter exponential
+    backoff, never waiting less than a server-provided Retry-After.
+    """
+    max_attempts: int = 3
+    backoff_base: float = 1.0
+    backoff_max: float = 30.0
+    retry_statuses: Tuple[int, ...] = (408, 429, 500, 502, 503, 504, 529)
+    
+    def should_retry(self, error: ClaudeAPIError, attempt: int) -> bool:
+        if attempt >= self.max_attempts:
+            return False
+        return error.status_code is None or error.status_code in self.retry_statuses
+    
+    def delay(self, attempt: int, error: Optional[ClaudeAPIError] = None) -> float:
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1))))
+        if error is not None and error.retry_after is not None:
+            delay = max(delay, min(error.retry_after, self.backoff_max))
+        return delay
+
+class JobJournal:
+    """Append-only JSONL record of a simulation job
+    
+    The first line describes the job (id, inputs, options); every finished step adds
+    a ``result`` line and every stimulus that gives up adds a ``failure`` line. Each
+    line is flushed and fsynced before the call returns, so a crash loses at most the
+    step that was in flight; a torn final line is cut off when the journal is replayed.
+    """
+    
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+    
+    def exists(self) -> bool:
+        return self.path.exists()
+    
+    def append(self, record: Dict):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as journal:
+                journal.write(line)
+                journal.flush()
+                os.fsync(journal.fileno())
+    
+    def _truncate_torn_tail(self):
+        """Drop a partial last line left by a crash mid-write so new records start on a fresh line"""
+        with self._lock, open(self.path, "rb+") as journal:
+            end = journal.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(0, position - 65536)
+                journal.seek(start)
+                chunk = journal.read(position - start)
+                newline = chunk.rfind(b"\n")
+                if newline != -1:
+                    position = start + newline + 1
+                    break
+                position = start
+            if position != end:
+                journal.truncate(position)
+    
+    def records(self) -> Iterator[Dict]:
+        with open(self.path, "r", encoding="utf-8") as journal:
+            for line in journal:
+                yield json.loads(line)
+    
+    def replay(self) -> Tuple[Dict, Dict[int, Dict[int, ProcessingResult]], Dict[int, Dict]]:
+        """Return (job header, successful results by item and step, last failure by item)"""
+        self._truncate_torn_tail()
+        header, completed, failures = None, {}, {}
+        for record in self.records():
+            kind = record.get("type")
+            if kind == "job":
+                header = record
+            elif kind == "result":
+                result = ProcessingResult(**record["result"])
+                completed.setdefault(record["item"], {})[result.step] = result
+                failures.pop(record["item"], None)
+            elif kind == "failure":
+                failures[record["item"]] = record
+        if header is None:
+            raise ValueError(f"{self.path} is not a job journal")
+        return header, completed, failures
+
+
 class VisualProcessingSimulator:
     """Main simulator class that orchestrates the visual processing pipeline using Claude AI"""
     
-    def __init__(self, claude_api_key: str = None):
+    def __init__(self, claude_api_key: str = None, response_cache: Optional[ResponseCache] = None, context_compactor: Optional[ContextCompactor] = None, model_router: Optional[ModelRouter] = None):
         self.claude_provider = None
+        self.async_claude_provider = None
+        self.response_cache = response_cache
+        # Optional ContextCompactor applied to the upstream output forwarded between steps
+        self.context_compactor = context_compactor
+        # Optional ModelRouter replacing the fixed per-step model choice when use_optimal_models is set
+        self.model_router = model_router
+        # Optional RetryPolicy for failed steps; None keeps the single-attempt behaviour
+        self.retry_policy: Optional[RetryPolicy] = None
+        # Optional memory index (e.g. memory_embeddings.EmbeddingIndex) searched for steps with recall_memories
+        self.memory_recall = None
+        self.memory_recall_k = 3
+        self.memory_recall_min_score = 0.1
+        # Downscales, recompresses and (optionally) tiles image stimuli; None uploads files unchanged
+        self.image_preprocessor: Optional[ImagePreprocessor] = ImagePreprocessor()
         if claude_api_key:
-            self.claude_provider = ClaudeProvider(claude_api_key)
+            self.set_claude_api_key(claude_api_key)
         self.processing_steps = self._initialize_processing_steps()
         self.results = []
         self.processing_metadata = {
             "total_tokens_used": 0,
+            "input_tokens_used": 0,
+            "output_tokens_used": 0,
             "total_processing_time": 0.0,
             "model_usage": {}
         }
+        self._metadata_lock = threading.Lock()
+        self._router_saves_deferred = 0  # Batches in progress; they save the router's state once at the end
     
     def set_claude_api_key(self, api_key: str):
         """Set or update Claude API key"""
         self.claude_provider = ClaudeProvider(api_key)
+        self.claude_provider.response_cache = self.response_cache
+        # Rebuilt from the new key on the next async run
+        self.async_claude_provider = None
+    
+    def set_provider(self, provider: ClaudeProvider):
+        """Use ``provider`` (e.g. a ``MockProvider`` or a ClaudeProvider pointed at a proxy) for all steps"""
+        self.claude_provider = provider
+        self.claude_provider.response_cache = self.response_cache
+        self.async_claude_provider = None
+    
+    def set_response_cache(self, cache: Optional[ResponseCache]):
+        """Attach (or detach with None) a response cache shared by all providers"""
+        self.response_cache = cache
+        for provider in (self.claude_provider, self.async_claude_provider):
+            if provider is not None:
+                provider.response_cache = cache
     
     def test_claude_connection(self) -> bool:
         """Test Claude API connection"""
@@ -197,6 +1481,7 @@ class VisualProcessingSimulator:
                 brain_region="Retinal Ganglion Cells",
                 process="Parasol (M-type) cells project to magnocellular LGN layers, midget (P-type) cells target parvocellular layers",
                 routing="Signals routed to LGN via optic nerve",
+                depends_on=(1,),
                 ai_prompt="You are retinal ganglion cells receiving input from photoreceptors. Your function is to organize visual information into parallel processing streams. Create three distinct pathway outputs: Magnocellular (M) pathway for luminance changes and motion, Parvocellular (P) pathway for color information and fine spatial detail, and Koniocellular (K) pathway for blue-yellow color opponency. Process this retinal input and describe the signals sent via each pathway:"
             ),
             ProcessingStep(
@@ -205,6 +1490,7 @@ class VisualProcessingSimulator:
                 brain_region="Lateral Geniculate Nucleus (LGN)",
                 process="Magnocellular layers process motion, parvocellular layers process color/form",
                 routing="Optic radiations project to V1",
+                depends_on=(2,),
                 ai_prompt="You are the Lateral Geniculate Nucleus (LGN), the thalamic relay station for visual information. Your role is to receive organized input from retinal ganglion cells, enhance contrast and edge detection, modulate signals based on attention and arousal, organize retinotopic mapping, and prepare information for cortical processing. Process the ganglion cell input and describe the enhanced signals being sent to primary visual cortex:"
             ),
             ProcessingStep(
@@ -213,6 +1499,7 @@ class VisualProcessingSimulator:
                 brain_region="Primary Visual Cortex (V1)",
                 process="Simple/complex cells detect edges, orientations, spatial frequencies",
                 routing="Information splits to ventral and dorsal streams",
+                depends_on=(3,),
                 ai_prompt="You are the primary visual cortex (V1), the first cortical processing stage. Your function includes simple cells detecting specific edge orientations and spatial frequencies, complex cells combining simple cell outputs for position-invariant edge detection, hypercolumns organizing orientation and color processing, and binocular integration processing depth information. Analyze the LGN input and extract basic visual features, creating a detailed feature map:"
             ),
             ProcessingStep(
@@ -221,6 +1508,7 @@ class VisualProcessingSimulator:
                 brain_region="V2/V4",
                 process="V2 processes texture, depth; V4 handles color constancy and forms",
                 routing="Processed information sent to inferotemporal cortex",
+                depends_on=(4,),
                 ai_prompt="You are the ventral stream areas V2 and V4, part of the 'what' pathway for object identification. V2 processes complex contours, textures, and figure-ground segregation. V4 handles color constancy, intermediate shape complexity, and attention-modulated responses. Integrate multiple feature dimensions and prepare for high-level object recognition. Analyze the V1 feature map and process complex visual properties for object identification:"
             ),
             ProcessingStep(
@@ -229,6 +1517,7 @@ class VisualProcessingSimulator:
                 brain_region="MT/MST",
                 process="MT detects coherent motion; MST analyzes optic flow",
                 routing="Motion information sent to posterior parietal cortex",
+                depends_on=(4,),
                 ai_prompt="You are the dorsal stream areas MT (Middle Temporal) and MST (Medial Superior Temporal), part of the 'where/how' pathway. MT detects coherent motion patterns and direction selectivity. MST analyzes complex optic flow patterns and self-motion. Process spatial relationships and integrate with attention and eye movement systems. Analyze motion and spatial information from the V1 input:"
             ),
             ProcessingStep(
@@ -237,6 +1526,7 @@ class VisualProcessingSimulator:
                 brain_region="Inferotemporal Cortex (IT)",
                 process="View-invariant object representations, categorical processing",
                 routing="Object information sent to perirhinal cortex",
+                depends_on=(5, 6),
                 ai_prompt="You are the Inferotemporal (IT) cortex, the final stage of the ventral visual pathway specializing in object recognition. Your functions include creating view-invariant object representations, categorical processing (faces, objects, scenes), integration of shape, color, and texture information, connection to semantic memory systems, and high-level visual categorization. Process the ventral stream input and provide object recognition and categorization:"
             ),
             ProcessingStep(
@@ -245,6 +1535,8 @@ class VisualProcessingSimulator:
                 brain_region="Perirhinal Cortex",
                 process="Compare visual input with stored memories, semantic associations",
                 routing="Integrated information contributes to conscious perception",
+                depends_on=(7,),
+                recall_memories=True,
                 ai_prompt="You are the perirhinal cortex and associated memory systems, responsible for integrating visual perception with stored knowledge. Your functions include comparing visual input with long-term memory representations, semantic association and contextual understanding, familiarity detection and novel object processing, integration with hippocampal memory systems, and contributing to conscious visual experience. Integrate the object recognition results with memory and provide the final conscious perception:"
             )
         ]
@@ -258,6 +1550,7 @@ class VisualProcessingSimulator:
                 "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
                 "total_steps": len(results),
                 "total_processing_time": self.processing_metadata["total_processing_time"],
+                "total_tokens_used": self.processing_metadata["total_tokens_used"],
                 "model_usage": self.processing_metadata["model_usage"]
             },
             "processing_steps": [
@@ -267,7 +1560,11 @@ class VisualProcessingSimulator:
                     "input": r.input_data,
                     "output": r.output,
                     "processing_time": r.processing_time,
-                    "model": r.model_used
+                    "model": r.model_used,
+                    "fingerprint": r.fingerprint,
+                    "input_tokens": r.input_tokens,
+                    "output_tokens": r.output_tokens,
+                    "metadata": r.metadata
                 }
                 for r in results
             ]
@@ -287,111 +1584,929 @@ class VisualProcessingSimulator:
         else:
             raise ValueError("Unsupported format. Use 'json' or 'csv'")
 
+    def export_results_to(self, results: Iterable[ProcessingResult], target, format: Optional[str] = None, compression: Optional[str] = None, append: bool = False, **extra) -> int:
+        """Stream results to a file or binary stream without building the export in memory
+        
+        ``results`` may be any iterable, e.g. a generator over a batch job. ``format``
+        (jsonl, csv, parquet or arrow) and ``compression`` (gzip or zstd) default to the
+        file name's suffixes; ``append`` adds to an existing JSON-lines or CSV file.
+        ``extra`` keyword arguments become constant columns (e.g. ``run="2024-06-01"``).
+        Returns the number of rows written.
+        """
+        with open_result_writer(target, format, compression, append) as writer:
+            return writer.write_many(results, **extra)
+    
+    @staticmethod
+    def _result_from_entry(entry: Dict) -> ProcessingResult:
+        return ProcessingResult(
+            step=int(entry["step"]),
+            brain_region=entry["brain_region"],
+            input_data=entry["input"],
+            output=entry["output"],
+            processing_time=float(entry["processing_time"]),
+            model_used=entry["model"],
+            fingerprint=entry.get("fingerprint") or "",
+            input_tokens=int(entry.get("input_tokens") or 0),
+            output_tokens=int(entry.get("output_tokens") or 0),
+            metadata=entry.get("metadata") or {}
+        )
+    
+    @staticmethod
+    def load_results(exported_json: str) -> List[ProcessingResult]:
+        """Rebuild ProcessingResults from an ``export_results`` JSON string"""
+        export_data = json.loads(exported_json)
+        return [VisualProcessingSimulator._result_from_entry(entry) for entry in export_data["processing_steps"]]
+    
+    @staticmethod
+    def iter_exported_results(path: Union[str, Path], compression: Optional[str] = None) -> Iterator[ProcessingResult]:
+        """Lazily rebuild ProcessingResults from an ``export_results_to`` file (any of its formats)"""
+        for entry in iter_records(path, compression):
+            yield VisualProcessingSimulator._result_from_entry(entry)
+
     def get_model_recommendations(self) -> Dict[str, str]:
-        """Get model recommendations for different use cases"""
-        return {
+        """Get model recommendations for different use cases
+        
+        With a model router and API key configured, the router's current per-step
+        choices are included as ``adaptive_step_<n>`` entries.
+        """
+        recommendations = {
             "educational_demo": "claude-3-5-haiku-20241022",
             "research_accuracy": "claude-3-5-sonnet-20241022", 
             "premium_analysis": "claude-3-opus-20240229",
             "cost_optimized": "claude-3-5-haiku-20241022",
             "balanced_performance": "claude-3-5-sonnet-20241022"
         }
+        if self.model_router is not None and self.claude_provider is not None:
+            plan = self.model_router.plan([step.sequence for step in self.processing_steps], self.claude_provider)
+            recommendations.update({f"adaptive_step_{step}": model for step, model in plan.items()})
+        return recommendations
+    
+    def _record_model_usage(self, model: str, processing_time: float, cached: bool = False):
+        """Update shared usage counters (safe to call from worker threads)
+        
+        Cache hits made no API call, so they only refresh the cache statistics.
+        """
+        with self._metadata_lock:
+            if not cached:
+                if model not in self.processing_metadata["model_usage"]:
+                    self.processing_metadata["model_usage"][model] = 0
+                self.processing_metadata["model_usage"][model] += 1
+                self.processing_metadata["total_processing_time"] += processing_time
+            if self.response_cache is not None:
+                self.processing_metadata["response_cache"] = self.response_cache.stats()
+    
+    def _prepare_visual_input(self, visual_input: Union[str, Path], input_type: str) -> Tuple[str, Optional[ImageData]]:
+        """Resolve the initial pathway input, loading image data for image stimuli"""
+        if input_type != "image":
+            return visual_input, None
+        if not isinstance(visual_input, (str, Path)):
+            raise ValueError("Image input must be a file path")
+        # Load image from file path
+        image_path = Path(visual_input)
+        if not image_path.exists():
+            raise ValueError(f"Image file not found: {image_path}")
+        if self.image_preprocessor is None:
+            with open(image_path, "rb") as image_file:
+                return f"Image file: {image_path.name}", base64.b64encode(image_file.read()).decode('utf-8')
+        prepared = self.image_preprocessor.prepare_file(image_path)
+        logger.debug("Prepared image %s", image_path.name, extra=prepared.summary())
+        return f"Image file: {image_path.name}", prepared.image_data
+    
+    def _select_model(self, step: ProcessingStep, use_optimal_models: bool, specific_model: str = None, provider: _ClaudeRequestMixin = None) -> str:
+        """Pick the Claude model used for a processing step"""
+        if use_optimal_models:
+            provider = provider or self.claude_provider
+            if self.model_router is not None:
+                return self.model_router.choose_model(step.sequence, [s.sequence for s in self.processing_steps], provider)
+            return provider.get_optimal_model_for_step(step.sequence)
+        return specific_model or "claude-3-5-sonnet-20241022"
+    
+    def _build_step_prompt(self, step: ProcessingStep, current_input: str, image_data: Optional[ImageData] = None, is_entry: bool = False) -> str:
+        """Create full prompt including context from previous steps"""
+        if is_entry:
+            if isinstance(image_data, list):
+                return f"{step.ai_prompt}\n\nThe first image shows the whole scene; the other {len(image_data) - 1} are full-resolution tiles of it, left to right and top to bottom."
+            if image_data:
+                # For first step with image, use vision-specific prompt
+                return step.ai_prompt
+            return f"{step.ai_prompt} {current_input}"
+        return f"{step.ai_prompt}\n\nPrevious processing output: {current_input}"
+    
+    def _fingerprint_step(self, step: ProcessingStep, model: str, current_input: str, image_data: Optional[ImageData] = None, context: Optional[Dict[str, str]] = None) -> str:
+        """Hash everything that determines a step's output: prompt text, model and upstream input
+        
+        ``context`` holds anything else added to the prompt (e.g. recalled memories); it
+        only enters the hash when present, so plain steps keep the fingerprints of
+        earlier versions and previously saved runs can still be reused.
+        """
+        material = {
+            "ai_prompt": step.ai_prompt,
+            "model": model,
+            "input": current_input,
+            "image": hashlib.sha256("".join([image_data] if isinstance(image_data, str) else image_data).encode("utf-8")).hexdigest() if image_data else None
+        }
+        if context:
+            material["context"] = context
+        return hashlib.sha256(json.dumps(material, sort_keys=True).encode("utf-8")).hexdigest()
+    
+    def _recall_memory_context(self, step: ProcessingStep, current_input: str) -> str:
+        """Look up stored memories similar to the step input and format them for the prompt"""
+        if not step.recall_memories or self.memory_recall is None:
+            return ""
+        start_time = time.perf_counter()
+        matches = self.memory_recall.search(current_input, self.memory_recall_k)
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        with self._metadata_lock:
+            recall_stats = self.processing_metadata.setdefault("memory_recall", {"queries": 0, "total_ms": 0.0, "last_ms": 0.0})
+            recall_stats["queries"] += 1
+            recall_stats["total_ms"] += elapsed_ms
+            recall_stats["last_ms"] = elapsed_ms
+        matches = [match for match in matches if match["score"] >= self.memory_recall_min_score]
+        if not matches:
+            return ""
+        lines = [f"- {match['summary']} (similarity {match['score']:.2f})" for match in matches]
+        return "\n\nStored visual memories most similar to this input:\n" + "\n".join(lines)
+    
+    def _compact_step_input(self, step: ProcessingStep, current_input: str) -> str:
+        """Apply the context compactor to a chained step's input and record the token savings"""
+        if self.context_compactor is None:
+            return current_input
+        compacted = self.context_compactor.compact(current_input, step)
+        with self._metadata_lock:
+            compaction = self.processing_metadata.setdefault("context_compaction", {"steps": 0, "steps_compacted": 0, "original_tokens": 0, "compacted_tokens": 0})
+            compaction["steps"] += 1
+            compaction["steps_compacted"] += compacted != current_input
+            compaction["original_tokens"] += ContextCompactor.estimate_tokens(current_input)
+            compaction["compacted_tokens"] += ContextCompactor.estimate_tokens(compacted)
+        return compacted
+    
+    def _begin_step(self, step: ProcessingStep, current_input: str, model: str, image_data: Optional[ImageData] = None, is_entry: bool = False) -> StepCall:
+        """Prepare the prompt and fingerprint for a step
+        
+        Image data is only sent for the entry step; later steps work from text, which
+        the context compactor (if configured) first reduces to its token budget. The
+        call keeps the raw input; the compacted text goes into its ``context``.
+        """
+        image_for_step = image_data if is_entry else None
+        context = {}
+        recall_context = self._recall_memory_context(step, current_input)
+        if recall_context:
+            context["recalled_memories"] = recall_context
+        prompt_input = current_input if is_entry else self._compact_step_input(step, current_input)
+        if prompt_input != current_input:
+            context["compacted_input"] = prompt_input
+        return StepCall(
+            step=step,
+            model=model,
+            input_data=current_input,
+            prompt=self._build_step_prompt(step, prompt_input, image_for_step, is_entry) + recall_context,
+            image_data=image_for_step,
+            fingerprint=self._fingerprint_step(step, model, current_input, image_for_step, context),
+            context=context
+        )
     
-    def process_visual_input(self, visual_input: Union[str, Path], use_optimal_models: bool = True, specific_model: str = None, input_type: str = "text") -> List[ProcessingResult]:
-        """Process visual input through the entire visual pathway using Claude AI"""
+    def _reuse_previous(self, call: StepCall, previous: Optional[ProcessingResult]) -> Optional[ProcessingResult]:
+        """Return the previous run's result for this step if its fingerprint is unchanged"""
+        reused = previous is not None and bool(previous.fingerprint) and previous.fingerprint == call.fingerprint
+        if reused:
+            logger.debug("Step %s reused from the previous run", call.step.sequence, extra={"step": call.step.sequence})
+        if previous is not None:
+            with self._metadata_lock:
+                incremental = self.processing_metadata.setdefault("incremental", {"reused_steps": 0, "recomputed_steps": 0})
+                incremental["reused_steps" if reused else "recomputed_steps"] += 1
+        return previous if reused else None
+    
+    def _step_span(self, call: StepCall, parent=None, activate: bool = True):
+        """Tracing span around one pathway step (see ``instrumentation.TRACER``)"""
+        attributes = {"simulation.step": call.step.sequence, "simulation.brain_region": call.step.brain_region, "gen_ai.request.model": call.model}
+        return TRACER.span("simulation.step", attributes, parent, activate)
+    
+    @contextlib.contextmanager
+    def _traced_run(self, mode: str, activate: bool = True):
+        """Tracing span and wall-time histogram around one pathway run"""
+        start = time.perf_counter()
+        with TRACER.span("simulation.run", {"simulation.mode": mode}, activate=activate) as span:
+            yield span
+        METRICS.observe("simulator_run_seconds", time.perf_counter() - start, mode=mode)
+    
+    def _finish_step(self, call: StepCall, response: Optional[str], processing_time: float, error: Optional[Exception] = None, verbose: bool = True, stats: Optional[Dict] = None, span=None, batch: bool = False) -> ProcessingResult:
+        """Record usage and wrap a step's response (or error) as a ProcessingResult
+        
+        ``stats`` is the provider's per-call report; its token usage replaces the
+        prompt-size estimate and is added to ``processing_metadata``. ``batch`` steps
+        came from a Message Batches job, so their time is a share of the batch's wall
+        time and is kept out of the router and the step latency histogram.
+        """
+        step = call.step
+        stats = stats or {}
+        input_tokens = stats.get("input_tokens") or ContextCompactor.estimate_tokens(call.prompt)
+        output_tokens = stats.get("output_tokens", 0)
+        if "input_tokens" in stats:
+            with self._metadata_lock:
+                self.processing_metadata["input_tokens_used"] += stats["input_tokens"]
+                self.processing_metadata["output_tokens_used"] += output_tokens
+                self.processing_metadata["total_tokens_used"] += stats["input_tokens"] + output_tokens
+        if span is not None:
+            span.set_attributes({"gen_ai.response.model": call.model, "gen_ai.usage.input_tokens": input_tokens,
+                                 "gen_ai.usage.output_tokens": output_tokens, "simulation.cached": bool(stats.get("cached"))})
+            if error is not None:
+                span.set_error(error)
+        if self.model_router is not None and not stats.get("cached") and not batch:
+            # Cache hits say nothing about the model's latency or reliability
+            self.model_router.record(step.sequence, call.model, processing_time, len(response or ""), input_tokens, error)
+        if error is not None:
+            logger.warning("Error processing step %s: %s", step.sequence, error,
+                           extra={"step": step.sequence, "brain_region": step.brain_region, "model": call.model})
+            response = f"Error in {step.brain_region}: {str(error)}"
+            processing_time = 0.0
+        else:
+            # Track model usage
+            self._record_model_usage(call.model, processing_time, bool(stats.get("cached")))
+            if not batch:
+                METRICS.observe("simulator_step_seconds", processing_time, step=step.sequence, model=call.model)
+            # Checked first so the preview isn't built when INFO is filtered out
+            if verbose and logger.isEnabledFor(logging.INFO):
+                logger.info("Step %s: %s finished in %.2fs", step.sequence, step.brain_region, processing_time,
+                            extra={"step": step.sequence, "brain_region": step.brain_region, "model": call.model,
+                                   "processing_time": round(processing_time, 4), "input_tokens": input_tokens,
+                                   "output_tokens": output_tokens, "routing": step.routing, "output_preview": response[:200]})
+        
+        return ProcessingResult(
+            step=step.sequence,
+            brain_region=step.brain_region,
+            input_data=call.input_data,
+            output=response,
+            processing_time=processing_time,
+            model_used=f"claude/{call.model}",
+            fingerprint="" if error is not None else call.fingerprint,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            metadata=dict(call.context)
+        )
+    
+    def _rate_limit_fallback(self, call: StepCall, error: ClaudeAPIError, provider: _ClaudeRequestMixin) -> Optional[StepCall]:
+        """Retarget a rate-limited call at another model chosen by the router, if one is available"""
+        if self.model_router is None or error.status_code not in ModelRouter.RATE_LIMIT_STATUSES:
+            return None
+        model = self.model_router.fallback_model(call.step.sequence, call.model, provider)
+        if model is None:
+            return None
+        self.model_router.record(call.step.sequence, call.model, 0.0, error=error)
+        with self._metadata_lock:
+            self.processing_metadata["rate_limit_fallbacks"] = self.processing_metadata.get("rate_limit_fallbacks", 0) + 1
+        return replace(call, model=model, fingerprint=self._fingerprint_step(call.step, model, call.input_data, call.image_data, call.context))
+    
+    def _finish_run(self):
+        """Publish router, rate limiter and latency statistics, persisting the router's if it has a state file
+        
+        Latency percentiles come from the process-wide ``instrumentation.METRICS``
+        registry, so they cover every simulator in the process.
+        """
+        limiter = self.claude_provider.rate_limiter if self.claude_provider else None
+        latency = {
+            "steps": METRICS.summary("simulator_step_seconds", ("step",)),
+            "models": METRICS.summary("simulator_step_seconds", ("model",)),
+            "api_phases": METRICS.summary("claude_api_request_seconds", ("model", "phase"))
+        }
+        with self._metadata_lock:
+            self.processing_metadata["latency"] = latency
+            if limiter is not None:
+                self.processing_metadata["rate_limiter"] = limiter.metrics()
+            if self.model_router is not None:
+                self.processing_metadata["model_routing"] = self.model_router.stats()
+        with self._metadata_lock:
+            deferred = self._router_saves_deferred > 0
+        if not deferred:
+            self._save_router_state()
+    
+    def _save_router_state(self):
+        """Persist the router's statistics if it has a state file; a failed save only logs a warning"""
+        if self.model_router is None or self.model_router.state_path is None:
+            return
+        try:
+            self.model_router.save()
+        except OSError as e:
+            logger.warning("Could not save model router state to %s: %s", self.model_router.state_path, e)
+    
+    def _next_attempt(self, call: StepCall, error: ClaudeAPIError, provider: _ClaudeRequestMixin, attempt: int, retry_policy: Optional[RetryPolicy]) -> Tuple[Optional[StepCall], float]:
+        """After a failed call return (call to send next, seconds to wait first), or (None, 0) to give up
+        
+        A rate-limited model is swapped for a router fallback right away; other
+        failures are retried on the same model as the retry policy allows. With a
+        policy, fallbacks count towards its ``max_attempts``; without one a step
+        falls back at most once per other model.
+        """
+        max_attempts = retry_policy.max_attempts if retry_policy is not None else len(provider.models)
+        if attempt >= max_attempts:
+            return None, 0.0
+        fallback = self._rate_limit_fallback(call, error, provider)
+        if fallback is not None:
+            return fallback, 0.0
+        if retry_policy is not None and retry_policy.should_retry(error, attempt):
+            with self._metadata_lock:
+                self.processing_metadata["step_retries"] = self.processing_metadata.get("step_retries", 0) + 1
+            return call, retry_policy.delay(attempt, error)
+        return None, 0.0
+    
+    def _run_step(self, step: ProcessingStep, current_input: str, model: str, image_data: Optional[ImageData] = None, verbose: bool = True, is_entry: bool = False, previous: Optional[ProcessingResult] = None, retry_policy: Optional[RetryPolicy] = None) -> ProcessingResult:
+        """Run a single pathway step against Claude, reusing ``previous`` when its fingerprint matches
+        
+        Failures are retried per ``retry_policy`` (default: the simulator's ``retry_policy``).
+        """
+        call = self._begin_step(step, current_input, model, image_data, is_entry)
+        reused = self._reuse_previous(call, previous)
+        if reused is not None:
+            return reused
+        
+        retry_policy = retry_policy or self.retry_policy
+        attempt = 1
+        # Rate-limit retries belong to the policy when there is one (see _retry_rate_limited)
+        owner_token = _policy_owns_retries.set(retry_policy is not None)
+        try:
+            with self._step_span(call) as span:
+                while True:
+                    start_time = time.time()
+                    stats = {}
+                    try:
+                        response = self.claude_provider.generate_response(call.prompt, call.model, call.image_data, stats=stats)
+                    except ClaudeAPIError as e:
+                        next_call, delay = self._next_attempt(call, e, self.claude_provider, attempt, retry_policy)
+                        if next_call is None:
+                            return self._finish_step(call, None, 0.0, e, verbose, span=span)
+                        time.sleep(delay)
+                        call, attempt = next_call, attempt + 1
+                        continue
+                    return self._finish_step(call, response, time.time() - start_time, None, verbose, stats, span)
+        finally:
+            _policy_owns_retries.reset(owner_token)
+    
+    def _step_graph_order(self) -> List[ProcessingStep]:
+        """Validate step dependencies and return the steps in a topological order"""
+        by_sequence = {step.sequence: step for step in self.processing_steps}
+        ordered = []
+        visiting, visited = set(), set()
+        
+        def visit(step: ProcessingStep):
+            if step.sequence in visited:
+                return
+            if step.sequence in visiting:
+                raise ValueError(f"Processing steps contain a dependency cycle at step {step.sequence}")
+            visiting.add(step.sequence)
+            for upstream in step.depends_on:
+                if upstream not in by_sequence:
+                    raise ValueError(f"Step {step.sequence} depends on unknown step {upstream}")
+                visit(by_sequence[upstream])
+            visiting.discard(step.sequence)
+            visited.add(step.sequence)
+            ordered.append(step)
+        
+        for step in self.processing_steps:
+            visit(step)
+        return ordered
+    
+    def _merge_upstream_outputs(self, step: ProcessingStep, outputs: Dict[int, str]) -> str:
+        """Combine the outputs of a step's dependencies into a single input"""
+        if len(step.depends_on) == 1:
+            return outputs[step.depends_on[0]]
+        regions = {s.sequence: s.brain_region for s in self.processing_steps}
+        return "\n\n".join(f"[{regions[upstream]}]\n{outputs[upstream]}" for upstream in step.depends_on)
+    
+    def _process_step_graph(self, initial_input: str, image_data: Optional[ImageData], use_optimal_models: bool, specific_model: str = None, verbose: bool = True, previous_by_step: Optional[Dict[int, ProcessingResult]] = None) -> List[ProcessingResult]:
+        """Run the pathway as a dependency graph, executing independent branches concurrently
+        
+        Steps start as soon as all of their ``depends_on`` steps have finished; steps
+        with several dependencies receive the merged outputs of every branch.
+        """
+        self._step_graph_order()
+        pending = list(self.processing_steps)
+        outputs: Dict[int, str] = {}
+        results: Dict[int, ProcessingResult] = {}
+        
+        with ThreadPoolExecutor(max_workers=len(pending) or 1) as executor:
+            running = {}
+            while pending or running:
+                ready = [step for step in pending if all(upstream in outputs for upstream in step.depends_on)]
+                for step in ready:
+                    pending.remove(step)
+                    is_entry = not step.depends_on
+                    current_input = initial_input if is_entry else self._merge_upstream_outputs(step, outputs)
+                    model = self._select_model(step, use_optimal_models, specific_model)
+                    previous = (previous_by_step or {}).get(step.sequence)
+                    # Copy the context so the request priority (see rate_limiter) follows the step's thread
+                    future = executor.submit(contextvars.copy_context().run, self._run_step, step, current_input, model, image_data, verbose, is_entry, previous)
+                    running[future] = step
+                
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    result = future.result()
+                    results[step.sequence] = result
+                    outputs[step.sequence] = result.output
+        
+        return [results[step.sequence] for step in self.processing_steps]
+    
+    def process_visual_input(self, visual_input: Union[str, Path], use_optimal_models: bool = True, specific_model: str = None, input_type: str = "text", verbose: bool = True, execution_mode: str = "linear", previous_results: Optional[List[ProcessingResult]] = None) -> List[ProcessingResult]:
+        """Process visual input through the entire visual pathway using Claude AI
+        
+        ``execution_mode="linear"`` chains every step onto the previous output in
+        sequence order. ``execution_mode="graph"`` follows each step's ``depends_on``
+        so the ventral (V2/V4) and dorsal (MT/MST) streams run in parallel and
+        rejoin at IT cortex.
+        
+        Passing ``previous_results`` (from an earlier run or ``load_results``) enables
+        incremental mode: steps whose prompt, model and upstream input fingerprint is
+        unchanged are reused, and only changed steps and their dependants are re-run.
+        """
         if not self.claude_provider:
             raise ValueError("Claude API key not configured. Use set_claude_api_key() first.")
+        if execution_mode not in ("linear", "graph"):
+            raise ValueError("Unsupported execution mode. Use 'linear' or 'graph'")
         
         results = []
-        current_input = visual_input
-        image_data = None
-        
-        # Handle image input
-        if input_type == "image":
-            if isinstance(visual_input, (str, Path)):
-                # Load image from file path
-                image_path = Path(visual_input)
-                if image_path.exists():
-                    with open(image_path, "rb") as image_file:
-                        image_data = base64.b64encode(image_file.read()).decode('utf-8')
-                    current_input = f"Image file: {image_path.name}"
-                else:
-                    raise ValueError(f"Image file not found: {image_path}")
-            else:
-                raise ValueError("Image input must be a file path")
+        current_input, image_data = self._prepare_visual_input(visual_input, input_type)
+        previous_by_step = {result.step: result for result in previous_results or []}
         
-        print(f"Starting Claude-powered visual processing simulation...")
-        print(f"Input type: {input_type}")
-        print(f"Initial visual input: {current_input}")
-        print(f"Using optimal model selection: {use_optimal_models}")
-        print("="*60)
+        if verbose:
+            ensure_logging_configured()
         
-        for step in self.processing_steps:
-            print(f"\nStep {step.sequence}: {step.brain_region}")
-            print(f"Event: {step.event}")
-            print(f"Process: {step.process}")
+        with self._traced_run(execution_mode):
+            if verbose:
+                logger.info("Starting Claude-powered visual processing simulation",
+                            extra={"input_type": input_type, "input_preview": current_input[:200],
+                                   "use_optimal_models": use_optimal_models, "execution_mode": execution_mode})
             
-            # Select optimal model for this step
-            if use_optimal_models:
-                model = self.claude_provider.get_optimal_model_for_step(step.sequence)
+            if execution_mode == "graph":
+                results = self._process_step_graph(current_input, image_data, use_optimal_models, specific_model, verbose, previous_by_step)
             else:
-                model = specific_model or "claude-3-5-sonnet-20241022"
-            
-            model_name = self.claude_provider.models[model]["name"]
-            print(f"Using model: {model_name}")
+                for step in self.processing_steps:
+                    model = self._select_model(step, use_optimal_models, specific_model)
+                    if verbose:
+                        logger.debug("Step %s: %s started", step.sequence, step.brain_region,
+                                     extra={"step": step.sequence, "event": step.event, "process": step.process, "model": model})
+                    
+                    result = self._run_step(step, current_input, model, image_data, verbose, step is self.processing_steps[0], previous_by_step.get(step.sequence))
+                    results.append(result)
+                    
+                    # Update current input for next step (chain the outputs)
+                    current_input = result.output
             
-            # Create full prompt including context from previous steps
-            if step.sequence == 1:
-                if input_type == "image" and image_data:
-                    # For first step with image, use vision-specific prompt
-                    full_prompt = step.ai_prompt
-                else:
-                    full_prompt = f"{step.ai_prompt} {current_input}"
-            else:
-                full_prompt = f"{step.ai_prompt}\n\nPrevious processing output: {current_input}"
+            self._finish_run()
+            if verbose:
+                logger.info("Simulation finished in %.2fs", self.processing_metadata["total_processing_time"],
+                            extra={"total_processing_time": self.processing_metadata["total_processing_time"],
+                                   "total_tokens_used": self.processing_metadata["total_tokens_used"],
+                                   "model_usage": self.processing_metadata["model_usage"]})
             
-            # Generate response using Claude API
-            start_time = time.time()
-            try:
-                # Use image data only for the first step if available
-                image_for_step = image_data if step.sequence == 1 and input_type == "image" else None
-                response = self.claude_provider.generate_response(full_prompt, model, image_for_step)
-                processing_time = time.time() - start_time
+            return results
+    
+    def stream_visual_input(self, visual_input: Union[str, Path], use_optimal_models: bool = True, specific_model: str = None, input_type: str = "text", verbose: bool = False, previous_results: Optional[List[ProcessingResult]] = None) -> Iterator[StepStreamEvent]:
+        """Run the linear pathway with streamed responses, yielding partial output per step
+        
+        Each step emits ``"delta"`` events as tokens arrive and a ``"complete"`` event
+        carrying its ProcessingResult, so callers can render output long before the
+        step (or the whole pathway) has finished.
+        """
+        if not self.claude_provider:
+            raise ValueError("Claude API key not configured. Use set_claude_api_key() first.")
+        
+        current_input, image_data = self._prepare_visual_input(visual_input, input_type)
+        previous_by_step = {result.step: result for result in previous_results or []}
+        if verbose:
+            ensure_logging_configured()
+        
+        # Spans are not made current here: this generator's context is the consumer's
+        with self._traced_run("stream", activate=False) as run_span:
+            for index, step in enumerate(self.processing_steps):
+                model = self._select_model(step, use_optimal_models, specific_model)
+                call = self._begin_step(step, current_input, model, image_data, index == 0)
+                result = self._reuse_previous(call, previous_by_step.get(step.sequence))
                 
-                # Track model usage
-                if model not in self.processing_metadata["model_usage"]:
-                    self.processing_metadata["model_usage"][model] = 0
-                self.processing_metadata["model_usage"][model] += 1
-                self.processing_metadata["total_processing_time"] += processing_time
+                if result is None:
+                    chunks = []
+                    stats = {}
+                    start_time = time.time()
+                    with self._step_span(call, run_span, activate=False) as span:
+                        try:
+                            for chunk in self.claude_provider.stream_response(call.prompt, call.model, call.image_data, stats=stats):
+                                chunks.append(chunk)
+                                yield StepStreamEvent(step.sequence, step.brain_region, "delta", chunk)
+                            result = self._finish_step(call, "".join(chunks), time.time() - start_time, None, verbose, stats, span)
+                        except ClaudeAPIError as e:
+                            result = self._finish_step(call, None, 0.0, e, verbose, span=span)
                 
-            except ClaudeAPIError as e:
-                print(f"Error processing step {step.sequence}: {e}")
-                response = f"Error in {step.brain_region}: {str(e)}"
-                processing_time = 0.0
-            
-            # Create result object
-            result = ProcessingResult(
-                step=step.sequence,
-                brain_region=step.brain_region,
-                input_data=current_input,
-                output=response,
-                processing_time=processing_time,
-                model_used=f"claude/{model}"
-            )
-            
-            results.append(result)
-            
-            # Update current input for next step (chain the outputs)
-            current_input = response
+                yield StepStreamEvent(step.sequence, step.brain_region, "complete", result.output, result)
+                # Chain the outputs
+                current_input = result.output
+            self._finish_run()
+    
+    def _get_async_provider(self) -> Union[AsyncClaudeProvider, "AsyncMockProvider"]:
+        """Return the async provider, creating one from the configured API key if needed"""
+        if self.async_claude_provider is None:
+            if not self.claude_provider:
+                raise ValueError("Claude API key not configured. Use set_claude_api_key() first.")
+            if isinstance(self.claude_provider, MockProvider):
+                self.async_claude_provider = AsyncMockProvider(self.claude_provider.behavior)
+            else:
+                self.async_claude_provider = AsyncClaudeProvider(self.claude_provider.api_key, self.claude_provider.base_url)
+            self.async_claude_provider.response_cache = self.response_cache
+        return self.async_claude_provider
+    
+    async def _run_step_async(self, step: ProcessingStep, current_input: str, model: str, image_data: Optional[ImageData] = None, verbose: bool = True, is_entry: bool = False, previous: Optional[ProcessingResult] = None) -> ProcessingResult:
+        """Async counterpart of ``_run_step`` using the pooled async provider"""
+        call = self._begin_step(step, current_input, model, image_data, is_entry)
+        reused = self._reuse_previous(call, previous)
+        if reused is not None:
+            return reused
+        
+        provider = self._get_async_provider()
+        attempt = 1
+        owner_token = _policy_owns_retries.set(self.retry_policy is not None)
+        try:
+            with self._step_span(call) as span:
+                while True:
+                    start_time = time.time()
+                    stats = {}
+                    try:
+                        response = await provider.generate_response(call.prompt, call.model, call.image_data, stats=stats)
+                    except ClaudeAPIError as e:
+                        next_call, delay = self._next_attempt(call, e, provider, attempt, self.retry_policy)
+                        if next_call is None:
+                            return self._finish_step(call, None, 0.0, e, verbose, span=span)
+                        await asyncio.sleep(delay)
+                        call, attempt = next_call, attempt + 1
+                        continue
+                    return self._finish_step(call, response, time.time() - start_time, None, verbose, stats, span)
+        finally:
+            _policy_owns_retries.reset(owner_token)
+    
+    async def process_visual_input_async(self, visual_input: Union[str, Path], use_optimal_models: bool = True, specific_model: str = None, input_type: str = "text", verbose: bool = False, execution_mode: str = "linear", previous_results: Optional[List[ProcessingResult]] = None) -> List[ProcessingResult]:
+        """Process visual input through the pathway on the event loop
+        
+        Uses ``async_claude_provider`` (an ``AsyncClaudeProvider`` built from the
+        configured API key unless one was assigned), so many simulations can share one
+        connection pool from a single thread, e.g. via ``asyncio.gather``.
+        """
+        if execution_mode not in ("linear", "graph"):
+            raise ValueError("Unsupported execution mode. Use 'linear' or 'graph'")
+        provider = self._get_async_provider()
+        initial_input, image_data = self._prepare_visual_input(visual_input, input_type)
+        previous_by_step = {result.step: result for result in previous_results or []}
+        if verbose:
+            ensure_logging_configured()
+        
+        if execution_mode == "linear":
+            results = []
+            current_input = initial_input
+            with self._traced_run("async_linear"):
+                for index, step in enumerate(self.processing_steps):
+                    model = self._select_model(step, use_optimal_models, specific_model, provider)
+                    result = await self._run_step_async(step, current_input, model, image_data, verbose, index == 0, previous_by_step.get(step.sequence))
+                    results.append(result)
+                    current_input = result.output
+                self._finish_run()
+            return results
+        
+        tasks: Dict[int, asyncio.Future] = {}
+        
+        async def run_node(step: ProcessingStep) -> ProcessingResult:
+            upstream = await asyncio.gather(*(tasks[sequence] for sequence in step.depends_on))
+            outputs = {sequence: result.output for sequence, result in zip(step.depends_on, upstream)}
+            is_entry = not step.depends_on
+            current_input = initial_input if is_entry else self._merge_upstream_outputs(step, outputs)
+            model = self._select_model(step, use_optimal_models, specific_model, provider)
+            return await self._run_step_async(step, current_input, model, image_data, verbose, is_entry, previous_by_step.get(step.sequence))
+        
+        with self._traced_run("async_graph"):
+            # Tasks copy the current context, so their step spans nest under the run span
+            for step in self._step_graph_order():
+                tasks[step.sequence] = asyncio.ensure_future(run_node(step))
+            await asyncio.gather(*tasks.values())
+            self._finish_run()
+        return [tasks[step.sequence].result() for step in self.processing_steps]
+    
+    def process_batch(self, inputs: Iterable[Union[str, Path, Tuple[Union[str, Path], str]]], max_concurrency: int = 4, use_optimal_models: bool = True, specific_model: str = None, input_type: str = "text", execution_mode: str = "linear") -> Iterator[BatchItemResult]:
+        """Run many stimuli through the pathway concurrently, yielding each as it finishes
+        
+        Each stimulus keeps its own strict step ordering; up to ``max_concurrency``
+        chains are in flight at once. Items may be plain inputs (using ``input_type``)
+        or ``(visual_input, input_type)`` pairs. Throughput figures are kept up to date
+        in ``processing_metadata["batch_throughput"]`` while the batch runs.
+        """
+        if not self.claude_provider:
+            raise ValueError("Claude API key not configured. Use set_claude_api_key() first.")
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        
+        def run_chain(index: int, item) -> BatchItemResult:
+            item_input, item_type = item if isinstance(item, tuple) else (item, input_type)
+            outcome = BatchItemResult(index=index, visual_input=item_input, input_type=item_type)
+            chain_start = time.time()
+            try:
+                # Batch chains queue behind interactive runs in the shared rate limiter
+                with request_priority(PRIORITY_BATCH):
+                    outcome.results = self.process_visual_input(item_input, use_optimal_models, specific_model, item_type, verbose=False, execution_mode=execution_mode)
+                # A failed step comes back as an error-text result without a fingerprint
+                failed = next((result for result in outcome.results if not result.fingerprint), None)
+                if failed is not None:
+                    outcome.error = failed.output
+            except Exception as e:
+                outcome.error = str(e)
+            outcome.elapsed = time.time() - chain_start
+            return outcome
+        
+        batch_start = time.time()
+        throughput = {"stimuli_completed": 0, "stimuli_failed": 0, "steps_completed": 0,
+                      "wall_time": 0.0, "stimuli_per_second": 0.0, "steps_per_second": 0.0,
+                      "max_concurrency": max_concurrency}
+        self.processing_metadata["batch_throughput"] = throughput
+        
+        # Inputs are pulled lazily and only a small window of chains is queued, so huge or
+        # endless input iterables stay bounded and a consumer that stops early does not
+        # wait for the rest of the batch to run
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        window = max_concurrency * 2
+        items = enumerate(inputs)
+        pending = set()
+        # Chains skip the router's per-run save; the batch saves it once when it ends
+        with self._metadata_lock:
+            self._router_saves_deferred += 1
+        try:
+            while True:
+                for index, item in items:
+                    pending.add(executor.submit(run_chain, index, item))
+                    if len(pending) >= window:
+                        break
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    outcome = future.result()
+                    if outcome.error:
+                        throughput["stimuli_failed"] += 1
+                    else:
+                        throughput["stimuli_completed"] += 1
+                    throughput["steps_completed"] += sum(1 for result in outcome.results if result.fingerprint)
+                    elapsed = time.time() - batch_start
+                    throughput["wall_time"] = elapsed
+                    throughput["stimuli_per_second"] = throughput["stimuli_completed"] / elapsed if elapsed else 0.0
+                    throughput["steps_per_second"] = throughput["steps_completed"] / elapsed if elapsed else 0.0
+                    yield outcome
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+            with self._metadata_lock:
+                self._router_saves_deferred -= 1
+            self._save_router_state()
+    
+    def _save_batch_checkpoint(self, checkpoint_path: Path, state: Dict):
+        """Atomically write the message-batch run state"""
+        tmp_path = checkpoint_path.with_name(checkpoint_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(state), encoding="utf-8")
+        tmp_path.replace(checkpoint_path)
+    
+    def _run_message_batch(self, calls: Dict[str, StepCall], state: Dict, checkpoint_path: Path, poll_interval: float, timeout: Optional[float], verbose: bool, stats: Optional[Dict[str, Dict]] = None) -> Tuple[Dict[str, Union[str, ClaudeAPIError]], float]:
+        """Send one step's calls as a batch job and wait for it; returns (responses by custom_id, seconds)
+        
+        Cached responses are served without submitting them. The batch id is checkpointed
+        before polling, so a resumed run picks the same job back up instead of paying again.
+        Token usage of each succeeded request is reported into ``stats[custom_id]``.
+        """
+        provider = self.claude_provider
+        start_time = time.time()
+        responses: Dict[str, Union[str, ClaudeAPIError]] = {}
+        pending = state.get("pending")
+        
+        if pending is None:
+            batch_requests = []
+            for custom_id, call in calls.items():
+                data = provider._build_request(call.prompt, call.model, call.image_data)
+                _, cached = provider._cache_lookup(data)
+                if cached is not None:
+                    responses[custom_id] = cached
+                else:
+                    batch_requests.append({"custom_id": custom_id, "params": data})
+            if not batch_requests:
+                return responses, time.time() - start_time
+            batch = provider.create_message_batch(batch_requests)
+            pending = {"batch_id": batch["id"], "submitted_at": start_time, "cached": responses,
+                       "models": {custom_id: call.model for custom_id, call in calls.items()}}
+            state["pending"] = pending
+            self._save_batch_checkpoint(checkpoint_path, state)
+            if verbose:
+                logger.info("Submitted batch %s with %d requests", batch["id"], len(batch_requests), extra={"batch_id": batch["id"]})
+        else:
+            responses = dict(pending.get("cached", {}))
+            start_time = pending.get("submitted_at", start_time)
+            batch = provider.get_message_batch(pending["batch_id"])
+        
+        while batch.get("processing_status") != "ended":
+            if timeout is not None and time.time() - start_time > timeout:
+                raise TimeoutError(f"Batch {batch['id']} still {batch.get('processing_status')} after {timeout}s; "
+                                   f"call again with the same checkpoint to resume")
+            time.sleep(poll_interval)
+            batch = provider.get_message_batch(batch["id"])
+            if verbose:
+                logger.info("Batch %s: %s", batch["id"], batch.get("processing_status"),
+                            extra={"batch_id": batch["id"], "request_counts": batch.get("request_counts", {})})
+        
+        for entry in provider.iter_message_batch_results(batch):
+            custom_id, result = entry["custom_id"], entry["result"]
+            if custom_id not in calls:
+                continue
+            if result.get("type") == "succeeded":
+                try:
+                    text = provider._parse_response(result["message"])
+                except ClaudeAPIError as e:
+                    responses[custom_id] = e
+                    continue
+                responses[custom_id] = text
+                call = calls[custom_id]
+                provider._record_call(call.model, result["message"].get("usage"), {}, None if stats is None else stats.setdefault(custom_id, {}), None)
+                if provider.response_cache is not None:
+                    data = provider._build_request(call.prompt, call.model, call.image_data)
+                    provider.response_cache.put(provider.response_cache.make_key(data), text)
+            else:
+                error = result.get("error", {})
+                message = error.get("error", error).get("message", "") if isinstance(error, dict) else str(error)
+                responses[custom_id] = ClaudeAPIError(f"Batch request {result.get('type')}: {message}".rstrip(": "))
+        return responses, time.time() - start_time
+    
+    def process_message_batches(self, inputs: Iterable[Union[str, Path, Tuple[Union[str, Path], str]]], checkpoint_path: Union[str, Path], use_optimal_models: bool = True, specific_model: str = None, input_type: str = "text", poll_interval: float = 30.0, timeout: Optional[float] = None, verbose: bool = True) -> List[BatchItemResult]:
+        """Run many stimuli through the linear pathway with the Message Batches API
+        
+        Step N of every stimulus is submitted as one batch job; once it has ended the
+        outputs are chained into step N+1's batch. Batch jobs cost less than interactive
+        calls but may take hours, so this suits overnight corpus runs.
+        
+        Progress (finished steps and any in-flight batch id) is checkpointed to
+        ``checkpoint_path`` after every step; calling again with the same inputs and
+        checkpoint resumes where the previous run stopped, with the models chosen for an
+        in-flight batch. ``processing_time`` of each result is its batch's wall time
+        divided by the number of requests in it; these times are not fed to the model
+        router or the step latency metrics.
+        """
+        if not self.claude_provider:
+            raise ValueError("Claude API key not configured. Use set_claude_api_key() first.")
+        items = [item if isinstance(item, tuple) else (item, input_type) for item in inputs]
+        checkpoint_path = Path(checkpoint_path)
+        if verbose:
+            ensure_logging_configured()
+        
+        item_keys = [[str(item_input), item_type] for item_input, item_type in items]
+        if checkpoint_path.exists():
+            state = json.loads(checkpoint_path.read_text(encoding="utf-8"))
+            if state["inputs"] != item_keys:
+                raise ValueError(f"Checkpoint {checkpoint_path} belongs to a different set of inputs")
+            if verbose:
+                logger.info("Resuming from %s: %d of %d steps done", checkpoint_path, state["completed_steps"], len(self.processing_steps))
+        else:
+            state = {"inputs": item_keys, "completed_steps": 0, "results": [[] for _ in items], "pending": None}
+        
+        prepared = [self._prepare_visual_input(item_input, item_type) for item_input, item_type in items]
+        results = [[ProcessingResult(**saved) for saved in item_results] for item_results in state["results"]]
+        run_start = time.time()
+        
+        for index, step in enumerate(self.processing_steps):
+            if index < state["completed_steps"]:
+                continue
+            calls = {}
+            # A resumed batch keeps the models it was submitted with
+            chosen_models = (state.get("pending") or {}).get("models", {})
+            for item_index, (initial_input, image_data) in enumerate(prepared):
+                custom_id = f"item{item_index}-step{step.sequence}"
+                current_input = initial_input if index == 0 else results[item_index][-1].output
+                model = chosen_models.get(custom_id) or self._select_model(step, use_optimal_models, specific_model)
+                calls[custom_id] = self._begin_step(step, current_input, model, image_data, index == 0)
             
-            print(f"Output: {response[:200]}..." if len(response) > 200 else f"Output: {response}")
-            print(f"Processing time: {processing_time:.2f}s")
-            print(f"Routing: {step.routing}")
+            stats: Dict[str, Dict] = {}
+            responses, elapsed = self._run_message_batch(calls, state, checkpoint_path, poll_interval, timeout, verbose, stats)
+            share = elapsed / max(1, len(calls))
+            for item_index, (custom_id, call) in enumerate(calls.items()):
+                response = responses.get(custom_id, ClaudeAPIError(f"No batch result for {custom_id}"))
+                if isinstance(response, ClaudeAPIError):
+                    results[item_index].append(self._finish_step(call, None, 0.0, response, verbose, batch=True))
+                else:
+                    results[item_index].append(self._finish_step(call, response, share, None, verbose, stats.get(custom_id), batch=True))
             
-        print(f"\nTotal processing time: {self.processing_metadata['total_processing_time']:.2f}s")
-        print(f"Model usage: {self.processing_metadata['model_usage']}")
+            state["completed_steps"] = index + 1
+            state["results"] = [[asdict(result) for result in item_results] for item_results in results]
+            state["pending"] = None
+            self._save_batch_checkpoint(checkpoint_path, state)
+            if verbose:
+                logger.info("Step %s: %s finished for %d stimuli in %.1fs", step.sequence, step.brain_region, len(calls), elapsed,
+                            extra={"step": step.sequence, "stimuli": len(calls), "elapsed": round(elapsed, 3)})
+        
+        self._finish_run()
+        elapsed = time.time() - run_start
+        return [
+            BatchItemResult(index=item_index, visual_input=item_input, input_type=item_type, results=results[item_index], elapsed=elapsed)
+            for item_index, (item_input, item_type) in enumerate(items)
+        ]
+    
+    def _job_journal(self, job_id: str, jobs_dir: Union[str, Path]) -> JobJournal:
+        if not re.fullmatch(r"[\w.-]+", job_id):
+            raise ValueError(f"Invalid job id '{job_id}': use letters, digits, '.', '_' and '-'")
+        return JobJournal(Path(jobs_dir) / f"{job_id}.jsonl")
+    
+    def job_status(self, job_id: str, jobs_dir: Union[str, Path] = "simulation_jobs") -> Dict[str, Union[str, int]]:
+        """Summarize a job journal: how many stimuli are complete, failed or still to run"""
+        header, completed, failures = self._job_journal(job_id, jobs_dir).replay()
+        steps = {step.sequence for step in self.processing_steps}
+        done = sum(1 for index in range(len(header["inputs"])) if steps <= set(completed.get(index, {})))
+        return {
+            "job_id": job_id,
+            "items": len(header["inputs"]),
+            "completed": done,
+            "failed": len(failures),
+            "pending": len(header["inputs"]) - done - len(failures),
+            "completed_steps": sum(len(results) for results in completed.values())
+        }
+    
+    def run_job(self, job_id: str, inputs: Optional[Iterable[Union[str, Path, Tuple[Union[str, Path], str]]]] = None, jobs_dir: Union[str, Path] = "simulation_jobs", retry_policy: Optional[RetryPolicy] = None, max_concurrency: int = 4, use_optimal_models: bool = True, specific_model: str = None, input_type: str = "text") -> Iterator[BatchItemResult]:
+        """Run or resume a durable simulation job, yielding each stimulus as it finishes
+        
+        Every finished step is appended to ``<jobs_dir>/<job_id>.jsonl`` as soon as it
+        completes. Calling again with the same ``job_id`` (``inputs`` may be omitted)
+        skips completed steps and stimuli and re-runs failed stimuli from the step that
+        failed, so a crashed run never pays twice for a finished step.
+        
+        Steps are retried per ``retry_policy`` (default: the simulator's policy, else
+        ``RetryPolicy()``). A step that still fails stops its stimulus, which is recorded
+        as failed instead of chaining an error message into the following steps.
+        """
+        if not self.claude_provider:
+            raise ValueError("Claude API key not configured. Use set_claude_api_key() first.")
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        journal = self._job_journal(job_id, jobs_dir)
+        retry_policy = retry_policy or self.retry_policy or RetryPolicy()
+        
+        if journal.exists():
+            header, completed, failures = journal.replay()
+            if inputs is not None:
+                requested = [[str(item_input), item_type] for item_input, item_type in
+                             (item if isinstance(item, tuple) else (item, input_type) for item in inputs)]
+                if requested != header["inputs"]:
+                    raise ValueError(f"Job {job_id} already exists with different inputs")
+        else:
+            if inputs is None:
+                raise ValueError(f"Job {job_id} not found in {jobs_dir}; pass inputs to create it")
+            Path(jobs_dir).mkdir(parents=True, exist_ok=True)
+            header = {
+                "type": "job",
+                "job_id": job_id,
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "inputs": [[str(item_input), item_type] for item_input, item_type in
+                           (item if isinstance(item, tuple) else (item, input_type) for item in inputs)],
+                "options": {"use_optimal_models": use_optimal_models, "specific_model": specific_model}
+            }
+            journal.append(header)
+            completed, failures = {}, {}
+        options = header["options"]
+        
+        job_stats = {"job_id": job_id, "items": len(header["inputs"]), "completed": 0, "failed": 0,
+                     "resumed_steps": sum(len(results) for results in completed.values()), "new_steps": 0}
+        self.processing_metadata["job"] = job_stats
+        
+        def run_item(index: int) -> BatchItemResult:
+            item_input, item_type = header["inputs"][index]
+            outcome = BatchItemResult(index=index, visual_input=item_input, input_type=item_type)
+            done = completed.get(index, {})
+            item_start = time.time()
+            try:
+                with request_priority(PRIORITY_BATCH), self._traced_run("job") as span:
+                    if span is not None:
+                        span.set_attributes({"simulation.job_id": job_id, "simulation.item": index})
+                    current_input, image_data = self._prepare_visual_input(item_input, item_type)
+                    for position, step in enumerate(self.processing_steps):
+                        result = done.get(step.sequence)
+                        if result is None:
+                            model = self._select_model(step, options["use_optimal_models"], options["specific_model"])
+                            result = self._run_step(step, current_input, model, image_data, False, position == 0, None, retry_policy)
+                            if not result.fingerprint:
+                                journal.append({"type": "failure", "item": index, "step": step.sequence, "error": result.output})
+                                outcome.results.append(result)
+                                outcome.error = result.output
+                                break
+                            journal.append({"type": "result", "item": index, "result": asdict(result)})
+                            with self._metadata_lock:
+                                job_stats["new_steps"] += 1
+                        outcome.results.append(result)
+                        current_input = result.output
+            except Exception as e:
+                journal.append({"type": "failure", "item": index, "step": None, "error": str(e)})
+                outcome.error = str(e)
+            outcome.elapsed = time.time() - item_start
+            return outcome
         
-        return results
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = [executor.submit(run_item, index) for index in range(len(header["inputs"]))]
+            for future in as_completed(futures):
+                outcome = future.result()
+                job_stats["failed" if outcome.error else "completed"] += 1
+                yield outcome
+        self._finish_run()
     
     def create_processing_report(self, results: List[ProcessingResult]) -> str:
         """Create a detailed processing report"""
@@ -411,6 +2526,7 @@ PATHWAY ANALYSIS:"""
 Step {result.step}: {result.brain_region}
 Model: {result.model_used}
 Processing time: {result.processing_time:.2f}s
+Tokens: {result.input_tokens} in / {result.output_tokens} out
 Output length: {len(result.output)} characters"""
         
         return report
@@ -4,20 +4,373 @@ HTTP server with Claude API proxy for the Claude Neural Visual Processing Simula
 Run this to avoid CORS issues when testing the web application
 """
 
+import argparse
+import atexit
+import http.client
 import http.server
-import socketserver
+import logging
+import queue
+import random
+import re
+import ssl
+import threading
+import time
 import webbrowser
 import os
 import sys
 import json
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 import urllib.parse
-from urllib.error import HTTPError
+
+from blob_store import HASH_PATTERN, BlobStore
+from instrumentation import METRICS, TRACER, record_api_call, remote_parent
+from memory_capacity import MemoryCapacityManager
+from memory_store import MemoryStore
+from proxy_cache import CachedResponse, ProxyResponseCache
+from rate_limiter import PRIORITIES, PRIORITY_INTERACTIVE, RateLimitTimeout, estimate_request_tokens, get_shared_limiter
+from structured_logging import configure_logging
+
+try:
+    # Need NumPy; /recall and /recall-similar are disabled without it
+    from memory_embeddings import EmbeddingIndex
+    from memory_index import TagIndex
+except ImportError:
+    EmbeddingIndex = TagIndex = None
+
+logger = logging.getLogger('proxy')
 
 # Configuration
 PORT = 8000
 DIRECTORY = os.path.dirname(os.path.abspath(__file__))
-MEMORY_FILE = os.path.join(DIRECTORY, 'visual_memories.json')
+MEMORY_FILE = os.path.join(DIRECTORY, 'visual_memories.json')  # Legacy format, migrated into MEMORY_DB
+MEMORY_DB = os.environ.get('SIM_MEMORY_DB', os.path.join(DIRECTORY, 'visual_memories.sqlite'))
+IMAGE_BLOB_DIR = os.environ.get('SIM_IMAGE_BLOB_DIR', os.path.join(DIRECTORY, 'memory_images'))
+MEMORY_VECTORS = os.environ.get('SIM_MEMORY_VECTORS', os.path.join(DIRECTORY, 'memory_vectors.f32'))
+INDEX_SAVE_DELAY = float(os.environ.get('SIM_INDEX_SAVE_DELAY', '5'))  # Seconds after an update before the embedding index is saved
+MEMORY_MAX_COUNT = int(os.environ['SIM_MEMORY_MAX_COUNT']) if os.environ.get('SIM_MEMORY_MAX_COUNT') else None
+MEMORY_MAX_BYTES = int(os.environ['SIM_MEMORY_MAX_BYTES']) if os.environ.get('SIM_MEMORY_MAX_BYTES') else None
+MEMORY_EVICTION = os.environ.get('SIM_MEMORY_EVICTION', 'lru')  # lru, lfu or arc; used when a limit is set
+CLAUDE_API_URL = os.environ.get('CLAUDE_API_URL', 'https://api.anthropic.com/v1/messages')
+WORKERS = int(os.environ.get('SIM_SERVER_WORKERS', '16'))          # Requests handled at the same time
+QUEUE_DEPTH = int(os.environ.get('SIM_SERVER_QUEUE_DEPTH', '64'))  # Requests allowed to wait for a worker
+REQUEST_TIMEOUT = float(os.environ.get('SIM_SERVER_REQUEST_TIMEOUT', '120'))  # Seconds of client socket inactivity
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', '16'))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '10'))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', '90'))
+UPSTREAM_MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', '3'))
+RATE_LIMIT_TIMEOUT = float(os.environ.get('RATE_LIMIT_TIMEOUT', '60'))  # Longest a proxied call waits for the limiter
+PROXY_CACHE_SIZE = int(os.environ.get('PROXY_CACHE_SIZE', '256'))  # Cached /claude-proxy responses; 0 disables caching and coalescing
+PROXY_CACHE_TTL = float(os.environ.get('PROXY_CACHE_TTL', '300'))  # Seconds a cached response is served
+
+class PooledResponse:
+    """Upstream response that hands its connection back to the pool once consumed"""
+    
+    def __init__(self, pool, connection, response, connect_seconds=0.0, ttfb_seconds=0.0):
+        self.pool = pool
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.connect_seconds = connect_seconds
+        self.ttfb_seconds = ttfb_seconds
+        self.received_at = time.perf_counter()
+    
+    def phases(self):
+        """Connect, time to first byte and body read seconds (body measured up to now)"""
+        body = time.perf_counter() - self.received_at
+        return {'connect': self.connect_seconds, 'ttfb': self.ttfb_seconds, 'body': body,
+                'total': self.connect_seconds + self.ttfb_seconds + body}
+    
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+    
+    def read(self, amt=None):
+        return self.response.read(amt)
+    
+    def readline(self):
+        return self.response.readline()
+    
+    def close(self):
+        if self.connection is None:
+            return
+        reusable = self.response.isclosed() and not self.response.will_close
+        if not reusable:
+            self.response.close()
+        self.pool.release(self.connection, reusable)
+        self.connection = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class UpstreamPool:
+    """Process-wide keep-alive connection pool for the Claude API, shared by all handler threads
+    
+    Connections are reused across requests so each call skips the TCP/TLS handshake.
+    Connect and read timeouts keep workers from hanging on a stalled upstream, and
+    429/5xx responses are retried with jittered exponential backoff (honouring
+    Retry-After). Usage counters are available from metrics().
+    """
+    
+    RETRY_STATUSES = {429, 500, 502, 503, 504, 529}
+    
+    def __init__(self, url, pool_size=UPSTREAM_POOL_SIZE, connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+                 read_timeout=UPSTREAM_READ_TIMEOUT, max_retries=UPSTREAM_MAX_RETRIES,
+                 backoff_base=0.5, backoff_max=20.0):
+        parsed = urllib.parse.urlsplit(url)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        self.path = parsed.path or '/'
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.ssl_context = ssl.create_default_context() if self.scheme == 'https' else None
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'connections_created': 0, 'connections_reused': 0,
+                      'connections_discarded': 0, 'in_use': 0, 'slot_waits': 0,
+                      'retries': 0, 'errors': 0, 'timeouts': 0}
+    
+    def _count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+    
+    def _connect(self):
+        if self.scheme == 'https':
+            connection = http.client.HTTPSConnection(self.host, self.port, timeout=self.connect_timeout, context=self.ssl_context)
+        else:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+        start = time.perf_counter()
+        connection.connect()
+        connection.connect_seconds = time.perf_counter() - start
+        connection.sock.settimeout(self.read_timeout)
+        self._count('connections_created')
+        return connection
+    
+    def acquire(self):
+        """Check out an idle connection (or open a new one), waiting for a free slot if needed"""
+        if not self.slots.acquire(blocking=False):
+            self._count('slot_waits')
+            if not self.slots.acquire(timeout=self.connect_timeout):
+                raise TimeoutError('Timed out waiting for a free upstream connection')
+        self._count('in_use')
+        try:
+            connection = self.idle.get_nowait()
+            self._count('connections_reused')
+            return connection, True
+        except queue.Empty:
+            pass
+        try:
+            return self._connect(), False
+        except BaseException:
+            self.release(None, False)
+            raise
+    
+    def release(self, connection, reusable):
+        """Return a connection to the pool, closing it if it can't carry another request"""
+        if connection is not None:
+            if reusable:
+                self.idle.put(connection)
+            else:
+                connection.close()
+                self._count('connections_discarded')
+        self._count('in_use', -1)
+        self.slots.release()
+
+    def close(self):
+        """Close every idle connection (e.g. before swapping the pool for another upstream)"""
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+    
+    def backoff_delay(self, attempt, retry_after=None):
+        """Full-jitter exponential backoff, never shorter than a server-provided Retry-After"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after:
+            try:
+                delay = max(delay, min(float(retry_after), self.backoff_max))
+            except ValueError:
+                pass
+        return delay
+    
+    def request(self, method, body, headers, reservation=None):
+        """Send a request upstream and return a PooledResponse (close it when done)
+        
+        With a rate limiter ``reservation``, 429/529 responses pause the model for every
+        caller and the retry queues through the limiter instead of sleeping on its own.
+        The response carries the connect and time-to-first-byte seconds of the last attempt.
+        """
+        self._count('requests')
+        attempt = 0
+        while True:
+            connection, reused = self.acquire()
+            try:
+                start = time.perf_counter()
+                connection.request(method, self.path, body=body, headers=headers)
+                response = connection.getresponse()
+                ttfb = time.perf_counter() - start
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                # A kept-alive connection closed by the server - retry once on a fresh one
+                self.release(connection, False)
+                if reused:
+                    continue
+                self._count('errors')
+                raise
+            except TimeoutError:
+                self.release(connection, False)
+                self._count('timeouts')
+                raise
+            except Exception:
+                self.release(connection, False)
+                self._count('errors')
+                raise
+            
+            pooled = PooledResponse(self, connection, response, 0.0 if reused else connection.connect_seconds, ttfb)
+            if response.status in self.RETRY_STATUSES and attempt < self.max_retries:
+                retry_after = response.getheader('Retry-After')
+                pooled.read()
+                pooled.close()
+                self._count('retries')
+                delay = self.backoff_delay(attempt, retry_after)
+                if reservation is not None and response.status in (429, 529):
+                    reservation.retry_after(delay)
+                else:
+                    time.sleep(delay)
+                attempt += 1
+                continue
+            return pooled
+    
+    def metrics(self):
+        with self.lock:
+            metrics = dict(self.stats)
+        metrics.update({'idle': self.idle.qsize(), 'pool_size': self.pool_size,
+                        'upstream': f'{self.scheme}://{self.host}:{self.port}{self.path}'})
+        return metrics
+
+UPSTREAM = UpstreamPool(CLAUDE_API_URL)
+RATE_LIMITER = get_shared_limiter()
+PROXY_CACHE = ProxyResponseCache(PROXY_CACHE_SIZE, PROXY_CACHE_TTL) if PROXY_CACHE_SIZE > 0 else None
+
+_memory_store = None
+_memory_store_lock = threading.Lock()
+_memory_capacity = None
+
+def get_memory_store():
+    """Open the memory store on first use, migrating the legacy JSON file into it"""
+    global _memory_store, _memory_capacity
+    with _memory_store_lock:
+        if _memory_store is None:
+            _memory_store = MemoryStore(MEMORY_DB, BlobStore(IMAGE_BLOB_DIR))
+            migrated = _memory_store.migrate_from_json(MEMORY_FILE)
+            if migrated:
+                logger.info('Migrated %d visual memories from %s to %s', migrated, MEMORY_FILE, MEMORY_DB)
+            externalized = _memory_store.externalize_images()
+            if externalized:
+                logger.info('Moved %d inline memory images to %s', externalized, IMAGE_BLOB_DIR)
+            orphaned = _memory_store.collect_orphan_images()
+            if orphaned:
+                logger.info('Deleted %d unreferenced memory images from %s', orphaned, IMAGE_BLOB_DIR)
+            if MEMORY_MAX_COUNT is not None or MEMORY_MAX_BYTES is not None:
+                _memory_capacity = MemoryCapacityManager(_memory_store, MEMORY_MAX_COUNT, MEMORY_MAX_BYTES, MEMORY_EVICTION)
+                _memory_capacity.rebuild(_memory_store.iter_memories())
+                _memory_store.add_listener(_memory_capacity)
+                logger.info('Memory bank limited to %s memories / %s bytes (%s eviction)',
+                            MEMORY_MAX_COUNT, MEMORY_MAX_BYTES, MEMORY_EVICTION)
+        return _memory_store
+
+_tag_index = None
+
+def get_tag_index():
+    """Build the recall index from the memory store on first use and keep it updated"""
+    global _tag_index
+    store = get_memory_store()
+    with _memory_store_lock:
+        if _tag_index is None:
+            _tag_index = TagIndex()
+            _tag_index.rebuild(store.iter_memories())
+            store.add_listener(_tag_index)
+        return _tag_index
+
+_embedding_index = None
+
+def get_embedding_index():
+    """Open the on-disk embedding index, rebuilding it if it is out of step with the store"""
+    global _embedding_index
+    store = get_memory_store()
+    with _memory_store_lock:
+        if _embedding_index is None:
+            _embedding_index = EmbeddingIndex(MEMORY_VECTORS)
+            version = store.version()
+            if version is None or _embedding_index.store_version != version:
+                _embedding_index.rebuild(store.iter_memories())
+                _embedding_index.save(version)
+            _embedding_index.autosave(INDEX_SAVE_DELAY, store.version)
+            store.add_listener(_embedding_index)
+            atexit.register(_embedding_index.close)
+        return _embedding_index
+
+class BoundedThreadPoolServer(http.server.HTTPServer):
+    """HTTP server that handles requests on a fixed worker pool with a bounded queue
+    
+    A slow /claude-proxy call only occupies one worker, so static assets and memory
+    requests keep flowing. When every worker is busy and the queue is full, new
+    connections are answered immediately with 503 instead of piling up.
+    """
+    
+    request_queue_size = 128  # Listen backlog; the default of 5 resets connections when a whole class clicks at once
+    
+    def __init__(self, server_address, handler_class, workers=WORKERS, queue_depth=QUEUE_DEPTH, request_timeout=REQUEST_TIMEOUT):
+        super().__init__(server_address, handler_class)
+        self.request_timeout = request_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sim-server')
+        self.slots = threading.BoundedSemaphore(workers + queue_depth)
+        self.rejected_requests = 0
+    
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self.rejected_requests += 1
+            self.reject_request(request)
+            return
+        self.executor.submit(self.process_request_worker, request, client_address)
+    
+    def process_request_worker(self, request, client_address):
+        try:
+            request.settimeout(self.request_timeout)
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+    
+    def reject_request(self, request):
+        """Answer with 503 Service Unavailable without tying up a worker"""
+        body = json.dumps({'status': 'busy', 'message': 'Server is at capacity, retry shortly'}).encode('utf-8')
+        try:
+            request.sendall(
+                b'HTTP/1.0 503 Service Unavailable\r\n'
+                b'Content-Type: application/json\r\n'
+                b'Retry-After: 1\r\n'
+                b'Connection: close\r\n'
+                + f'Content-Length: {len(body)}\r\n\r\n'.encode('ascii')
+                + body
+            )
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+    
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
 class Handler(http.server.SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
@@ -26,10 +379,19 @@ class Handler(http.server.SimpleHTTPRequestHandler):
     def end_headers(self):
         # Add CORS headers to allow API calls
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, x-api-key, anthropic-version')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, x-api-key, anthropic-version, x-request-priority, traceparent')
         super().end_headers()
     
+    def log_request(self, code='-', size='-'):
+        # Access log through the queued logger (not a blocking stderr write), within the request's trace
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('%s %s %s', self.command, self.path, getattr(code, 'value', code),
+                        extra={'status': getattr(code, 'value', code), 'client': self.client_address[0]})
+    
+    def log_message(self, format, *args):
+        logger.warning(format, *args, extra={'client': self.client_address[0]})
+    
     def do_OPTIONS(self):
         # Handle preflight requests
         self.send_response(200)
@@ -37,8 +399,22 @@ class Handler(http.server.SimpleHTTPRequestHandler):
     
     def do_GET(self):
         # Handle memory loading requests
+        path = urllib.parse.urlsplit(self.path).path
         if self.path == '/load-memory':
             self.handle_load_memory()
+        elif self.path == '/proxy-metrics':
+            self.send_json(200, dict(UPSTREAM.metrics(), rate_limits=RATE_LIMITER.metrics(),
+                                     response_cache=PROXY_CACHE.metrics() if PROXY_CACHE is not None else None))
+        elif self.path == '/metrics':
+            self.handle_prometheus_metrics()
+        elif self.path == '/memory-stats':
+            self.handle_memory_stats()
+        elif path == '/memories':
+            self.handle_list_memories()
+        elif path.startswith('/memories/'):
+            self.handle_get_memory(self.memory_id_from_path(path))
+        elif path.startswith('/memory-image/'):
+            self.handle_memory_image(path[len('/memory-image/'):])
         else:
             super().do_GET()
     
@@ -48,8 +424,36 @@ class Handler(http.server.SimpleHTTPRequestHandler):
             self.handle_claude_proxy()
         elif self.path == '/save-memory':
             self.handle_save_memory()
+        elif self.path == '/memories':
+            self.handle_put_memory(None)
+        elif self.path == '/recall':
+            self.handle_recall()
+        elif self.path == '/recall-similar':
+            self.handle_recall_similar()
+        else:
+            self.send_error(404, 'Unknown endpoint')
+    
+    def do_PUT(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path.startswith('/memories/'):
+            self.handle_put_memory(self.memory_id_from_path(path))
         else:
-            super().do_POST()
+            self.send_error(404, 'Unknown endpoint')
+    
+    def do_DELETE(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path.startswith('/memories/'):
+            self.handle_delete_memory(self.memory_id_from_path(path))
+        else:
+            self.send_error(404, 'Unknown endpoint')
+    
+    @staticmethod
+    def memory_id_from_path(path):
+        return urllib.parse.unquote(path[len('/memories/'):])
+    
+    def read_json_body(self):
+        content_length = int(self.headers['Content-Length'])
+        return json.loads(self.rfile.read(content_length).decode('utf-8'))
     
     def handle_claude_proxy(self):
         """Proxy requests to Claude API to avoid CORS issues"""
@@ -59,8 +463,8 @@ class Handler(http.server.SimpleHTTPRequestHandler):
             post_data = self.rfile.read(content_length)
             request_data = json.loads(post_data.decode('utf-8'))
             
-            # Extract API key from request
-            api_key = request_data.get('api_key')
+            # Extract API key from request (the web UI sends it in the body, other clients as a header)
+            api_key = request_data.get('api_key') or self.headers.get('x-api-key')
             if not api_key:
                 self.send_error(400, 'Missing API key')
                 return
@@ -68,107 +472,395 @@ class Handler(http.server.SimpleHTTPRequestHandler):
             # Remove api_key from request data before forwarding
             claude_request = {k: v for k, v in request_data.items() if k != 'api_key'}
             
-            # Prepare the request to Claude API
-            url = 'https://api.anthropic.com/v1/messages'
-            headers = {
-                'x-api-key': api_key,
-                'Content-Type': 'application/json',
-                'anthropic-version': '2023-06-01'
-            }
-            
-            # Make the request to Claude API
-            req = urllib.request.Request(
-                url,
-                data=json.dumps(claude_request).encode('utf-8'),
-                headers=headers,
-                method='POST'
-            )
-            
-            try:
-                with urllib.request.urlopen(req) as response:
-                    # Forward the successful response
-                    response_data = response.read()
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(response_data)
-                    
-            except HTTPError as e:
-                # Forward the error response
-                error_data = e.read()
-                self.send_response(e.code)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(error_data)
+            # Identical requests (same body, whoever's key) are answered from the cache or share one upstream call
+            cache_control = self.headers.get('Cache-Control', '').lower()
+            if PROXY_CACHE is None or 'no-cache' in cache_control or 'no-store' in cache_control:
+                self.forward_claude_request(claude_request, api_key)
+                return
+            cache_key = PROXY_CACHE.make_key(claude_request)
+            outcome, value = PROXY_CACHE.begin(cache_key)
+            METRICS.inc('proxy_cache_requests_total', result=outcome)
+            if outcome == 'miss':
+                response = None
+                try:
+                    response = self.forward_claude_request(claude_request, api_key, cache_status='MISS')
+                finally:
+                    PROXY_CACHE.finish(cache_key, value, response)
+                return
+            cached = value if outcome == 'hit' else value.wait(UPSTREAM_READ_TIMEOUT + RATE_LIMIT_TIMEOUT)
+            if cached is None:
+                # The shared call failed, stalled or was refused for the leader's key: make this request on its own
+                self.forward_claude_request(claude_request, api_key)
+                return
+            self.send_response(cached.status)
+            self.send_header('Content-Type', cached.content_type)
+            self.send_header('Content-Length', str(len(cached.body)))
+            self.send_header('X-Proxy-Cache', 'HIT' if outcome == 'hit' else 'COALESCED')
+            self.end_headers()
+            self.wfile.write(cached.body)
                 
         except Exception as e:
-            print(f"Error handling Claude proxy request: {e}")
+            logger.exception('Error handling Claude proxy request')
             self.send_error(500, f'Server error: {str(e)}')
     
-    def handle_save_memory(self):
-        """Save visual memories to file"""
+    def forward_claude_request(self, claude_request, api_key, cache_status=None):
+        """Send a request upstream and relay the answer to the client
+        
+        Returns the relayed response as a CachedResponse, or None if the request was
+        not answered by the API (local rate limit timeout).
+        """
+        # Prepare the request to Claude API
+        headers = {
+            'x-api-key': api_key,
+            'Content-Type': 'application/json',
+            'anthropic-version': '2023-06-01'
+        }
+        
+        # Wait for the shared rate limiter; UI requests go ahead of clients marking themselves as batch
+        priority = PRIORITIES.get(self.headers.get('x-request-priority', '').lower(), PRIORITY_INTERACTIVE)
         try:
-            # Read the request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            memory_data = json.loads(post_data.decode('utf-8'))
-            
-            # Save to file
-            with open(MEMORY_FILE, 'w', encoding='utf-8') as f:
-                json.dump(memory_data, f, indent=2, ensure_ascii=False)
-            
-            print(f"💾 Saved {len(memory_data.get('memories', []))} visual memories to {MEMORY_FILE}")
+            reservation = RATE_LIMITER.acquire(claude_request.get('model', ''), estimate_request_tokens(claude_request),
+                                               priority, timeout=RATE_LIMIT_TIMEOUT)
+        except RateLimitTimeout as e:
+            self.send_response(429)
+            self.send_header('Retry-After', str(int(RATE_LIMIT_TIMEOUT)))
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'type': 'error', 'error': {'type': 'rate_limit_error', 'message': str(e)}}).encode('utf-8'))
+            return None
+        
+        # Make the request to Claude API over the shared connection pool, continuing the caller's trace if it sent one
+        model = claude_request.get('model', '')
+        attributes = {'gen_ai.system': 'anthropic', 'gen_ai.request.model': model, 'gen_ai.request.stream': bool(claude_request.get('stream'))}
+        with TRACER.span('proxy.claude_messages', attributes, remote_parent(self.headers.get('traceparent'))) as span, \
+                UPSTREAM.request('POST', json.dumps(claude_request).encode('utf-8'), headers, reservation) as response:
+            METRICS.inc('claude_api_requests_total', model=model, status=response.status)
+            if response.status == 200 and claude_request.get('stream'):
+                recorded = [] if cache_status else None
+                usage = self.relay_event_stream(response, recorded, cache_status)
+                self.settle_reservation(reservation, usage)
+                self.record_upstream_call(model, usage, response, span)
+                return CachedResponse(200, 'text/event-stream', b''.join(recorded)) if cache_status else None
             
-            # Send success response
-            self.send_response(200)
+            # Forward the response (including upstream errors) as-is
+            response_data = response.read()
+            if response.status == 200:
+                usage = self.response_usage(response_data)
+                self.settle_reservation(reservation, usage)
+                self.record_upstream_call(model, usage, response, span)
+            elif span is not None:
+                span.set_error(f'Upstream status {response.status}')
+            self.send_response(response.status)
             self.send_header('Content-Type', 'application/json')
+            if cache_status:
+                self.send_header('X-Proxy-Cache', cache_status)
             self.end_headers()
-            response = {'status': 'success', 'message': 'Memories saved successfully'}
-            self.wfile.write(json.dumps(response).encode('utf-8'))
+            self.wfile.write(response_data)
+            return CachedResponse(response.status, 'application/json', response_data)
+    
+    @staticmethod
+    def response_usage(response_data):
+        """The ``usage`` object of a Messages API response body ({} if absent or unparseable)"""
+        try:
+            return json.loads(response_data).get('usage') or {}
+        except (ValueError, AttributeError):
+            return {}
+    
+    def settle_reservation(self, reservation, usage):
+        """Refund the tokens a call reserved but did not use, according to the reported usage"""
+        try:
+            reservation.settle(int(usage['input_tokens']) + int(usage['output_tokens']))
+        except (KeyError, TypeError, ValueError):
+            pass
+    
+    def record_upstream_call(self, model, usage, response, span):
+        """Publish a proxied call's phase timings and token usage to the metrics and its span"""
+        phases = response.phases()
+        input_tokens, output_tokens = record_api_call(model, usage, phases)
+        if span is not None:
+            span.set_attributes({'gen_ai.usage.input_tokens': input_tokens, 'gen_ai.usage.output_tokens': output_tokens,
+                                 **{f'http.{phase}_seconds': round(seconds, 6) for phase, seconds in phases.items()}})
+    
+    def handle_prometheus_metrics(self):
+        """Serve latency histograms, API counters and pool/limiter gauges in the Prometheus text format"""
+        for key, value in UPSTREAM.metrics().items():
+            if isinstance(value, (int, float)):
+                METRICS.set_gauge(f'proxy_upstream_{key}', value)
+        for model, stats in RATE_LIMITER.metrics().items():
+            for key, value in stats.items():
+                METRICS.set_gauge(f'rate_limiter_{key}', value, model=model)
+        if PROXY_CACHE is not None:
+            for key, value in PROXY_CACHE.metrics().items():
+                METRICS.set_gauge(f'proxy_cache_{key}', value)
+        if _memory_capacity is not None:
+            for key, value in _memory_capacity.metrics().items():
+                if isinstance(value, (int, float)):
+                    METRICS.set_gauge(f'memory_bank_{key}', value)
+        body = METRICS.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_json(self, status, payload):
+        """Send a JSON response body"""
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def relay_event_stream(self, response, recorded=None, cache_status=None):
+        """Relay a server-sent event stream to the client line by line as it arrives
+        
+        Returns the token usage reported by the stream's message_start/message_delta events.
+        With ``recorded`` (a list) every line is also kept, for the proxy cache.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        if cache_status:
+            self.send_header('X-Proxy-Cache', cache_status)
+        self.end_headers()
+        
+        usage = {}
+        for line in iter(response.readline, b''):
+            self.wfile.write(line)
+            if recorded is not None:
+                recorded.append(line)
+            if line in (b'\n', b'\r\n'):
+                # End of an event - push it to the browser immediately
+                self.wfile.flush()
+            elif line.startswith(b'data:') and b'"usage"' in line:
+                try:
+                    event = json.loads(line[5:])
+                except ValueError:
+                    continue
+                usage.update((event.get('message') or {}).get('usage') or event.get('usage') or {})
+        self.wfile.flush()
+        return usage
+    
+    def handle_save_memory(self):
+        """Save the full visual memory bank (legacy bulk endpoint)"""
+        try:
+            memory_data = self.read_json_body()
+            store = get_memory_store()
+            
+            # Only memories that were added, changed or removed touch the database; the web
+            # client syncs memories through /memories/<id> and sends only its settings here
+            if 'memories' in memory_data:
+                store.replace_all(memory_data['memories'])
+                logger.info('Saved %d visual memories to %s', len(memory_data['memories']), MEMORY_DB)
+            if memory_data.get('settings'):
+                store.set_settings(memory_data['settings'])
+            
+            self.send_json(200, {'status': 'success', 'message': 'Memories saved successfully'})
             
         except Exception as e:
-            print(f"Error saving memories: {e}")
+            logger.exception('Error saving memories')
             self.send_error(500, f'Error saving memories: {str(e)}')
     
     def handle_load_memory(self):
-        """Load visual memories from file"""
+        """Load the full visual memory bank (legacy bulk endpoint)"""
         try:
-            if os.path.exists(MEMORY_FILE):
-                with open(MEMORY_FILE, 'r', encoding='utf-8') as f:
-                    memory_data = json.load(f)
-                
-                print(f"📂 Loaded {len(memory_data.get('memories', []))} visual memories from {MEMORY_FILE}")
-                
-                # Send the memory data
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(memory_data).encode('utf-8'))
-            else:
-                # File doesn't exist - send 404
-                print(f"📂 No memory file found at {MEMORY_FILE}")
-                self.send_response(404)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                response = {'status': 'not_found', 'message': 'No memory file found'}
-                self.wfile.write(json.dumps(response).encode('utf-8'))
+            store = get_memory_store()
+            if store.count() == 0:
+                logger.info('No visual memories stored in %s', MEMORY_DB)
+                self.send_json(404, {'status': 'not_found', 'message': 'No memory file found'})
+                return
+            
+            memory_data = store.export_all()
+            logger.info('Loaded %d visual memories from %s', len(memory_data['memories']), MEMORY_DB)
+            self.send_json(200, memory_data)
                 
         except Exception as e:
-            print(f"Error loading memories: {e}")
+            logger.exception('Error loading memories')
             self.send_error(500, f'Error loading memories: {str(e)}')
+    
+    def handle_list_memories(self):
+        """GET /memories?offset=0&limit=50 - one page of memories"""
+        try:
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            offset = max(0, int(query.get('offset', ['0'])[0]))
+            limit = min(500, max(1, int(query.get('limit', ['50'])[0])))
+            memories, total = get_memory_store().list(offset, limit)
+            self.send_json(200, {'memories': memories, 'total': total, 'offset': offset, 'limit': limit})
+        except ValueError:
+            self.send_error(400, 'offset and limit must be integers')
+        except Exception as e:
+            logger.exception('Error listing memories')
+            self.send_error(500, f'Error listing memories: {str(e)}')
+    
+    def handle_get_memory(self, memory_id):
+        memory = get_memory_store().get(memory_id)
+        if _memory_capacity is not None:
+            _memory_capacity.record_access(memory_id, memory is not None)
+        if memory is None:
+            self.send_json(404, {'status': 'not_found', 'message': f'No memory with id {memory_id}'})
+        else:
+            self.send_json(200, memory)
+    
+    def handle_memory_stats(self):
+        """GET /memory-stats - size of the memory bank, its limits and eviction hit rate"""
+        store = get_memory_store()
+        if _memory_capacity is None:
+            self.send_json(200, {'count': store.count(), 'max_count': None, 'max_bytes': None, 'policy': None})
+        else:
+            self.send_json(200, _memory_capacity.metrics())
+    
+    def handle_put_memory(self, memory_id):
+        """POST /memories inserts a memory; PUT /memories/<id> inserts or replaces one"""
+        try:
+            memory = self.read_json_body()
+            if memory_id is not None:
+                memory['id'] = memory_id
+            stored_id = get_memory_store().upsert(memory)
+            self.send_json(200 if memory_id is not None else 201, {'status': 'success', 'id': stored_id})
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, f'Invalid memory: {str(e)}')
+        except Exception as e:
+            logger.exception('Error saving memory')
+            self.send_error(500, f'Error saving memory: {str(e)}')
+    
+    def handle_recall(self):
+        """POST /recall {"tags": [...], "k": 5, "threshold": 0.1, "metric": "jaccard"|"overlap"}"""
+        if TagIndex is None:
+            self.send_json(501, {'status': 'unavailable', 'message': 'Memory recall requires numpy'})
+            return
+        try:
+            query = self.read_json_body()
+            tags = query.get('tags') or []
+            if not isinstance(tags, list):
+                raise ValueError('tags must be a list')
+            start = time.perf_counter()
+            matches = get_tag_index().query(tags, int(query.get('k', 5)), float(query.get('threshold', 0.0)),
+                                            query.get('metric', 'jaccard'))
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            
+            store = get_memory_store()
+            results = []
+            for memory_id, score in matches:
+                memory = store.get(memory_id)
+                if memory is not None:
+                    results.append({'id': memory_id, 'score': score, 'memory': memory})
+                    if _memory_capacity is not None:
+                        _memory_capacity.record_access(memory_id)
+            self.send_json(200, {'matches': results, 'query_ms': elapsed_ms})
+        except (ValueError, TypeError) as e:
+            self.send_json(400, {'status': 'error', 'message': str(e)})
+        except Exception as e:
+            logger.exception('Error recalling memories')
+            self.send_error(500, f'Error recalling memories: {str(e)}')
+    
+    def handle_recall_similar(self):
+        """POST /recall-similar {"text": "...", "k": 5} - nearest memories by embedding"""
+        if EmbeddingIndex is None:
+            self.send_json(501, {'status': 'unavailable', 'message': 'Memory recall requires numpy'})
+            return
+        try:
+            query = self.read_json_body()
+            text = query.get('text')
+            if not isinstance(text, str) or not text.strip():
+                raise ValueError('text must be a non-empty string')
+            start = time.perf_counter()
+            matches = get_embedding_index().search(text, int(query.get('k', 5)))
+            if _memory_capacity is not None:
+                for match in matches:
+                    _memory_capacity.record_access(match['id'])
+            self.send_json(200, {'matches': matches, 'query_ms': (time.perf_counter() - start) * 1000})
+        except (ValueError, TypeError) as e:
+            self.send_json(400, {'status': 'error', 'message': str(e)})
+        except Exception as e:
+            logger.exception('Error recalling memories')
+            self.send_error(500, f'Error recalling memories: {str(e)}')
+    
+    def handle_memory_image(self, image_hash):
+        """Serve raw image bytes from the blob store with ETag and Range support"""
+        blob_store = get_memory_store().blob_store
+        if not HASH_PATTERN.match(image_hash) or not blob_store.exists(image_hash):
+            self.send_json(404, {'status': 'not_found', 'message': 'No such image'})
+            return
+        
+        etag = f'"{image_hash}"'
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        
+        blob_path = blob_store.path(image_hash)
+        size = os.path.getsize(blob_path)
+        start, end = 0, size - 1
+        range_header = self.headers.get('Range')
+        if range_header:
+            match = re.match(r'bytes=(\d*)-(\d*)$', range_header.strip())
+            if not match or match.groups() == ('', ''):
+                self.send_range_not_satisfiable(size)
+                return
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                # Suffix range: the last N bytes
+                start = max(0, size - int(match.group(2)))
+            if start > end or start >= size:
+                self.send_range_not_satisfiable(size)
+                return
+        
+        length = end - start + 1
+        with open(blob_path, 'rb') as f:
+            self.send_response(206 if range_header else 200)
+            self.send_header('Content-Type', blob_store.media_type(image_hash))
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+            if range_header:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.end_headers()
+            self.wfile.flush()
+            # Zero-copy transfer straight from the page cache where the OS supports it
+            self.connection.sendfile(f, start, length)
+    
+    def send_range_not_satisfiable(self, size):
+        self.send_response(416)
+        self.send_header('Content-Range', f'bytes */{size}')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def handle_delete_memory(self, memory_id):
+        if get_memory_store().delete(memory_id):
+            self.send_json(200, {'status': 'success', 'id': memory_id})
+        else:
+            self.send_json(404, {'status': 'not_found', 'message': f'No memory with id {memory_id}'})
 
 def main():
+    parser = argparse.ArgumentParser(description='Claude Neural Visual Processing Simulator server')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS, help='concurrent request handlers')
+    parser.add_argument('--queue-depth', type=int, default=QUEUE_DEPTH, help='requests allowed to wait before 503')
+    parser.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT, help='per-request client socket timeout in seconds')
+    parser.add_argument('--no-browser', action='store_true', help='do not open a web browser')
+    parser.add_argument('--log-format', choices=('json', 'text'), help='log record format (default: SIM_LOG_FORMAT or json)')
+    parser.add_argument('--quiet', action='store_true', help='log warnings and errors only')
+    args = parser.parse_args()
+    configure_logging(fmt=args.log_format, quiet=args.quiet or None)
+    
     print(f"Claude Neural Visual Processing Simulator")
-    print(f"Starting HTTP server on port {PORT}...")
+    print(f"Starting HTTP server on port {args.port}...")
     print(f"Directory: {DIRECTORY}")
+    print(f"Workers: {args.workers}, queue depth: {args.queue_depth}, request timeout: {args.timeout}s")
     
     try:
-        with socketserver.TCPServer(("", PORT), Handler) as httpd:
-            print(f"Server running at http://localhost:{PORT}/")
-            print(f"Opening web browser...")
+        with BoundedThreadPoolServer(("", args.port), Handler, args.workers, args.queue_depth, args.timeout) as httpd:
+            print(f"Server running at http://localhost:{args.port}/")
             
-            # Open the browser automatically
-            webbrowser.open(f'http://localhost:{PORT}/index.html')
+            if not args.no_browser:
+                # Open the browser automatically
+                print(f"Opening web browser...")
+                webbrowser.open(f'http://localhost:{args.port}/index.html')
             
             print(f"Press Ctrl+C to stop the server")
             httpd.serve_forever()
@@ -178,7 +870,7 @@ def main():
         sys.exit(0)
     except OSError as e:
         if e.errno == 48:  # Address already in use
-            print(f"Error: Port {PORT} is already in use")
+            print(f"Error: Port {args.port} is already in use")
             print(f"Try using a different port or stop the existing server")
         else:
             print(f"Error starting server: {e}")
@@ -0,0 +1,168 @@
+"""
+Structured logging for the Claude Neural Visual Processing Simulator
+Leveled JSON-lines records written by a background thread through a queue, stamped
+with the active trace and span ids so proxy requests correlate with simulation steps
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+from instrumentation import TRACER
+
+# Loggers used by script.py and start_server.py
+LOGGER_NAMES = ('simulator', 'proxy')
+
+# Attributes every LogRecord has; anything else on a record came from ``extra=`` and is emitted as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName', 'trace_id', 'span_id'}
+
+_listener = None
+_level = logging.INFO
+
+
+class CorrelationFilter(logging.Filter):
+    """Stamps each record with the trace and span id of the span active where it was logged
+
+    Runs in the logging thread (before the record is queued), where the span context is.
+    A proxy request carrying the simulator's ``traceparent`` shares its trace id.
+    """
+
+    def filter(self, record):
+        span = TRACER.current_span()
+        record.trace_id = span.trace_id if span is not None else None
+        record.span_id = span.span_id if span is not None else None
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records with their fields intact so the listener's formatter lays them out
+
+    The stdlib ``prepare()`` formats the whole record (traceback included) into
+    ``msg`` and clears ``exc_info``, which leaves a JSON line's traceback inside its
+    ``message``. This one only merges ``args`` into the message and renders the
+    traceback to ``exc_text`` (so no frames are kept alive in the queue).
+    """
+
+    _traceback_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or self._traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, correlation ids and ``extra`` fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'trace_id', None):
+            entry['trace_id'] = record.trace_id
+            entry['span_id'] = record.span_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines with the ``extra`` fields appended as key=value pairs"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)-7s %(name)s: %(message)s')
+
+    def formatMessage(self, record):
+        # The line before any traceback, so the fields stay next to the message
+        fields = [f'{key}={value}' for key, value in record.__dict__.items() if key not in _RECORD_ATTRIBUTES]
+        if getattr(record, 'trace_id', None):
+            fields.append(f'trace_id={record.trace_id}')
+        return ' '.join([super().formatMessage(record)] + fields)
+
+
+def configure_logging(level=None, fmt=None, path=None, quiet=None):
+    """Route the simulator and proxy loggers through a queue to one background writer
+
+    Logging calls only enqueue the record; formatting and the stream or file write
+    happen on the listener thread. Defaults come from the environment:
+    ``SIM_LOG_LEVEL`` (INFO), ``SIM_LOG_FORMAT`` (``json`` or ``text``),
+    ``SIM_LOG_FILE`` (stderr when unset) and ``SIM_LOG_QUIET`` (warnings and errors
+    only, for batch runs). Calling it again replaces the previous configuration.
+    """
+    global _listener, _level
+    level = level or os.environ.get('SIM_LOG_LEVEL', 'INFO')
+    level = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+    if quiet is None:
+        quiet = os.environ.get('SIM_LOG_QUIET', '').lower() in ('1', 'true', 'yes')
+    _level = level
+    if quiet:
+        level = max(level, logging.WARNING)
+    fmt = fmt or os.environ.get('SIM_LOG_FORMAT', 'json')
+    if fmt not in ('json', 'text'):
+        raise ValueError(f"Unsupported log format '{fmt}'. Use 'json' or 'text'")
+    path = path or os.environ.get('SIM_LOG_FILE')
+
+    _stop_listener()
+    target = logging.FileHandler(path, encoding='utf-8') if path else logging.StreamHandler(sys.stderr)
+    target.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationFilter())
+    for name in LOGGER_NAMES:
+        logger = logging.getLogger(name)
+        logger.handlers = [queue_handler]
+        logger.setLevel(level)
+        logger.propagate = False
+    _listener = logging.handlers.QueueListener(log_queue, target)
+    _listener.start()
+    return _listener
+
+
+def set_quiet(quiet=True):
+    """Switch between warnings-only and the configured level without reconfiguring handlers"""
+    for name in LOGGER_NAMES:
+        logging.getLogger(name).setLevel(max(_level, logging.WARNING) if quiet else _level)
+
+
+def ensure_configured():
+    """Configure logging from the environment unless the application already set it up"""
+    if _listener is None and not logging.getLogger().handlers and not logging.getLogger(LOGGER_NAMES[0]).handlers:
+        configure_logging()
+
+
+def _stop_listener():
+    """Stop the background writer after it drains the queue, then close its handlers"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def shutdown_logging():
+    """Flush queued records, stop the background writer and close its stream or file"""
+    _stop_listener()
+
+
+atexit.register(shutdown_logging)